@@ -0,0 +1,277 @@
+"""
+Batching - Cross-request batching for the YOLO detection and counting models
+Concurrent requests are grouped while the detection pool is busy and run
+as one forward pass; each request still gets its own conf threshold and
+annotated image.
+"""
+import os
+import time
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+from profiler import NULL_TIMER
+from deadlines import RequestAborted
+from executors import PRIORITY_CLASSES, INTERACTIVE
+
+
+class DetectionBatcher:
+    """Group concurrent detection/count requests into batched predictor calls"""
+
+    def __init__(self, predictor, pool, task, max_batch=8, max_wait_ms=5.0):
+        """
+        Args:
+            predictor: BloodCellPredictor providing predict_detection_batch
+            pool: InferencePool the batches run on
+            task: 'detection' or 'count'
+            max_batch: Maximum number of images per forward pass
+            max_wait_ms: How long the first request waits for others to join
+        """
+        self.predictor = predictor
+        self.pool = pool
+        self.task = task
+        self.max_batch = max(int(max_batch), 1)
+        self.max_wait = max(float(max_wait_ms), 0.0) / 1000.0
+
+        self._pending = {cls: deque() for cls in PRIORITY_CLASSES}
+        self._cond = threading.Condition()
+        # One batch in flight per pool worker; further requests keep accumulating
+        self._slots = threading.Semaphore(pool.workers)
+        self._closed = False
+
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._items = 0
+        self._largest = 0
+        self._wait_seconds = 0.0
+        self._dropped = 0
+
+        self._thread = threading.Thread(target=self._collect, name=f"{task}-batcher", daemon=True)
+        self._thread.start()
+
+    def submit(self, image, conf=0.25, show_labels=True, logger=None, timer=None, priority=INTERACTIVE,
+               annotate=True):
+        """
+        Queue one image for the next batch
+        Args:
+            priority: 'interactive' or 'bulk'
+            annotate: Draw the annotated image (False leaves annotated_image None)
+        Returns:
+            concurrent.futures.Future with the same result as predict_detection(_count)
+        """
+        future = Future()
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"{self.task} batcher is shut down")
+            self._pending[priority].append((future, image, conf, show_labels, annotate, logger, timer, time.perf_counter()))
+            self._cond.notify()
+        return future
+
+    def _pending_count(self):
+        return sum(len(pending) for pending in self._pending.values())
+
+    def _take(self):
+        # Called with the lock held. Each waiting class gets a share of the
+        # batch proportional to its pool weight, leftovers go to the highest class
+        waiting = [cls for cls in PRIORITY_CLASSES if self._pending[cls]]
+        total = sum(self.pool.weights[cls] for cls in waiting)
+        batch = []
+        for cls in waiting:
+            share = max(int(self.max_batch * self.pool.weights[cls] / total), 1)
+            while self._pending[cls] and share > 0 and len(batch) < self.max_batch:
+                batch.append(self._pending[cls].popleft())
+                share -= 1
+        for cls in waiting:
+            while self._pending[cls] and len(batch) < self.max_batch:
+                batch.append(self._pending[cls].popleft())
+        # The batch is scheduled at the priority of its most urgent request
+        return waiting[0], batch
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending_count() and not self._closed:
+                self._cond.wait()
+            if not self._pending_count():
+                return None
+
+            # Give other requests up to max_wait (from the oldest arrival) to join
+            oldest = min(pending[0][-1] for pending in self._pending.values() if pending)
+            deadline = oldest + self.max_wait
+            while self._pending_count() < self.max_batch and not self._closed:
+                remaining = deadline - time.perf_counter()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            return self._take()
+
+    def _collect(self):
+        while True:
+            self._slots.acquire()
+            next_batch = self._next_batch()
+            if next_batch is None:
+                self._slots.release()
+                break
+            priority, batch = next_batch
+            future = self.pool.submit_as(priority, self._run_batch, batch)
+            future.add_done_callback(lambda _: self._slots.release())
+
+    def _live(self, item):
+        future, timer = item[0], item[6]
+        error = None
+        if future.set_running_or_notify_cancel():
+            try:
+                # Deadline passed or client gone while queued - skip the forward pass
+                (timer or NULL_TIMER).check()
+                return True
+            except RequestAborted as e:
+                error = e
+        with self._lock:
+            self._dropped += 1
+        if error is not None:
+            future.set_exception(error)
+        return False
+
+    def _run_batch(self, batch):
+        batch = [item for item in batch if self._live(item)]
+        if not batch:
+            return
+        # A batch formed before a hot reload may be larger than the new model accepts
+        limit = self.predictor.model_loader.detection_batch_limit(self.task) or len(batch)
+        for start in range(0, len(batch), limit):
+            try:
+                self._run_items(batch[start:start + limit])
+            except BaseException as e:
+                for item in batch[start + limit:]:
+                    item[0].set_exception(e)
+                raise
+
+    def _run_items(self, batch):
+        started = time.perf_counter()
+        with self._lock:
+            self._batches += 1
+            self._items += len(batch)
+            self._largest = max(self._largest, len(batch))
+            self._wait_seconds += sum(started - item[-1] for item in batch)
+
+        futures, images, confs, show_labels, annotates, loggers, timers, _ = zip(*batch)
+        try:
+            results = self.predictor.predict_detection_batch(
+                list(images), list(confs), list(show_labels),
+                task=self.task, loggers=list(loggers), timers=list(timers),
+                annotate=list(annotates)
+            )
+        except BaseException as e:
+            for future in futures:
+                future.set_exception(e)
+            raise
+
+        for future, result in zip(futures, results):
+            if isinstance(result, RequestAborted):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    def resize(self, max_batch):
+        """Change the maximum batch size (e.g. after the served model changed)"""
+        with self._cond:
+            self.max_batch = max(int(max_batch), 1)
+            self._cond.notify_all()
+
+    def shutdown(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Batch size and wait statistics
+        Returns:
+            dict with configuration and counters
+        """
+        with self._lock:
+            return {
+                "max_batch": self.max_batch,
+                "max_wait_ms": round(self.max_wait * 1000, 3),
+                "pending": {cls: len(self._pending[cls]) for cls in PRIORITY_CLASSES},
+                "batches": self._batches,
+                "items": self._items,
+                "largest_batch": self._largest,
+                "dropped": self._dropped,
+                "mean_batch_size": round(self._items / self._batches, 3) if self._batches else 0.0,
+                "mean_batch_wait_ms": round(self._wait_seconds / self._items * 1000, 3) if self._items else 0.0
+            }
+
+
+def batch_settings():
+    """
+    Batching settings from environment variables
+    DL_DETECTION_BATCH_SIZE: images per forward pass (1 disables batching)
+    DL_DETECTION_BATCH_WAIT_MS: how long a request waits for others to join
+    Returns:
+        tuple: (max batch, max wait in ms)
+    """
+    return (int(os.environ.get('DL_DETECTION_BATCH_SIZE', '8')),
+            float(os.environ.get('DL_DETECTION_BATCH_WAIT_MS', '5')))
+
+
+def batch_size_for(model_loader, task, max_batch):
+    # Static-shape ONNX/OpenVINO exports cap the batch size
+    limit = model_loader.detection_batch_limit(task)
+    return min(max_batch, limit) if limit else max_batch
+
+
+def build_batchers(predictor, topology):
+    """
+    Create the detection and count batchers from environment variables (see batch_settings)
+    Returns:
+        dict mapping task name to DetectionBatcher (tasks without batching are omitted)
+    """
+    max_batch, max_wait_ms = batch_settings()
+
+    batchers = {}
+    for task in ('detection', 'count'):
+        size = batch_size_for(predictor.model_loader, task, max_batch)
+        if size > 1:
+            batchers[task] = DetectionBatcher(predictor, topology.pool_for(task), task, size, max_wait_ms)
+        elif max_batch > 1:
+            print(f"⚠ {task} model is a static-shape export, batching disabled")
+    return batchers
+
+
+def limit_batcher(batchers, model_loader, task, filename, fmt):
+    """
+    Shrink a task's batcher to the batch limit of a model about to be installed
+    Args:
+        batchers: dict from build_batchers
+        model_loader: ModelLoader serving the task
+        task: 'detection' or 'count'
+        filename: Checkpoint of the new version
+        fmt: Its serving format
+    """
+    batcher = batchers.get(task)
+    limit = model_loader.detection_batch_limit(task, filename, fmt)
+    if batcher is not None and limit and batcher.max_batch > limit:
+        batcher.resize(limit)
+
+
+def update_batcher(batchers, predictor, topology, task):
+    """
+    Fit a task's batcher to the model now served (called after a hot reload)
+    Args:
+        batchers: dict from build_batchers, updated in place
+        predictor: BloodCellPredictor the batches run on
+        topology: ExecutionTopology owning the task's pool
+        task: 'detection' or 'count'
+    """
+    max_batch, max_wait_ms = batch_settings()
+    size = batch_size_for(predictor.model_loader, task, max_batch)
+    batcher = batchers.get(task)
+    if batcher is not None:
+        # Keeps running with batches of one, so queued requests are not lost
+        batcher.resize(size)
+    elif size > 1 and topology is not None:
+        batchers[task] = DetectionBatcher(predictor, topology.pool_for(task), task, size, max_wait_ms)
+    else:
+        return
+    print(f"✓ {task} batching: up to {size} image(s) per forward pass")
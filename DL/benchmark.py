@@ -0,0 +1,429 @@
+"""
+Benchmark - Reproducible performance benchmark for the DL service
+Drives BloodCellPredictor directly and the FastAPI app in-process across
+every classifier and both YOLO models
+
+Usage:
+    python benchmark.py --standin --output bench.json
+    python benchmark.py --models mobilenet-v2,count --batch-sizes 1,8 --resolutions 224,1024
+"""
+import os
+# Force TensorFlow to use legacy Keras 2.x for compatibility with older models
+os.environ['TF_USE_LEGACY_KERAS'] = '1'
+
+import argparse
+import asyncio
+import csv
+import io
+import json
+import logging
+import platform
+import resource
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from interface import BloodCellPredictor
+from standins import StandInModelLoader, synthetic_smear, CLASSIFIER_IDS
+
+
+DETECTION_TARGETS = ['detection', 'count']
+
+# Silent logger so predictor debug output does not skew timings
+quiet_logger = logging.getLogger("benchmark.quiet")
+quiet_logger.addHandler(logging.NullHandler())
+quiet_logger.propagate = False
+
+
+# ==================== MEASUREMENT HELPERS ====================
+
+def latency_summary(latencies_ms):
+    """
+    Summarize a list of latencies
+    Args:
+        latencies_ms: Latencies in milliseconds
+    Returns:
+        dict with mean/min/max and p50/p95/p99
+    """
+    if not latencies_ms:
+        return {}
+    values = np.asarray(latencies_ms, dtype=np.float64)
+    return {
+        "mean_ms": round(float(values.mean()), 3),
+        "min_ms": round(float(values.min()), 3),
+        "p50_ms": round(float(np.percentile(values, 50)), 3),
+        "p95_ms": round(float(np.percentile(values, 95)), 3),
+        "p99_ms": round(float(np.percentile(values, 99)), 3),
+        "max_ms": round(float(values.max()), 3)
+    }
+
+
+def peak_rss_mb():
+    """Peak resident set size of this process in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, macOS reports bytes
+    if sys.platform == 'darwin':
+        return round(peak / (1024 * 1024), 1)
+    return round(peak / 1024, 1)
+
+
+def current_rss_mb():
+    """Current resident set size of this process in MB"""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        return round(pages * os.sysconf('SC_PAGE_SIZE') / (1024 * 1024), 1)
+    except (OSError, ValueError):
+        return None
+
+
+def environment_info():
+    """Describe the machine and library versions the benchmark ran on"""
+    versions = {}
+    for name in ('numpy', 'tensorflow', 'torch', 'ultralytics', 'fastapi', 'cv2', 'PIL'):
+        module = sys.modules.get(name)
+        if module is not None:
+            versions[name] = getattr(module, '__version__', 'unknown')
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "processor": platform.processor(),
+        "cpu_count": os.cpu_count(),
+        "versions": versions
+    }
+
+
+# ==================== SETUP ====================
+
+def load_models(standin, models_dir):
+    """
+    Load models and measure startup time
+    Args:
+        standin: Use stand-in models instead of real weights
+        models_dir: Directory containing the model files
+    Returns:
+        tuple: (model_loader, startup timings dict)
+    """
+    startup = {}
+    start = time.perf_counter()
+    if standin:
+        loader = StandInModelLoader(models_dir=models_dir)
+    else:
+        from model_loader import ModelLoader
+        loader = ModelLoader(models_dir=models_dir)
+    startup["import_s"] = round(time.perf_counter() - start, 3)
+
+    start = time.perf_counter()
+    loader.load_all_models()
+    startup["load_s"] = round(time.perf_counter() - start, 3)
+    startup["rss_after_load_mb"] = current_rss_mb()
+    return loader, startup
+
+
+def make_images(resolutions, seed):
+    """
+    Build synthetic images (and their JPEG encodings) for each resolution
+    Args:
+        resolutions: List of square image sizes
+        seed: Random seed
+    Returns:
+        dict mapping resolution to (RGB array, JPEG bytes)
+    """
+    images = {}
+    for size in resolutions:
+        array = synthetic_smear(size, size, seed=seed + size)
+        buffered = io.BytesIO()
+        Image.fromarray(array).save(buffered, format="JPEG", quality=90)
+        images[size] = (array, buffered.getvalue())
+    return images
+
+
+def load_image_dir(path, limit=None):
+    """Load real images from a directory (overrides synthetic images)"""
+    files = sorted(f for f in os.listdir(path) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+    images = []
+    for filename in files[:limit]:
+        with open(os.path.join(path, filename), 'rb') as f:
+            data = f.read()
+        images.append((np.array(Image.open(io.BytesIO(data)).convert('RGB')), data))
+    return images
+
+
+# ==================== DIRECT (PREDICTOR) MODE ====================
+
+def make_direct_call(predictor, target, image, batch_size, conf):
+    """Build a zero-argument callable that runs one predictor invocation"""
+    if target in CLASSIFIER_IDS:
+        if batch_size == 1:
+            return lambda: predictor.predict_classification(image, model_id=target, logger=quiet_logger)
+        batch = [image] * batch_size
+        return lambda: predictor.predict_classification_batch(batch, model_id=target, logger=quiet_logger)
+
+    if batch_size == 1:
+        if target == 'detection':
+            return lambda: predictor.predict_detection(image, conf=conf, logger=quiet_logger)
+        return lambda: predictor.predict_detection_count(image, conf=conf, logger=quiet_logger)
+
+    # Batched YOLO forward pass with per-image post-processing
+    task = 'detection' if target == 'detection' else 'count'
+    batch = [image] * batch_size
+    return lambda: predictor.predict_detection_batch(
+        batch, [conf] * batch_size, [True] * batch_size, task=task, loggers=[quiet_logger] * batch_size
+    )
+
+
+def run_direct(call, concurrency, iterations, warmup):
+    """
+    Run a callable repeatedly from a thread pool
+    Returns:
+        tuple: (latencies in ms, wall seconds, error count)
+    """
+    for _ in range(warmup):
+        call()
+
+    def timed():
+        start = time.perf_counter()
+        call()
+        return (time.perf_counter() - start) * 1000
+
+    latencies = []
+    errors = 0
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        futures = [pool.submit(timed) for _ in range(iterations)]
+        for future in futures:
+            try:
+                latencies.append(future.result())
+            except Exception:
+                errors += 1
+    return latencies, time.perf_counter() - start, errors
+
+
+# ==================== HTTP (IN-PROCESS APP) MODE ====================
+
+def http_request_args(target, jpeg_bytes, conf):
+    """Build the endpoint path and form fields for a target"""
+    files = {"image": ("bench.jpg", jpeg_bytes, "image/jpeg")}
+    if target in CLASSIFIER_IDS:
+        return "/predict/classification", files, {"model_id": target}
+    path = "/predict/detection" if target == 'detection' else "/predict/count"
+    return path, files, {"conf": str(conf), "show_labels": "true"}
+
+
+async def run_http(app, target, jpeg_bytes, conf, concurrency, iterations, warmup):
+    """
+    Drive the FastAPI app in-process through an ASGI transport
+    Returns:
+        tuple: (latencies in ms, wall seconds, error count)
+    """
+    import httpx
+
+    path, files, data = http_request_args(target, jpeg_bytes, conf)
+    transport = httpx.ASGITransport(app=app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench", timeout=None) as client:
+        for _ in range(warmup):
+            await client.post(path, files=files, data=data)
+
+        semaphore = asyncio.Semaphore(concurrency)
+        latencies = []
+        errors = 0
+
+        async def timed():
+            nonlocal errors
+            async with semaphore:
+                start = time.perf_counter()
+                response = await client.post(path, files=files, data=data)
+                elapsed = (time.perf_counter() - start) * 1000
+                if response.status_code == 200:
+                    latencies.append(elapsed)
+                else:
+                    errors += 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(timed() for _ in range(iterations)))
+        return latencies, time.perf_counter() - start, errors
+
+
+def prepare_app(model_loader, predictor):
+    """
+    Import the FastAPI app and point it at the already-loaded models
+    Returns:
+        tuple: (app, import seconds)
+    """
+    start = time.perf_counter()
+    import main
+    import_s = time.perf_counter() - start
+    # The lifespan handler is not run by the ASGI transport, inject its state directly
+    from decoding import build_decoder
+    main.model_loader = model_loader
+    main.predictor = predictor
+    main.decoder = build_decoder()
+    main.startup.mark_ready()
+    return main.app, round(import_s, 3)
+
+
+# ==================== DRIVER ====================
+
+def parse_list(value, cast=str):
+    return [cast(v.strip()) for v in value.split(',') if v.strip()]
+
+
+def run_benchmark(args):
+    """
+    Run every scenario in the benchmark matrix
+    Returns:
+        dict with environment, startup timings and per-scenario results
+    """
+    targets = parse_list(args.models) if args.models else CLASSIFIER_IDS + DETECTION_TARGETS
+    batch_sizes = parse_list(args.batch_sizes, int)
+    resolutions = parse_list(args.resolutions, int)
+    concurrencies = parse_list(args.concurrency, int)
+    modes = parse_list(args.modes)
+
+    model_loader, startup = load_models(args.standin, args.models_dir)
+    predictor = BloodCellPredictor(model_loader)
+
+    if args.image_dir:
+        real = load_image_dir(args.image_dir, limit=len(resolutions))
+        images = {array.shape[0]: (array, data) for array, data in real}
+        resolutions = list(images.keys())
+    else:
+        images = make_images(resolutions, args.seed)
+
+    app = None
+    if 'http' in modes:
+        app, startup["app_import_s"] = prepare_app(model_loader, predictor)
+
+    report = {
+        "environment": environment_info(),
+        "config": {
+            "standin": args.standin,
+            "targets": targets,
+            "batch_sizes": batch_sizes,
+            "resolutions": resolutions,
+            "concurrency": concurrencies,
+            "modes": modes,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "conf": args.conf,
+            "seed": args.seed
+        },
+        "startup": startup,
+        "results": []
+    }
+
+    for target in targets:
+        if target not in CLASSIFIER_IDS and target not in DETECTION_TARGETS:
+            print(f"⚠ Skipping unknown target: {target}")
+            continue
+        if target in CLASSIFIER_IDS and model_loader.classification_models.get(target) is None:
+            print(f"⚠ Skipping {target}: model not loaded")
+            continue
+
+        for mode in modes:
+            # The HTTP endpoints take one image per request
+            mode_batch_sizes = batch_sizes if mode == 'direct' else [1]
+            for resolution in resolutions:
+                array, jpeg_bytes = images[resolution]
+                for batch_size in mode_batch_sizes:
+                    for concurrency in concurrencies:
+                        try:
+                            if mode == 'direct':
+                                call = make_direct_call(predictor, target, array, batch_size, args.conf)
+                                latencies, wall, errors = run_direct(
+                                    call, concurrency, args.iterations, args.warmup
+                                )
+                            else:
+                                latencies, wall, errors = asyncio.run(run_http(
+                                    app, target, jpeg_bytes, args.conf,
+                                    concurrency, args.iterations, args.warmup
+                                ))
+                        except Exception as e:
+                            print(f"✗ {target}/{mode}/{resolution}px/b{batch_size}/c{concurrency} failed: {str(e)}")
+                            continue
+
+                        completed = len(latencies)
+                        row = {
+                            "target": target,
+                            "mode": mode,
+                            "resolution": resolution,
+                            "batch_size": batch_size,
+                            "concurrency": concurrency,
+                            "requests": completed,
+                            "errors": errors,
+                            "wall_s": round(wall, 3),
+                            "throughput_rps": round(completed / wall, 3) if wall else 0.0,
+                            "throughput_ips": round(completed * batch_size / wall, 3) if wall else 0.0,
+                            "peak_rss_mb": peak_rss_mb()
+                        }
+                        row.update(latency_summary(latencies))
+                        report["results"].append(row)
+                        print(f"✓ {target:16s} {mode:6s} {resolution:5d}px b={batch_size:<3d} c={concurrency:<3d} "
+                              f"{row['throughput_ips']:9.2f} img/s  p50={row.get('p50_ms', 0):8.2f}ms  "
+                              f"p99={row.get('p99_ms', 0):8.2f}ms")
+
+    if app is not None:
+        import main
+        main.decoder.shutdown()
+    report["peak_rss_mb"] = peak_rss_mb()
+    return report
+
+
+def write_report(report, output, fmt):
+    """Write the report as JSON or CSV ('-' writes to stdout)"""
+    to_stdout = output == '-'
+    if fmt == 'csv':
+        rows = report["results"]
+        fieldnames = sorted({key for row in rows for key in row})
+        handle = sys.stdout if to_stdout else open(output, 'w', newline='')
+        try:
+            writer = csv.DictWriter(handle, fieldnames=fieldnames)
+            writer.writeheader()
+            writer.writerows(rows)
+        finally:
+            if not to_stdout:
+                handle.close()
+    else:
+        text = json.dumps(report, indent=2)
+        if to_stdout:
+            print(text)
+        else:
+            with open(output, 'w') as f:
+                f.write(text)
+    if not to_stdout:
+        print(f"✓ Report written to {output}")
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Benchmark the blood cell DL service")
+    parser.add_argument("--models", default="",
+                        help="Comma-separated targets (classifier ids, 'detection', 'count'); default all")
+    parser.add_argument("--modes", default="direct,http", help="Comma-separated: direct, http")
+    parser.add_argument("--batch-sizes", default="1,4,16", help="Batch sizes for direct mode")
+    parser.add_argument("--resolutions", default="224,640,1280", help="Square synthetic image sizes")
+    parser.add_argument("--concurrency", default="1,4", help="Concurrent callers")
+    parser.add_argument("--iterations", type=int, default=30, help="Measured calls per scenario")
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured warmup calls per scenario")
+    parser.add_argument("--conf", type=float, default=0.25, help="Detection confidence threshold")
+    parser.add_argument("--seed", type=int, default=0, help="Seed for synthetic images")
+    parser.add_argument("--standin", action="store_true", help="Use stand-in models (no weights needed)")
+    parser.add_argument("--models-dir", default="models", help="Directory containing the model files")
+    parser.add_argument("--image-dir", default=None, help="Use real images from this directory")
+    parser.add_argument("--output", default=None,
+                        help="Output file, '-' for stdout (default: benchmark_results.<format>)")
+    parser.add_argument("--format", choices=["json", "csv"], default="json", help="Output format")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    print("=" * 60)
+    print("Blood Cell Analysis Benchmark")
+    print("=" * 60)
+    report = run_benchmark(args)
+    write_report(report, args.output or f"benchmark_results.{args.format}", args.format)
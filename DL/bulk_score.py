@@ -0,0 +1,458 @@
+"""
+Bulk Score - Offline batch scoring of image directories with resumable progress
+Runs BloodCellPredictor directly (no HTTP server): images are decoded by a
+reader thread pool, classified and/or counted in batches, and written to
+CSV or Parquet in chunks. A checkpoint is updated after every chunk, so an
+interrupted run picks up where it stopped when started again.
+
+Usage:
+    python bulk_score.py --input /data/smears --output scores.csv
+    python bulk_score.py --manifest images.txt --tasks count --output scores.parquet
+    python bulk_score.py --input /data/smears --output scores.csv --restart
+"""
+import os
+# Force TensorFlow to use legacy Keras 2.x for compatibility with older models
+os.environ['TF_USE_LEGACY_KERAS'] = '1'
+
+import argparse
+import csv
+import hashlib
+import importlib.util
+import itertools
+import json
+import logging
+import sys
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+
+from interface import BloodCellPredictor
+from decoding import build_decoder
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff')
+TASKS = ['classification', 'count']
+CHECKPOINT_VERSION = 1
+
+# Silent logger so per-image predictor output does not flood the console
+quiet_logger = logging.getLogger("bulk_score.quiet")
+quiet_logger.addHandler(logging.NullHandler())
+quiet_logger.propagate = False
+
+
+# ==================== INPUTS ====================
+
+def list_images(input_dir=None, manifest=None):
+    """
+    Collect the images to score in a stable order
+    Args:
+        input_dir: Directory walked recursively for image files
+        manifest: Text file with one path per line, or a CSV with a 'path' column
+            (relative paths are resolved against the manifest's directory)
+    Returns:
+        Sorted list of image paths
+    """
+    if manifest:
+        base = os.path.dirname(os.path.abspath(manifest))
+        with open(manifest, 'r', encoding='utf-8', newline='') as f:
+            first = f.readline()
+            f.seek(0)
+            if first.strip().lower().split(',')[0] == 'path':
+                paths = [row['path'] for row in csv.DictReader(f)]
+            else:
+                paths = [line.strip() for line in f]
+        paths = [os.path.join(base, p) for p in paths if p and not p.startswith('#')]
+    else:
+        paths = []
+        for root, dirs, files in os.walk(input_dir):
+            dirs.sort()
+            paths.extend(os.path.join(root, name) for name in files if name.lower().endswith(IMAGE_EXTENSIONS))
+    return sorted(paths)
+
+
+def fingerprint(paths):
+    """Hash of the image list, so a checkpoint is never applied to different inputs"""
+    digest = hashlib.sha256()
+    for path in paths:
+        digest.update(path.encode('utf-8'))
+        digest.update(b'\0')
+    return digest.hexdigest()
+
+
+def read_images(paths, decoder, readers, prefetch):
+    """
+    Decode images on a thread pool, yielding them in input order
+    At most `prefetch` decoded images are held in memory.
+    Args:
+        decoder: ImageDecoder (see decoding.py)
+    Yields:
+        tuple: (path, PIL Image or None, error message or None)
+    """
+    def decode_image(path):
+        with open(path, 'rb') as f:
+            return decoder.decode(f.read())
+
+    with ThreadPoolExecutor(max_workers=readers, thread_name_prefix="reader") as pool:
+        pending = deque()
+        remaining = iter(paths)
+        for path in itertools.islice(remaining, prefetch):
+            pending.append((path, pool.submit(decode_image, path)))
+        while pending:
+            path, future = pending.popleft()
+            following = next(remaining, None)
+            if following is not None:
+                pending.append((following, pool.submit(decode_image, following)))
+            try:
+                yield path, future.result(), None
+            except Exception as e:
+                yield path, None, f"{type(e).__name__}: {str(e)}"
+
+
+# ==================== SCORING ====================
+
+def output_columns(loader, tasks, save_boxes):
+    columns = ['path', 'status', 'error', 'width', 'height']
+    if 'classification' in tasks:
+        columns += ['predicted_class', 'confidence']
+        columns += [f"prob_{name}" for name in loader.classification_classes]
+    if 'count' in tasks:
+        columns += [f"count_{name}" for name in loader.detection_count_classes] + ['total_cells']
+        if save_boxes:
+            columns.append('boxes')
+    return columns
+
+
+def classify(predictor, images, model_id):
+    """
+    Classify a batch, retrying image by image if the batch fails
+    Returns:
+        list with a result dict or an error message per image
+    """
+    try:
+        return predictor.predict_classification_batch(images, model_id=model_id, logger=quiet_logger)
+    except Exception as e:
+        if len(images) == 1:
+            return [f"{type(e).__name__}: {str(e)}"]
+    results = []
+    for image in images:
+        try:
+            results.extend(predictor.predict_classification_batch([image], model_id=model_id, logger=quiet_logger))
+        except Exception as e:
+            results.append(f"{type(e).__name__}: {str(e)}")
+    return results
+
+
+def count_cells(predictor, images, conf, batch_size):
+    """
+    Count cells in sub-batches of the YOLO batch size (no annotated images)
+    Returns:
+        list with a result dict or an error message per image
+    """
+    results = []
+    for start in range(0, len(images), batch_size):
+        chunk = images[start:start + batch_size]
+        try:
+            results.extend(predictor.predict_detection_batch(
+                chunk, [conf] * len(chunk), [False] * len(chunk),
+                task='count', loggers=[quiet_logger] * len(chunk), annotate=False
+            ))
+        except Exception as e:
+            if len(chunk) == 1:
+                results.append(f"{type(e).__name__}: {str(e)}")
+                continue
+            results.extend(count_cells(predictor, chunk, conf, 1))
+    return results
+
+
+def score_batch(predictor, batch, args):
+    """
+    Score one batch of decoded images
+    Args:
+        batch: List of (path, image, decode error) tuples
+    Returns:
+        list of output rows (dicts), one per input in order
+    """
+    rows = []
+    images = []
+    for path, image, error in batch:
+        row = {'path': path, 'status': 'ok', 'error': None}
+        if error is not None:
+            row.update(status='error', error=error)
+        else:
+            row['width'], row['height'] = image.size
+            images.append((row, image))
+        rows.append(row)
+
+    decoded = [image for _, image in images]
+    outputs = {}
+    if decoded and 'classification' in args.tasks:
+        outputs['classification'] = classify(predictor, decoded, args.model_id)
+    if decoded and 'count' in args.tasks:
+        outputs['count'] = count_cells(predictor, decoded, args.conf, args.detection_batch_size)
+
+    classes = predictor.model_loader.classification_classes
+    for i, (row, _) in enumerate(images):
+        errors = []
+        result = outputs.get('classification', [None] * len(images))[i]
+        if isinstance(result, dict):
+            row['predicted_class'] = result['predicted_class']
+            row['confidence'] = round(result['confidence'], 6)
+            for name in classes:
+                row[f"prob_{name}"] = round(result['probabilities'][name], 6)
+        elif result is not None:
+            errors.append(f"classification: {result}")
+
+        result = outputs.get('count', [None] * len(images))[i]
+        if isinstance(result, dict):
+            for name, value in result['counts'].items():
+                row[f"count_{name}"] = value
+            row['total_cells'] = result['total_cells']
+            if args.save_boxes:
+                row['boxes'] = json.dumps([
+                    [d['class'], round(d['confidence'], 4)] + [round(v, 1) for v in d['bbox']]
+                    for d in result['detections']
+                ])
+        elif result is not None:
+            errors.append(f"count: {result}")
+
+        if errors:
+            row.update(status='error', error='; '.join(errors))
+    return rows
+
+
+# ==================== OUTPUT ====================
+
+def column_type(pa, name):
+    if name in ('width', 'height', 'total_cells') or name.startswith('count_'):
+        return pa.int64()
+    if name == 'confidence' or name.startswith('prob_'):
+        return pa.float64()
+    return pa.string()
+
+
+class ChunkWriter:
+    """Append result chunks to a CSV file or a directory of Parquet parts"""
+
+    def __init__(self, output, fmt, columns):
+        """
+        Args:
+            output: CSV file path, or directory for the Parquet parts
+            fmt: 'csv' or 'parquet'
+            columns: Ordered column names
+        """
+        self.output = output
+        self.fmt = fmt
+        self.columns = columns
+        if fmt == 'parquet':
+            if importlib.util.find_spec('pyarrow') is None:
+                print("✗ Parquet output needs pyarrow (pip install pyarrow), or use a .csv output")
+                sys.exit(2)
+
+    def reset(self, checkpoint):
+        """Drop anything written after the checkpoint (e.g. a chunk cut short by a crash)"""
+        if self.fmt == 'csv':
+            if checkpoint["csv_bytes"] == 0:
+                with open(self.output, 'w', encoding='utf-8', newline='') as f:
+                    csv.DictWriter(f, fieldnames=self.columns).writeheader()
+                checkpoint["csv_bytes"] = os.path.getsize(self.output)
+            else:
+                with open(self.output, 'r+b') as f:
+                    f.truncate(checkpoint["csv_bytes"])
+        else:
+            os.makedirs(self.output, exist_ok=True)
+            for name in os.listdir(self.output):
+                if name.startswith('part-') and int(name[5:10]) >= checkpoint["chunks"]:
+                    os.remove(os.path.join(self.output, name))
+
+    def write(self, rows, checkpoint):
+        """Write one chunk and advance the checkpoint's output position"""
+        if self.fmt == 'csv':
+            with open(self.output, 'a', encoding='utf-8', newline='') as f:
+                csv.DictWriter(f, fieldnames=self.columns).writerows(rows)
+                f.flush()
+                os.fsync(f.fileno())
+            checkpoint["csv_bytes"] = os.path.getsize(self.output)
+        else:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # Explicit schema so chunks without errors/boxes still match the others
+            schema = pa.schema([(c, column_type(pa, c)) for c in self.columns])
+            table = pa.Table.from_pylist([{c: row.get(c) for c in self.columns} for row in rows], schema=schema)
+            path = os.path.join(self.output, f"part-{checkpoint['chunks']:05d}.parquet")
+            pq.write_table(table, path + '.tmp')
+            os.replace(path + '.tmp', path)
+        checkpoint["chunks"] += 1
+
+
+def checkpoint_path(output):
+    return output.rstrip('/\\') + '.checkpoint.json'
+
+
+def load_checkpoint(path, settings, restart):
+    """
+    Read the checkpoint for this output, or start a new one
+    Returns:
+        checkpoint dict
+    """
+    if os.path.exists(path) and not restart:
+        with open(path, 'r', encoding='utf-8') as f:
+            checkpoint = json.load(f)
+        if checkpoint.get("version") != CHECKPOINT_VERSION or checkpoint.get("settings") != settings:
+            print(f"✗ {path} belongs to a run with different inputs or settings - use --restart to start over")
+            sys.exit(2)
+        return checkpoint
+    return {
+        "version": CHECKPOINT_VERSION,
+        "settings": settings,
+        "done": 0,
+        "failed": 0,
+        "chunks": 0,
+        "csv_bytes": 0,
+        "started_at": datetime.now().isoformat(timespec='seconds'),
+        "updated_at": None,
+        "finished": False
+    }
+
+
+def save_checkpoint(path, checkpoint):
+    # Write-then-rename so a crash never leaves a half-written checkpoint
+    checkpoint["updated_at"] = datetime.now().isoformat(timespec='seconds')
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(checkpoint, f, indent=2)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(path + '.tmp', path)
+
+
+# ==================== RUN ====================
+
+def load_models(args):
+    """Load only the models the requested tasks need"""
+    if args.standin:
+        from standins import StandInModelLoader
+        loader = StandInModelLoader(models_dir=args.models_dir)
+        loader.load_all_models()
+        return loader
+
+    from model_loader import ModelLoader
+    loader = ModelLoader(models_dir=args.models_dir)
+    if 'classification' in args.tasks:
+        loader.load_classification_model(args.model_id)
+    if 'count' in args.tasks:
+        loader.load_detection_count_model()
+    return loader
+
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m" if hours else f"{minutes}m{seconds:02d}s"
+
+
+def run(args):
+    paths = list_images(args.input, args.manifest)
+    if not paths:
+        print("✗ No images found")
+        return 1
+    print(f"✓ Found {len(paths)} image(s)")
+
+    settings = {
+        "inputs": fingerprint(paths),
+        "images": len(paths),
+        "tasks": args.tasks,
+        "model_id": args.model_id if 'classification' in args.tasks else None,
+        "conf": args.conf if 'count' in args.tasks else None,
+        "format": args.format,
+        "save_boxes": args.save_boxes
+    }
+    ckpt_path = checkpoint_path(args.output)
+    checkpoint = load_checkpoint(ckpt_path, settings, args.restart)
+    if checkpoint["finished"]:
+        print(f"✓ Already complete ({checkpoint['done']} images) - use --restart to score again")
+        return 0
+    if checkpoint["done"]:
+        print(f"Resuming after {checkpoint['done']}/{len(paths)} image(s)")
+
+    loader = load_models(args)
+    if 'count' in args.tasks:
+        # Static-shape exports accept one image per forward pass
+        limit = loader.detection_batch_limit('count')
+        if limit and args.detection_batch_size > limit:
+            print(f"⚠ Count model is a static-shape export, --detection-batch-size {args.detection_batch_size} -> {limit}")
+            args.detection_batch_size = limit
+    predictor = BloodCellPredictor(loader)
+    writer = ChunkWriter(args.output, args.format, output_columns(loader, args.tasks, args.save_boxes))
+    writer.reset(checkpoint)
+    save_checkpoint(ckpt_path, checkpoint)
+
+    todo = paths[checkpoint["done"]:]
+    reader = read_images(todo, build_decoder(), args.readers, args.prefetch or args.batch_size * 4)
+    started = time.perf_counter()
+    scored = 0
+    chunk = []
+    try:
+        while True:
+            batch = list(itertools.islice(reader, args.batch_size))
+            if batch:
+                chunk.extend(score_batch(predictor, batch, args))
+            if chunk and (len(chunk) >= args.chunk_size or not batch):
+                writer.write(chunk, checkpoint)
+                checkpoint["done"] += len(chunk)
+                checkpoint["failed"] += sum(1 for row in chunk if row['status'] != 'ok')
+                save_checkpoint(ckpt_path, checkpoint)
+                scored += len(chunk)
+                chunk = []
+
+                elapsed = time.perf_counter() - started
+                rate = scored / elapsed if elapsed else 0.0
+                eta = (len(paths) - checkpoint["done"]) / rate if rate else 0.0
+                print(f"✓ {checkpoint['done']}/{len(paths)} images ({rate:.1f} img/s, "
+                      f"{checkpoint['failed']} failed, ETA {format_duration(eta)})")
+            if not batch:
+                break
+    except KeyboardInterrupt:
+        print(f"\n⚠ Interrupted - {checkpoint['done']}/{len(paths)} images saved, run again to resume")
+        return 130
+
+    checkpoint["finished"] = True
+    save_checkpoint(ckpt_path, checkpoint)
+    print(f"✓ Scored {len(paths)} image(s) ({checkpoint['failed']} failed) -> {args.output}")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Score a directory or manifest of blood smear images offline")
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument("--input", default=None, help="Directory of images (searched recursively)")
+    source.add_argument("--manifest", default=None, help="Text file of image paths, or CSV with a 'path' column")
+    parser.add_argument("--output", required=True, help="Output .csv file or .parquet directory")
+    parser.add_argument("--format", choices=["csv", "parquet"], default=None,
+                        help="Output format (default: from the output extension)")
+    parser.add_argument("--tasks", default="classification,count", help="Comma-separated: classification, count")
+    parser.add_argument("--model-id", default="mobilenet-v2", help="Classification model")
+    parser.add_argument("--conf", type=float, default=0.25, help="Counting confidence threshold")
+    parser.add_argument("--batch-size", type=int, default=32, help="Images per classification batch")
+    parser.add_argument("--detection-batch-size", type=int, default=8, help="Images per YOLO forward pass")
+    parser.add_argument("--readers", type=int, default=min(os.cpu_count() or 1, 8), help="Image decode threads")
+    parser.add_argument("--prefetch", type=int, default=None, help="Decoded images held ahead (default 4 batches)")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="Rows per output chunk and checkpoint")
+    parser.add_argument("--save-boxes", action="store_true", help="Add a JSON column with the counted boxes")
+    parser.add_argument("--restart", action="store_true", help="Ignore the checkpoint and start over")
+    parser.add_argument("--standin", action="store_true", help="Use stand-in models (no weights needed)")
+    parser.add_argument("--models-dir", default="models", help="Directory containing the model files")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.tasks = [t.strip() for t in args.tasks.split(',') if t.strip()]
+    for task in args.tasks:
+        if task not in TASKS:
+            print(f"✗ Unknown task: {task}. Available: {TASKS}")
+            sys.exit(2)
+    args.format = args.format or ('parquet' if args.output.rstrip('/\\').endswith('.parquet') else 'csv')
+    args.batch_size = max(args.batch_size, 1)
+    args.detection_batch_size = max(args.detection_batch_size, 1)
+    sys.exit(run(args))
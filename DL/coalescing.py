@@ -0,0 +1,102 @@
+"""
+Coalescing - Single-flight deduplication of identical concurrent predictions
+Requests with the same image bytes and parameters share one running
+computation instead of each running inference.
+"""
+import asyncio
+import hashlib
+
+
+def request_key(task, image_bytes, **params):
+    """
+    Build the coalescing key for a prediction
+    Args:
+        task: 'classification', 'detection' or 'count'
+        image_bytes: Raw uploaded image bytes
+        params: Parameters that change the result (model_id, conf, show_labels)
+    Returns:
+        Hashable key
+    """
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    return (task, digest, tuple(sorted(params.items())))
+
+
+class SingleFlight:
+    """Share one in-flight computation between concurrent identical requests"""
+
+    def __init__(self, enabled=True):
+        """
+        Args:
+            enabled: When False every request runs its own computation
+        """
+        self.enabled = enabled
+        self._in_flight = {}
+        self._waiters = {}  # Task -> callers still awaiting it
+        self._computations = 0
+        self._coalesced = 0
+
+    async def run(self, key, fn):
+        """
+        Run fn() unless an identical computation is already in flight
+        The computation runs as its own task, so one caller disconnecting
+        does not cancel it for the others; it is cancelled (which cancels
+        its queued pool or batcher work) once every caller has gone.
+        Args:
+            key: Coalescing key (see request_key)
+            fn: Zero-argument callable returning an awaitable
+        Returns:
+            tuple: (result, coalesced) - dict results are copied per caller
+        """
+        if not self.enabled:
+            self._computations += 1
+            return await fn(), False
+
+        task = self._in_flight.get(key)
+        coalesced = task is not None
+        if coalesced:
+            self._coalesced += 1
+        else:
+            self._computations += 1
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda t: self._finished(key, t))
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            result = await asyncio.shield(task)
+        finally:
+            self._leave(key, task)
+        # Callers add their own fields (log_file, profile) to the result
+        return (dict(result) if isinstance(result, dict) else result), coalesced
+
+    def _leave(self, key, task):
+        self._waiters[task] -= 1
+        if self._waiters[task]:
+            return
+        del self._waiters[task]
+        if not task.done():
+            # The last caller was cancelled (deadline or disconnect): nobody wants the result
+            task.cancel()
+            if self._in_flight.get(key) is task:
+                del self._in_flight[key]
+
+    def _finished(self, key, task):
+        if self._in_flight.get(key) is task:
+            del self._in_flight[key]
+        if not task.cancelled():
+            task.exception()  # Mark retrieved even if every caller went away
+
+    def stats(self):
+        """
+        Coalescing counters
+        Returns:
+            dict with computations run and duplicates avoided
+        """
+        total = self._computations + self._coalesced
+        return {
+            "enabled": self.enabled,
+            "in_flight": len(self._in_flight),
+            "computations": self._computations,
+            "coalesced": self._coalesced,
+            "coalesced_ratio": round(self._coalesced / total, 4) if total else 0.0
+        }
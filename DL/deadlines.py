@@ -0,0 +1,145 @@
+"""
+Deadlines - Per-request deadlines, priority class and client-disconnect cancellation
+A RequestContext is passed wherever a StageTimer goes; every stage entry
+checks it, so abandoned requests stop between pipeline stages.
+"""
+import time
+import asyncio
+import threading
+
+from profiler import StageTimer
+from executors import PRIORITY_CLASSES, INTERACTIVE
+
+
+class RequestAborted(Exception):
+    """Base class for requests abandoned before completion"""
+    status_code = 500
+
+
+class DeadlineExceeded(RequestAborted):
+    """The request's deadline passed"""
+    status_code = 504
+
+
+class ClientDisconnected(RequestAborted):
+    """The client went away"""
+    status_code = 499  # Client Closed Request (nginx convention)
+
+
+class RequestContext(StageTimer):
+    """Stage timer that also enforces a deadline and a cancellation flag"""
+
+    def __init__(self, deadline_ms=None, poll_interval=0.1, priority=INTERACTIVE):
+        """
+        Args:
+            deadline_ms: Time budget in milliseconds from now (None = no deadline)
+            poll_interval: Seconds between client-disconnect checks
+            priority: Scheduling class, 'interactive' or 'bulk'
+        """
+        super().__init__()
+        self.deadline = None
+        self.poll_interval = poll_interval
+        self.priority = INTERACTIVE
+        self._cancelled = threading.Event()
+        self._reason = None
+        self._watcher = None
+        self.set_deadline(deadline_ms)
+        self.set_priority(priority)
+
+    def set_deadline(self, deadline_ms):
+        """Set the time budget, measured from when the request was received"""
+        if deadline_ms is not None and deadline_ms > 0:
+            self.deadline = self.started + deadline_ms / 1000.0
+
+    def set_priority(self, priority):
+        """Set the scheduling class (None keeps the current one)"""
+        if priority is None:
+            return
+        priority = priority.strip().lower()
+        if priority not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority: {priority}. Use one of {list(PRIORITY_CLASSES)}")
+        self.priority = priority
+
+    def remaining(self):
+        """Seconds left before the deadline (None without a deadline)"""
+        if self.deadline is None:
+            return None
+        return max(self.deadline - time.perf_counter(), 0.0)
+
+    def remaining_ms(self):
+        remaining = self.remaining()
+        return None if remaining is None else remaining * 1000
+
+    def cancel(self, reason="Client disconnected"):
+        if not self._cancelled.is_set():
+            self._reason = reason
+            self._cancelled.set()
+
+    @property
+    def aborted(self):
+        """ClientDisconnected/DeadlineExceeded class if the request is dead, else None"""
+        if self._cancelled.is_set():
+            return ClientDisconnected
+        if self.deadline is not None and time.perf_counter() >= self.deadline:
+            return DeadlineExceeded
+        return None
+
+    def check(self):
+        """Raise if the request was cancelled or its deadline passed"""
+        aborted = self.aborted
+        if aborted is ClientDisconnected:
+            raise ClientDisconnected(self._reason)
+        if aborted is DeadlineExceeded:
+            budget = (self.deadline - self.started) * 1000
+            raise DeadlineExceeded(f"Deadline of {budget:.0f}ms exceeded")
+
+    def stage(self, name):
+        self.check()
+        return super().stage(name)
+
+    # ==================== EVENT LOOP SIDE ====================
+
+    def watch(self, request):
+        """Start polling the ASGI connection for a client disconnect"""
+        self._watcher = asyncio.ensure_future(self._watch(request))
+
+    async def _watch(self, request):
+        while not self._cancelled.is_set():
+            if await request.is_disconnected():
+                self.cancel()
+                return
+            await asyncio.sleep(self.poll_interval)
+
+    def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            self._watcher = None
+
+    async def run(self, awaitable):
+        """
+        Await work, abandoning it when the deadline passes or the client goes away
+        Cancelling the work drops it from the inference queue if it has not started.
+        Returns:
+            The awaitable's result
+        """
+        self.check()
+        task = asyncio.ensure_future(awaitable)
+        waiters = {task}
+        if self._watcher is not None:
+            waiters.add(self._watcher)
+
+        try:
+            while True:
+                done, _ = await asyncio.wait(waiters, timeout=self.remaining(),
+                                             return_when=asyncio.FIRST_COMPLETED)
+                if task in done:
+                    return task.result()
+                if self.aborted:
+                    break
+                waiters.discard(self._watcher)  # Watcher stopped without a disconnect
+        except asyncio.CancelledError:
+            task.cancel()
+            raise
+
+        task.cancel()
+        self.check()
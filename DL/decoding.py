@@ -0,0 +1,317 @@
+"""
+Decoding - Uploaded image decoding on a dedicated thread pool
+JPEG and 8-bit PNG uploads can be decoded with OpenCV or libjpeg-turbo
+(PyTurboJPEG) instead of PIL. A backend is only used after it decodes a set
+of reference images to exactly the same RGB pixels as
+Image.open(...).convert('RGB'); anything else (other formats, CMYK JPEGs,
+16-bit PNGs, backend failures) is decoded by PIL.
+"""
+import io
+import os
+import time
+import asyncio
+import threading
+import importlib.util
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+from PIL import Image
+
+from profiler import NULL_TIMER
+
+
+BACKENDS = ['pil', 'opencv', 'turbojpeg']
+
+# Fast backends tried by 'auto', fastest first
+AUTO_ORDER = {
+    'jpeg': ['turbojpeg', 'opencv'],
+    'png': ['opencv']
+}
+
+# Formats each backend can decode
+BACKEND_FORMATS = {
+    'opencv': ('jpeg', 'png'),
+    'turbojpeg': ('jpeg',)
+}
+
+
+def sniff_format(data):
+    """
+    Identify uploads a fast backend decodes exactly like PIL
+    Returns:
+        'jpeg', 'png', or None (decode with PIL)
+    """
+    if data[:3] == b'\xff\xd8\xff':
+        # CMYK/YCCK JPEGs convert differently across decoders
+        return 'jpeg' if jpeg_components(data) in (1, 3) else None
+    if data[:8] == b'\x89PNG\r\n\x1a\n' and len(data) > 24:
+        # IHDR bit depth; 16-bit PNGs are reduced to 8 bits differently
+        return 'png' if data[24] == 8 else None
+    return None
+
+
+def jpeg_components(data):
+    """Number of color components from the JPEG frame header (None if not found)"""
+    i = 2
+    while i + 4 <= len(data):
+        if data[i] != 0xFF:
+            return None
+        marker = data[i + 1]
+        if marker == 0xFF:
+            i += 1  # Fill byte
+            continue
+        length = int.from_bytes(data[i + 2:i + 4], 'big')
+        # SOF0-SOF15, except DHT (C4), JPG (C8) and DAC (CC)
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            return data[i + 9] if i + 9 < len(data) else None
+        i += 2 + length
+    return None
+
+
+# ==================== BACKENDS ====================
+
+def decode_pil(data):
+    return Image.open(io.BytesIO(data)).convert('RGB')
+
+
+def decode_pil_draft(data, size):
+    """PIL decode at a reduced DCT scale, keeping both sides >= size"""
+    image = Image.open(io.BytesIO(data))
+    image.draft('RGB', (size, size))
+    return image.convert('RGB')
+
+
+class OpenCVBackend:
+    def __init__(self):
+        import cv2
+        self.cv2 = cv2
+        # PIL does not apply EXIF orientation, so OpenCV must not either
+        self.flags = cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION
+
+    def __call__(self, data):
+        image = self.cv2.imdecode(np.frombuffer(data, dtype=np.uint8), self.flags)
+        if image is None:
+            raise ValueError("OpenCV could not decode the image")
+        return Image.fromarray(self.cv2.cvtColor(image, self.cv2.COLOR_BGR2RGB))
+
+
+class TurboJPEGBackend:
+    def __init__(self):
+        from turbojpeg import TurboJPEG, TJPF_RGB
+        self.jpeg = TurboJPEG()
+        self.pixel_format = TJPF_RGB
+
+    def __call__(self, data):
+        return Image.fromarray(self.jpeg.decode(data, pixel_format=self.pixel_format))
+
+
+def create_backend(name):
+    """
+    Instantiate a fast backend
+    Returns:
+        Callable bytes -> RGB PIL Image, or None if its package is not installed
+    """
+    module = {'opencv': 'cv2', 'turbojpeg': 'turbojpeg'}[name]
+    if importlib.util.find_spec(module) is None:
+        return None
+    try:
+        return OpenCVBackend() if name == 'opencv' else TurboJPEGBackend()
+    except Exception as e:
+        # e.g. PyTurboJPEG installed without the libjpeg-turbo shared library
+        print(f"⚠ {name} decoder unavailable: {str(e)}")
+        return None
+
+
+def reference_images():
+    """
+    Encoded samples used to check a backend against PIL
+    Returns:
+        dict mapping format to a list of encoded images
+    """
+    rng = np.random.default_rng(0)
+    # Odd sizes exercise the chroma upsampling at the image edges
+    smooth = rng.integers(0, 256, (9, 13, 3), dtype=np.uint8)
+    image = Image.fromarray(smooth).resize((67, 45), Image.BILINEAR)
+    noisy = Image.fromarray(rng.integers(0, 256, (31, 17, 3), dtype=np.uint8))
+
+    samples = {'jpeg': [], 'png': []}
+    for sample in (image, noisy):
+        for subsampling in (0, 1, 2):  # 4:4:4, 4:2:2, 4:2:0
+            buffer = io.BytesIO()
+            sample.save(buffer, format='JPEG', quality=90, subsampling=subsampling)
+            samples['jpeg'].append(buffer.getvalue())
+        for mode in ('RGB', 'L', 'RGBA', 'P'):
+            buffer = io.BytesIO()
+            sample.convert(mode).save(buffer, format='PNG')
+            samples['png'].append(buffer.getvalue())
+    buffer = io.BytesIO()
+    image.convert('L').save(buffer, format='JPEG', quality=90)
+    samples['jpeg'].append(buffer.getvalue())
+    buffer = io.BytesIO()
+    image.save(buffer, format='JPEG', quality=90, progressive=True)
+    samples['jpeg'].append(buffer.getvalue())
+    return samples
+
+
+def matches_pil(backend, samples):
+    """True if the backend decodes every sample to exactly PIL's pixels"""
+    try:
+        return all(np.array_equal(np.asarray(backend(data)), np.asarray(decode_pil(data))) for data in samples)
+    except Exception:
+        return False
+
+
+# ==================== DECODER ====================
+
+class ImageDecoder:
+    """Decode uploads to RGB PIL Images with the fastest backend that matches PIL"""
+
+    def __init__(self, backend='auto', workers=2, draft=False):
+        """
+        Args:
+            backend: 'auto', 'pil', 'opencv' or 'turbojpeg'
+            workers: Decode threads (decoders release the GIL)
+            draft: Allow reduced-size JPEG decoding when the caller only needs a small
+                image (e.g. 224x224 classification); not pixel-equivalent, off by default
+        """
+        if backend != 'auto' and backend not in BACKENDS:
+            raise ValueError(f"Unknown decoder backend: {backend}. Available: {['auto'] + BACKENDS}")
+        self.backend = backend
+        self.workers = max(int(workers), 1)
+        self.draft = draft
+        self.routes = self._select_routes(backend)
+        self._pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="decode")
+
+        self._lock = threading.Lock()
+        self._decoded = {}
+        self._fallbacks = 0
+        self._failed = 0
+        self._decode_seconds = 0.0
+        self._max_decode_seconds = 0.0
+
+    def _select_routes(self, backend):
+        # format -> (backend name, callable); formats not listed use PIL
+        if backend == 'pil':
+            return {}
+        candidates = {fmt: AUTO_ORDER[fmt] for fmt in AUTO_ORDER} if backend == 'auto' else \
+            {fmt: [backend] for fmt in BACKEND_FORMATS[backend]}
+
+        samples = reference_images()
+        instances = {}
+        routes = {}
+        for fmt, names in candidates.items():
+            for name in names:
+                if name not in instances:
+                    instances[name] = create_backend(name)
+                decode = instances[name]
+                if decode is None:
+                    continue
+                if matches_pil(decode, samples[fmt]):
+                    routes[fmt] = (name, decode)
+                    break
+                print(f"⚠ {name} does not decode {fmt.upper()} exactly like PIL here, not using it")
+        if backend != 'auto' and not routes:
+            print(f"⚠ Decoder backend '{backend}' unavailable, using PIL")
+        return routes
+
+    def decode(self, data, draft_size=None, timer=None):
+        """
+        Decode image bytes in the calling thread
+        Args:
+            data: Encoded image bytes
+            draft_size: Smallest side the caller needs (used only when draft decoding is enabled)
+            timer: Optional StageTimer, receives the 'decode' time
+        Returns:
+            RGB PIL Image
+        """
+        timer = timer or NULL_TIMER
+        start = time.perf_counter()
+        fmt = sniff_format(data)
+        name = 'pil'
+        try:
+            if draft_size and self.draft and fmt == 'jpeg':
+                name = 'pil-draft'
+                image = decode_pil_draft(data, draft_size)
+            elif fmt in self.routes:
+                name, decode = self.routes[fmt]
+                try:
+                    image = decode(data)
+                except Exception:
+                    # Let PIL decode it (or raise its usual error for broken uploads)
+                    with self._lock:
+                        self._fallbacks += 1
+                    name = 'pil'
+                    image = decode_pil(data)
+            else:
+                image = decode_pil(data)
+        except Exception:
+            with self._lock:
+                self._failed += 1
+            raise
+
+        elapsed = time.perf_counter() - start
+        timer.add("decode", elapsed * 1000)
+        with self._lock:
+            key = f"{name}/{fmt or 'other'}"
+            self._decoded[key] = self._decoded.get(key, 0) + 1
+            self._decode_seconds += elapsed
+            self._max_decode_seconds = max(self._max_decode_seconds, elapsed)
+        return image
+
+    async def decode_async(self, data, draft_size=None, timer=None):
+        """
+        Decode image bytes on the decode pool without blocking the event loop
+        Returns:
+            RGB PIL Image
+        """
+        timer = timer or NULL_TIMER
+        timer.check()
+        enqueued = time.perf_counter()
+
+        def run():
+            timer.add("decode_queue", (time.perf_counter() - enqueued) * 1000)
+            return self.decode(data, draft_size=draft_size, timer=timer)
+
+        return await asyncio.get_running_loop().run_in_executor(self._pool, run)
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False)
+
+    def stats(self):
+        """
+        Backend selection and decode timings
+        Returns:
+            dict with the backend per format and counters
+        """
+        with self._lock:
+            decoded = sum(self._decoded.values())
+            return {
+                "backend": self.backend,
+                "routes": {fmt: self.routes[fmt][0] if fmt in self.routes else 'pil' for fmt in AUTO_ORDER},
+                "workers": self.workers,
+                "draft": self.draft,
+                "decoded": dict(self._decoded),
+                "fallbacks": self._fallbacks,
+                "failed": self._failed,
+                "mean_decode_ms": round(self._decode_seconds / decoded * 1000, 3) if decoded else 0.0,
+                "max_decode_ms": round(self._max_decode_seconds * 1000, 3)
+            }
+
+
+def build_decoder():
+    """
+    Create the decoder from environment variables
+    DL_DECODER: 'auto' (default), 'pil', 'opencv' or 'turbojpeg'
+    DL_DECODE_WORKERS: decode threads (default 2)
+    DL_DECODE_DRAFT: 1 enables reduced-size JPEG decoding for classification uploads
+    Returns:
+        ImageDecoder
+    """
+    decoder = ImageDecoder(
+        backend=os.environ.get('DL_DECODER', 'auto').lower(),
+        workers=int(os.environ.get('DL_DECODE_WORKERS', '2')),
+        draft=os.environ.get('DL_DECODE_DRAFT', '0') == '1'
+    )
+    routes = decoder.stats()["routes"]
+    print(f"✓ Image decoder: JPEG={routes['jpeg']}, PNG={routes['png']}, {decoder.workers} thread(s)")
+    return decoder
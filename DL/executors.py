@@ -0,0 +1,407 @@
+"""
+Executors - Framework-isolated inference worker pools
+Classification (TensorFlow) and detection (PyTorch/Ultralytics) run in
+separate pools with explicit thread budgets and optional CPU affinity so
+the two frameworks don't oversubscribe the cores under mixed load.
+"""
+import os
+import sys
+import time
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future
+
+
+def parse_cpu_list(value):
+    """
+    Parse a CPU list such as '0-3,6'
+    Returns:
+        set of CPU ids, or None when value is empty
+    """
+    if not value:
+        return None
+    cpus = set()
+    for part in value.split(','):
+        part = part.strip()
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def available_cpus():
+    """CPUs this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return sorted(os.sched_getaffinity(0))
+    return list(range(os.cpu_count() or 1))
+
+
+# Priority classes, highest first
+PRIORITY_CLASSES = ('interactive', 'bulk')
+INTERACTIVE = 'interactive'
+
+# Recent queue waits kept per class for the percentile metrics
+WAIT_SAMPLES = 1024
+
+
+def parse_class_map(value, cast=float):
+    """
+    Parse a per-class setting such as 'interactive:8,bulk:1'
+    Returns:
+        dict mapping priority class to value
+    """
+    result = {}
+    for part in (value or '').split(','):
+        if ':' not in part:
+            continue
+        name, number = part.split(':', 1)
+        name = name.strip()
+        if name not in PRIORITY_CLASSES:
+            raise ValueError(f"Unknown priority class: {name}. Available: {list(PRIORITY_CLASSES)}")
+        result[name] = cast(number)
+    return result
+
+
+def percentile(values, q):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+class InferencePool:
+    """Fixed set of worker threads running one framework's inference calls"""
+
+    def __init__(self, name, framework, workers=1, threads=1, cpus=None, weights=None, caps=None):
+        """
+        Args:
+            name: Pool name ('classification' or 'detection')
+            framework: Framework served by this pool ('tensorflow' or 'torch')
+            workers: Number of concurrent inference calls
+            threads: Intra-op thread budget for this pool's framework
+            cpus: Optional set of CPU ids to pin the pool's threads to
+            weights: Scheduling weight per priority class (default interactive 8, bulk 1)
+            caps: Max concurrent calls per priority class. By default bulk may use
+                workers - 1, leaving one worker free for interactive calls. A
+                single-worker pool gets a bulk cap of 0: bulk calls then only start
+                while no interactive call is queued or running. Calls are not
+                preempted, so one that started still delays an interactive call
+                arriving behind it; give such pools 2 workers to serve bulk traffic.
+                A bulk cap of 0 gives any pool that behaviour; interactive must be >= 1
+        """
+        self.name = name
+        self.framework = framework
+        self.workers = max(int(workers), 1)
+        self.threads = max(int(threads), 1)
+        self.cpus = cpus
+        self.weights = {'interactive': 8.0, 'bulk': 1.0}
+        self.weights.update({cls: max(float(weight), 0.01) for cls, weight in (weights or {}).items()})
+        self.caps = {'interactive': self.workers, 'bulk': self.workers - 1}
+        for cls, cap in (caps or {}).items():
+            # 0 means "only while interactive work is idle", which interactive itself can never be
+            minimum = 1 if cls == INTERACTIVE else 0
+            if int(cap) < minimum:
+                raise ValueError(f"Priority cap for '{cls}' in the {name} pool must be at least {minimum}, got {cap}")
+            self.caps[cls] = int(cap)
+
+        # One queue per class, served by stride scheduling: each class advances
+        # its virtual time by 1/weight per dispatch, the smallest time goes next
+        self._queues = {cls: deque() for cls in PRIORITY_CLASSES}
+        self._pass = {cls: 0.0 for cls in PRIORITY_CLASSES}
+        self._virtual_time = 0.0
+        self._running = {cls: 0 for cls in PRIORITY_CLASSES}
+        self._stopping = False
+
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._started = time.perf_counter()
+        self._in_flight = 0
+        self._completed = 0
+        self._failed = 0
+        self._dropped = 0
+        self._busy_seconds = 0.0
+        self._wait_seconds = 0.0
+        self._class_stats = {
+            cls: {"started": 0, "completed": 0, "dropped": 0, "wait_seconds": 0.0,
+                  "waits": deque(maxlen=WAIT_SAMPLES)}
+            for cls in PRIORITY_CLASSES
+        }
+
+        self._threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._worker, name=f"{name}-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def _pin_current_thread(self):
+        # On Linux pid 0 targets the calling thread; framework threads
+        # created from here (Eigen/OpenMP pools) inherit the mask
+        if self.cpus and hasattr(os, 'sched_setaffinity'):
+            try:
+                os.sched_setaffinity(0, self.cpus)
+            except OSError as e:
+                print(f"⚠ Could not pin {self.name} pool to CPUs {sorted(self.cpus)}: {str(e)}")
+
+    def _next_item(self):
+        # Called with the lock held
+        while not self._stopping:
+            # A class capped at 0 (bulk on a single worker) only runs while interactive work is idle
+            idle = not self._queues[INTERACTIVE] and not self._running[INTERACTIVE]
+            eligible = [cls for cls in PRIORITY_CLASSES
+                        if self._queues[cls] and self._running[cls] < (self.caps[cls] or int(idle))]
+            if eligible:
+                cls = min(eligible, key=lambda c: self._pass[c])
+                self._virtual_time = self._pass[cls]
+                self._pass[cls] += 1.0 / self.weights[cls]
+                self._running[cls] += 1
+                return cls, self._queues[cls].popleft()
+            self._cond.wait()
+        return None
+
+    def _worker(self):
+        self._pin_current_thread()
+        while True:
+            with self._cond:
+                next_item = self._next_item()
+            if next_item is None:
+                break
+            cls, (future, fn, args, kwargs, enqueued) = next_item
+            stats = self._class_stats[cls]
+
+            if not future.set_running_or_notify_cancel():
+                # Caller went away (disconnect/deadline) while this was queued
+                with self._cond:
+                    self._dropped += 1
+                    stats["dropped"] += 1
+                    self._running[cls] -= 1
+                    self._cond.notify()
+                continue
+
+            started = time.perf_counter()
+            with self._lock:
+                self._in_flight += 1
+                self._wait_seconds += started - enqueued
+                stats["started"] += 1
+                stats["wait_seconds"] += started - enqueued
+                stats["waits"].append(started - enqueued)
+            try:
+                result = fn(*args, **kwargs)
+            except BaseException as e:
+                with self._lock:
+                    self._failed += 1
+                future.set_exception(e)
+            else:
+                with self._lock:
+                    self._completed += 1
+                    stats["completed"] += 1
+                future.set_result(result)
+            finally:
+                with self._cond:
+                    self._in_flight -= 1
+                    self._running[cls] -= 1
+                    self._busy_seconds += time.perf_counter() - started
+                    self._cond.notify()
+
+    def submit(self, fn, *args, **kwargs):
+        """
+        Queue an interactive call on this pool
+        Returns:
+            concurrent.futures.Future with the call's result
+        """
+        return self.submit_as(INTERACTIVE, fn, *args, **kwargs)
+
+    def submit_as(self, priority, fn, *args, **kwargs):
+        """
+        Queue a call in the given priority class
+        Args:
+            priority: 'interactive' or 'bulk'
+        Returns:
+            concurrent.futures.Future with the call's result
+        """
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority class: {priority}. Available: {list(PRIORITY_CLASSES)}")
+        future = Future()
+        with self._cond:
+            if not self._queues[priority] and not self._running[priority]:
+                # An idle class must not bank credit while it was away
+                self._pass[priority] = max(self._pass[priority], self._virtual_time)
+            self._queues[priority].append((future, fn, args, kwargs, time.perf_counter()))
+            self._cond.notify()
+        return future
+
+    async def run(self, fn, *args, **kwargs):
+        """Await an interactive call on this pool from the event loop"""
+        return await asyncio.wrap_future(self.submit(fn, *args, **kwargs))
+
+    async def run_as(self, priority, fn, *args, **kwargs):
+        """Await a call in the given priority class from the event loop"""
+        return await asyncio.wrap_future(self.submit_as(priority, fn, *args, **kwargs))
+
+    def shutdown(self):
+        with self._cond:
+            self._stopping = True
+            self._cond.notify_all()
+
+    def stats(self):
+        """
+        Resource split and utilization of this pool
+        Returns:
+            dict with configuration and counters
+        """
+        with self._lock:
+            elapsed = time.perf_counter() - self._started
+            finished = self._completed + self._failed
+            classes = {}
+            for cls in PRIORITY_CLASSES:
+                stats = self._class_stats[cls]
+                waits = list(stats["waits"])
+                classes[cls] = {
+                    "weight": self.weights[cls],
+                    "max_in_flight": self.caps[cls],
+                    "queued": len(self._queues[cls]),
+                    "in_flight": self._running[cls],
+                    "completed": stats["completed"],
+                    "dropped": stats["dropped"],
+                    "mean_queue_wait_ms": round(stats["wait_seconds"] / stats["started"] * 1000, 3) if stats["started"] else 0.0,
+                    "p50_queue_wait_ms": round(percentile(waits, 0.50) * 1000, 3),
+                    "p99_queue_wait_ms": round(percentile(waits, 0.99) * 1000, 3)
+                }
+            return {
+                "framework": self.framework,
+                "workers": self.workers,
+                "intra_op_threads": self.threads,
+                "cpus": sorted(self.cpus) if self.cpus else None,
+                "queued": sum(len(q) for q in self._queues.values()),
+                "in_flight": self._in_flight,
+                "completed": self._completed,
+                "failed": self._failed,
+                "dropped": self._dropped,
+                "utilization": round(self._busy_seconds / (elapsed * self.workers), 4) if elapsed else 0.0,
+                "mean_queue_wait_ms": round(self._wait_seconds / finished * 1000, 3) if finished else 0.0,
+                "mean_service_ms": round(self._busy_seconds / finished * 1000, 3) if finished else 0.0,
+                "classes": classes
+            }
+
+
+class ExecutionTopology:
+    """Route inference to the classification or detection pool"""
+
+    # Task name -> pool name
+    ROUTES = {
+        'classification': 'classification',
+        'detection': 'detection',
+        'count': 'detection'
+    }
+
+    def __init__(self, classification_pool, detection_pool):
+        self.pools = {
+            'classification': classification_pool,
+            'detection': detection_pool
+        }
+
+    @classmethod
+    def from_env(cls):
+        """
+        Build the topology from environment variables
+        DL_CLASSIFICATION_WORKERS / DL_DETECTION_WORKERS: concurrent calls per pool
+        DL_CLASSIFICATION_THREADS / DL_DETECTION_THREADS: intra-op thread budget per pool
+        DL_CLASSIFICATION_CPUS / DL_DETECTION_CPUS: optional CPU lists, e.g. '0-3'
+        DL_PRIORITY_WEIGHTS: scheduling weights per class, e.g. 'interactive:8,bulk:1'
+        DL_PRIORITY_CAPS: max concurrent calls per class and pool, e.g. 'bulk:1' ('bulk:0' = only while interactive is idle)
+        Budgets default to an even split of the available cores. The detection
+        pool defaults to 2 workers so bulk calls always leave one worker free.
+        """
+        cores = len(available_cpus())
+        half = max(cores // 2, 1)
+        weights = parse_class_map(os.environ.get('DL_PRIORITY_WEIGHTS'))
+        caps = parse_class_map(os.environ.get('DL_PRIORITY_CAPS'), cast=int)
+        classification_pool = InferencePool(
+            'classification', 'tensorflow',
+            workers=int(os.environ.get('DL_CLASSIFICATION_WORKERS', '2')),
+            threads=int(os.environ.get('DL_CLASSIFICATION_THREADS', str(half))),
+            cpus=parse_cpu_list(os.environ.get('DL_CLASSIFICATION_CPUS')),
+            weights=weights, caps=caps
+        )
+        detection_pool = InferencePool(
+            'detection', 'torch',
+            workers=int(os.environ.get('DL_DETECTION_WORKERS', '2')),
+            threads=int(os.environ.get('DL_DETECTION_THREADS', str(max(cores - half, 1)))),
+            cpus=parse_cpu_list(os.environ.get('DL_DETECTION_CPUS')),
+            weights=weights, caps=caps
+        )
+        return cls(classification_pool, detection_pool)
+
+    def configure_frameworks(self):
+        """
+        Apply the thread budgets to TensorFlow and torch
+        Must run before either framework executes its first op.
+        """
+        classification = self.pools['classification']
+        detection = self.pools['detection']
+
+        import tensorflow as tf
+        try:
+            # One shared Eigen pool sized to the budget, one inter-op lane per worker
+            tf.config.threading.set_intra_op_parallelism_threads(classification.threads)
+            tf.config.threading.set_inter_op_parallelism_threads(classification.workers)
+        except RuntimeError as e:
+            print(f"⚠ TensorFlow threads already initialized: {str(e)}")
+
+        import torch
+        # torch's intra-op setting applies per call, split the budget across workers
+        torch.set_num_threads(max(detection.threads // detection.workers, 1))
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # Already set once in this process
+
+        print(f"✓ Thread budgets: TensorFlow intra={classification.threads} inter={classification.workers}, "
+              f"torch per-call={torch.get_num_threads()}")
+
+    def load_models(self, model_loader):
+        """
+        Load models from inside their pools so framework thread pools
+        are created by (and inherit the affinity of) the pool threads
+        Returns:
+            True if classification and both detection models are available
+        """
+        classification = self.pools['classification'].submit(model_loader.load_all_classification_models)
+        detection = self.pools['detection'].submit(model_loader.load_all_detection_models)
+        loaded, failed = classification.result()
+        detection_ok = detection.result()
+        if not loaded:
+            print("⚠ Warning: No classification models loaded")
+        return bool(loaded) and detection_ok
+
+    def pool_for(self, task):
+        if task not in self.ROUTES:
+            raise ValueError(f"Unknown task: {task}")
+        return self.pools[self.ROUTES[task]]
+
+    def submit(self, task, fn, *args, **kwargs):
+        return self.pool_for(task).submit(fn, *args, **kwargs)
+
+    async def run(self, task, fn, *args, **kwargs):
+        return await self.pool_for(task).run(fn, *args, **kwargs)
+
+    def submit_as(self, task, priority, fn, *args, **kwargs):
+        return self.pool_for(task).submit_as(priority, fn, *args, **kwargs)
+
+    async def run_as(self, task, priority, fn, *args, **kwargs):
+        return await self.pool_for(task).run_as(priority, fn, *args, **kwargs)
+
+    def stats(self):
+        return {
+            "cores": len(available_cpus()),
+            "frameworks_loaded": [name for name in ('tensorflow', 'torch') if name in sys.modules],
+            "pools": {name: pool.stats() for name, pool in self.pools.items()}
+        }
+
+    def shutdown(self):
+        for pool in self.pools.values():
+            pool.shutdown()
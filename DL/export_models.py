@@ -0,0 +1,248 @@
+"""
+Export Models - Convert the YOLO checkpoints to CPU-optimized formats
+ModelLoader serves the exported model automatically when it is present
+(OpenVINO IR first, then ONNX) and falls back to the .pt checkpoint.
+
+Usage:
+    python export_models.py --format openvino
+    python export_models.py --format onnx --dynamic --imgsz 640
+    python export_models.py --check --image-dir samples/
+"""
+import os
+# Force TensorFlow to use legacy Keras 2.x for compatibility with older models
+os.environ['TF_USE_LEGACY_KERAS'] = '1'
+
+import argparse
+import io
+import json
+import sys
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from model_loader import ModelLoader, DETECTION_EXPORTS, EXPORT_MANIFEST, file_sha256
+
+
+# ==================== EXPORT ====================
+
+def write_manifest(models_dir, manifest):
+    path = os.path.join(models_dir, EXPORT_MANIFEST)
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    print(f"✓ Export manifest written to {path}")
+
+
+def export_model(checkpoint, fmt, imgsz, dynamic):
+    """
+    Export one YOLO checkpoint
+    Args:
+        checkpoint: Path to the .pt file
+        fmt: 'onnx' or 'openvino'
+        imgsz: Input size the export is traced at
+        dynamic: Allow any batch size and input shape
+    Returns:
+        Path to the exported model
+    """
+    from ultralytics import YOLO
+
+    model = YOLO(checkpoint)
+    # Static exports are traced at batch 1 (see ModelLoader.detection_batch_limit)
+    return model.export(format=fmt, imgsz=imgsz, dynamic=dynamic, batch=1, half=False)
+
+
+def run_export(args, loader):
+    import ultralytics
+
+    manifest = loader.read_export_manifest()
+    for task in args.models:
+        filename = loader.detection_files[task]
+        checkpoint = os.path.join(loader.models_dir, filename)
+        if not os.path.exists(checkpoint):
+            print(f"⚠ Skipping {task}: {checkpoint} not found")
+            continue
+
+        print(f"Exporting {filename} -> {args.format} (imgsz={args.imgsz}, dynamic={args.dynamic})...")
+        path = export_model(checkpoint, args.format, args.imgsz, args.dynamic)
+        manifest.setdefault(filename, {})[args.format] = {
+            "path": os.path.basename(str(path).rstrip('/\\')),
+            "imgsz": args.imgsz,
+            "dynamic": args.dynamic,
+            # ModelLoader skips the export once the checkpoint is retrained/replaced
+            "checkpoint_sha256": file_sha256(checkpoint),
+            "checkpoint_size": os.path.getsize(checkpoint),
+            "ultralytics": ultralytics.__version__,
+            "exported_at": datetime.now().isoformat(timespec='seconds')
+        }
+        print(f"✓ {task} exported to {path}")
+
+    write_manifest(loader.models_dir, manifest)
+
+
+# ==================== PARITY CHECK ====================
+
+def box_iou(a, b):
+    """Pairwise IoU between two (N, 4) and (M, 4) xyxy arrays"""
+    top_left = np.maximum(a[:, None, :2], b[None, :, :2])
+    bottom_right = np.minimum(a[:, None, 2:], b[None, :, 2:])
+    inter = np.clip(bottom_right - top_left, 0, None).prod(axis=2)
+    area_a = (a[:, 2:] - a[:, :2]).prod(axis=1)
+    area_b = (b[:, 2:] - b[:, :2]).prod(axis=1)
+    return inter / (area_a[:, None] + area_b[None, :] - inter + 1e-9)
+
+
+def to_arrays(results):
+    boxes = results.boxes
+    return (boxes.xyxy.cpu().numpy().reshape(-1, 4),
+            boxes.cls.cpu().numpy().astype(int),
+            boxes.conf.cpu().numpy())
+
+
+def compare_results(reference, candidate, iou_threshold, conf_tolerance):
+    """
+    Match candidate boxes to reference boxes (same class, greedy by confidence)
+    Returns:
+        dict with match statistics for one image
+    """
+    ref_xyxy, ref_cls, ref_conf = to_arrays(reference)
+    cand_xyxy, cand_cls, cand_conf = to_arrays(candidate)
+
+    used = np.zeros(len(cand_xyxy), dtype=bool)
+    matched = 0
+    conf_errors = []
+    if len(ref_xyxy) and len(cand_xyxy):
+        iou = box_iou(ref_xyxy, cand_xyxy)
+        order = np.argsort(-ref_conf)
+    else:
+        order = []
+    for i in order:
+        scores = np.where((cand_cls == ref_cls[i]) & ~used, iou[i], 0.0)
+        j = int(np.argmax(scores))
+        if scores[j] >= iou_threshold:
+            used[j] = True
+            matched += 1
+            conf_errors.append(abs(float(ref_conf[i]) - float(cand_conf[j])))
+
+    classes = set(ref_cls.tolist()) | set(cand_cls.tolist())
+    count_error = max((abs(int((ref_cls == c).sum()) - int((cand_cls == c).sum())) for c in classes), default=0)
+    return {
+        "reference_boxes": len(ref_xyxy),
+        "candidate_boxes": len(cand_xyxy),
+        "matched": matched,
+        "max_conf_error": max(conf_errors) if conf_errors else 0.0,
+        "conf_within_tolerance": all(e <= conf_tolerance for e in conf_errors),
+        "count_error": count_error
+    }
+
+
+def load_check_images(image_dir, limit):
+    if image_dir:
+        files = sorted(f for f in os.listdir(image_dir) if f.lower().endswith(('.jpg', '.jpeg', '.png')))
+        images = []
+        for filename in files[:limit]:
+            with open(os.path.join(image_dir, filename), 'rb') as f:
+                images.append((filename, np.array(Image.open(io.BytesIO(f.read())).convert('RGB'))))
+        return images
+
+    from standins import synthetic_smear
+    return [(f"synthetic_{i}", synthetic_smear(640, 480, seed=i)) for i in range(limit)]
+
+
+def run_check(args, loader):
+    """
+    Compare every exported model against its .pt checkpoint
+    Returns:
+        True if all exports are within tolerance
+    """
+    from ultralytics import YOLO
+
+    images = load_check_images(args.image_dir, args.max_images)
+    if not images:
+        print("✗ No images to check")
+        return False
+
+    manifest = loader.read_export_manifest()
+    all_ok = True
+    checked = 0
+    for task in args.models:
+        filename = loader.detection_files[task]
+        checkpoint = os.path.join(loader.models_dir, filename)
+        stem = os.path.splitext(filename)[0]
+        if not os.path.exists(checkpoint):
+            print(f"⚠ Skipping {task}: {checkpoint} not found")
+            continue
+
+        reference_model = YOLO(checkpoint)
+        for fmt, suffix, _ in DETECTION_EXPORTS:
+            path = os.path.join(loader.models_dir, stem + suffix)
+            if not os.path.exists(path):
+                continue
+            checked += 1
+            imgsz = manifest.get(filename, {}).get(fmt, {}).get("imgsz", 640)
+            candidate_model = YOLO(path, task='detect')
+
+            matched = total = 0
+            max_conf_error = 0.0
+            count_errors = []
+            conf_ok = True
+            # Boxes right at the threshold may flip, hence the match-rate/count tolerances
+            for name, image in images:
+                reference = reference_model.predict(image, conf=args.conf, imgsz=imgsz, verbose=False)[0]
+                candidate = candidate_model.predict(image, conf=args.conf, imgsz=imgsz, verbose=False)[0]
+                stats = compare_results(reference, candidate, args.iou, args.conf_tolerance)
+                matched += stats["matched"]
+                total += max(stats["reference_boxes"], stats["candidate_boxes"])
+                max_conf_error = max(max_conf_error, stats["max_conf_error"])
+                conf_ok = conf_ok and stats["conf_within_tolerance"]
+                count_errors.append(stats["count_error"])
+                if args.verbose:
+                    print(f"  {name}: {stats}")
+
+            match_rate = matched / total if total else 1.0
+            worst_count_error = max(count_errors) if count_errors else 0
+            ok = (match_rate >= args.min_match_rate and conf_ok
+                  and worst_count_error <= args.count_tolerance)
+            all_ok = all_ok and ok
+            print(f"{'✓' if ok else '✗'} {task:9s} {fmt:8s} boxes matched {match_rate:.2%} "
+                  f"(IoU>={args.iou}), max conf error {max_conf_error:.4f}, "
+                  f"max count error {worst_count_error} over {len(images)} image(s)")
+
+    if not checked:
+        print("⚠ No exported models found - run without --check first")
+        return False
+    return all_ok
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Export YOLO models to ONNX/OpenVINO and check parity")
+    parser.add_argument("--models", default="detection,count", help="Comma-separated: detection, count")
+    parser.add_argument("--models-dir", default="models", help="Directory containing the model files")
+    parser.add_argument("--format", choices=[fmt for fmt, _, _ in DETECTION_EXPORTS], default="openvino",
+                        help="Export format")
+    parser.add_argument("--imgsz", type=int, default=640, help="Input size to trace the export at")
+    parser.add_argument("--dynamic", action="store_true",
+                        help="Dynamic batch/shape export (needed for cross-request batching)")
+    parser.add_argument("--check", action="store_true", help="Compare exported models against the .pt checkpoints")
+    parser.add_argument("--image-dir", default=None, help="Images for --check (default: synthetic smears)")
+    parser.add_argument("--max-images", type=int, default=20, help="Images used by --check")
+    parser.add_argument("--conf", type=float, default=0.25, help="Confidence threshold for --check")
+    parser.add_argument("--iou", type=float, default=0.9, help="IoU for a box to count as matched")
+    parser.add_argument("--conf-tolerance", type=float, default=0.02, help="Max confidence difference per box")
+    parser.add_argument("--min-match-rate", type=float, default=0.97, help="Min fraction of matched boxes")
+    parser.add_argument("--count-tolerance", type=int, default=1, help="Max per-class count difference per image")
+    parser.add_argument("--verbose", action="store_true", help="Print per-image statistics")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.models = [m.strip() for m in args.models.split(',') if m.strip()]
+    loader = ModelLoader(models_dir=args.models_dir)
+    for task in args.models:
+        if task not in loader.detection_files:
+            print(f"✗ Unknown model: {task}. Available: {list(loader.detection_files.keys())}")
+            sys.exit(2)
+
+    if args.check:
+        sys.exit(0 if run_check(args, loader) else 1)
+    run_export(args, loader)
@@ -0,0 +1,476 @@
+"""
+Inference Broker - Central inference process shared by all HTTP workers
+The broker owns the only copy of the model weights. Workers send image
+arrays through shared memory and receive results on their own queue, so
+each extra HTTP worker costs almost no memory.
+"""
+import os
+# Force TensorFlow to use legacy Keras 2.x for compatibility with older models
+os.environ['TF_USE_LEGACY_KERAS'] = '1'
+
+import itertools
+import signal
+import threading
+import traceback
+from concurrent.futures import Future, TimeoutError as FutureTimeout
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+from PIL import Image
+
+from profiler import StageTimer, sampling_profiler
+from deadlines import RequestContext, RequestAborted
+from executors import INTERACTIVE
+
+
+# Predictor methods workers are allowed to call remotely -> task used for pool routing
+REMOTE_METHODS = {
+    'predict_classification': 'classification',
+    'predict_classification_batch': 'classification',
+    'predict_detection': 'detection',
+    'predict_detection_count': 'count',
+    'embed_classification': 'classification',
+}
+
+# Pseudo-method returning the broker's worker pool statistics
+STATS_METHOD = '__pool_stats__'
+
+# Pseudo-method abandoning a request whose HTTP client went away
+CANCEL_METHOD = '__cancel__'
+
+# Pseudo-method running a model registry action (args: [action], kwargs)
+REGISTRY_METHOD = '__registry__'
+
+# Pseudo-method capturing a sampling profile of the broker, where inference runs
+# (kwargs: SamplingProfiler.capture arguments)
+PROFILE_METHOD = '__profile__'
+
+
+# ==================== SHARED MEMORY HELPERS ====================
+
+def array_to_shm(array):
+    """
+    Copy a numpy array into a new shared memory block
+    Returns:
+        tuple: (SharedMemory, descriptor dict)
+    """
+    array = np.ascontiguousarray(array)
+    shm = shared_memory.SharedMemory(create=True, size=max(array.nbytes, 1))
+    np.ndarray(array.shape, dtype=array.dtype, buffer=shm.buf)[...] = array
+    return shm, {"__shm__": shm.name, "shape": array.shape, "dtype": array.dtype.str}
+
+
+def array_from_shm(descriptor, unlink=False):
+    """
+    Copy an array out of a shared memory block created by another process
+    Args:
+        descriptor: Descriptor produced by array_to_shm
+        unlink: Free the block afterwards (the receiver owns it)
+    Returns:
+        numpy array (private copy)
+    """
+    shm = shared_memory.SharedMemory(name=descriptor["__shm__"])
+    try:
+        view = np.ndarray(descriptor["shape"], dtype=np.dtype(descriptor["dtype"]), buffer=shm.buf)
+        array = view.copy()
+        del view
+    finally:
+        shm.close()
+        if unlink:
+            shm.unlink()
+        else:
+            # Attaching registers the block with our resource tracker, but the
+            # creating process owns it - don't let our tracker free it at exit
+            resource_tracker.unregister(shm._name, "shared_memory")
+    return array
+
+
+def is_shm_descriptor(value):
+    return isinstance(value, dict) and "__shm__" in value
+
+
+class CollectingLogger:
+    """Logger stand-in that buffers lines so the worker can replay them"""
+
+    def __init__(self):
+        self.lines = []
+
+    def info(self, message):
+        self.lines.append(("info", str(message)))
+
+    def warning(self, message):
+        self.lines.append(("warning", str(message)))
+
+    def error(self, message):
+        self.lines.append(("error", str(message)))
+
+
+# ==================== BROKER (SERVER SIDE) ====================
+
+def run_broker(request_queue, response_queues, ready_queue, models_dir="models"):
+    """
+    Broker process entry point: load models once and serve inference calls
+    Worker pool sizes and thread budgets come from the DL_CLASSIFICATION_* /
+    DL_DETECTION_* environment variables (see executors.py), YOLO batching
+    from DL_DETECTION_BATCH_* (see batching.py)
+    Args:
+        request_queue: Queue shared by all workers
+        response_queues: One response queue per worker index
+        ready_queue: Queue used to report readiness/model metadata to the supervisor
+        models_dir: Directory containing the model files
+    """
+    from model_loader import ModelLoader
+    from interface import BloodCellPredictor
+    from executors import ExecutionTopology
+    from batching import build_batchers
+    from similarity import build_similarity_index
+    from registry import build_registry, REGISTRY_ACTIONS
+
+    # Ctrl+C reaches the whole process group - let the supervisor stop us in order
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+    topology = ExecutionTopology.from_env()
+    topology.configure_frameworks()
+    model_loader = ModelLoader(models_dir=models_dir)
+    topology.load_models(model_loader)
+    predictor = BloodCellPredictor(model_loader, similarity=build_similarity_index())
+    batchers = build_batchers(predictor, topology)
+    registry = build_registry(model_loader, topology, predictor, batchers)
+
+    ready_queue.put({
+        "pid": os.getpid(),
+        "classification_models": {
+            model_id: model is not None for model_id, model in model_loader.classification_models.items()
+        },
+        "detection": model_loader.detection_model is not None,
+        "count": model_loader.detection_count_model is not None,
+        "classification_classes": model_loader.classification_classes,
+        "detection_count_classes": model_loader.detection_count_classes,
+        "model_files": model_loader.model_files
+    })
+    print(f"✓ Inference broker ready (pid {os.getpid()})")
+
+    # (worker index, request id) -> RequestContext of requests not yet answered
+    # (single dict operations are atomic, pool threads pop their own entries)
+    contexts = {}
+
+    def reply(worker_index, request_id, logger, timer, profile, result=None, error=None):
+        stages = timer.stages if profile else None
+        contexts.pop((worker_index, request_id), None)
+        if error is None:
+            if isinstance(result, dict) and isinstance(result.get('annotated_image'), np.ndarray):
+                shm, descriptor = array_to_shm(result['annotated_image'])
+                # Hand ownership to the worker, which unlinks after reading
+                shm.close()
+                resource_tracker.unregister(shm._name, "shared_memory")
+                result['annotated_image'] = descriptor
+            response = ("ok", result, logger.lines, stages)
+        else:
+            if not isinstance(error, RequestAborted):
+                logger.error(''.join(traceback.format_exception(type(error), error, error.__traceback__)))
+            response = ("error", f"{type(error).__name__}: {str(error)}", logger.lines, stages)
+        response_queues[worker_index].put((request_id, response))
+
+    def capture_profile(worker_index, request_id, kwargs):
+        try:
+            response = ("ok", sampling_profiler.capture(**kwargs), [], None)
+        except RuntimeError as e:
+            # Another capture is running (SamplingProfiler.capture allows one at a time)
+            response = ("busy", str(e), [], None)
+        except Exception as e:
+            response = ("error", str(e), [], None)
+        response_queues[worker_index].put((request_id, response))
+
+    def decode_args(method, args):
+        args = [array_from_shm(a) if is_shm_descriptor(a) else a for a in args]
+        if method == 'predict_classification_batch':
+            args[0] = [array_from_shm(a) for a in args[0]]
+        return args
+
+    def handle(worker_index, request_id, method, args, kwargs, profile, deadline_ms, priority):
+        logger = CollectingLogger()
+        timer = contexts.get((worker_index, request_id)) or RequestContext(deadline_ms, priority=priority)
+        try:
+            # Drop work whose caller gave up while it was queued
+            timer.check()
+            result = getattr(predictor, method)(*decode_args(method, args), logger=logger, timer=timer, **kwargs)
+        except Exception as e:
+            reply(worker_index, request_id, logger, timer, profile, error=e)
+        else:
+            reply(worker_index, request_id, logger, timer, profile, result=result)
+
+    def handle_batched(worker_index, request_id, method, args, kwargs, profile, deadline_ms, priority):
+        # Detection/count requests from every worker share the YOLO batchers
+        logger = CollectingLogger()
+        timer = contexts.get((worker_index, request_id)) or RequestContext(deadline_ms, priority=priority)
+
+        def done(future):
+            error = future.exception()
+            if error is None:
+                reply(worker_index, request_id, logger, timer, profile, result=future.result())
+            else:
+                reply(worker_index, request_id, logger, timer, profile, error=error)
+
+        try:
+            image = decode_args(method, args)[0]
+            future = batchers[REMOTE_METHODS[method]].submit(image, logger=logger, timer=timer,
+                                                             priority=priority, **kwargs)
+        except Exception as e:
+            reply(worker_index, request_id, logger, timer, profile, error=e)
+        else:
+            future.add_done_callback(done)
+
+    while True:
+        message = request_queue.get()
+        if message is None:
+            break
+        worker_index, request_id, method = message[:3]
+        if method == STATS_METHOD:
+            stats = dict(topology.stats(), batching={task: b.stats() for task, b in batchers.items()},
+                         similarity=predictor.similarity.stats() if predictor.similarity else None)
+            response_queues[worker_index].put((request_id, ("ok", stats, [], None)))
+        elif method == REGISTRY_METHOD:
+            action = message[3][0]
+            try:
+                if action not in REGISTRY_ACTIONS:
+                    raise ValueError(f"Registry action not allowed: {action}")
+                response = ("ok", getattr(registry, action)(**message[4]), [], None)
+            except Exception as e:
+                response = ("error", str(e), [], None)
+            response_queues[worker_index].put((request_id, response))
+        elif method == PROFILE_METHOD:
+            if sampling_profiler.busy:
+                # Requested by another HTTP worker; each worker only knows about its own captures
+                response = ("busy", "A profile capture is already running in the inference broker", [], None)
+                response_queues[worker_index].put((request_id, response))
+            else:
+                # Samples for the whole capture; requests keep being dispatched meanwhile
+                threading.Thread(target=capture_profile, args=(worker_index, request_id, message[4]),
+                                 name="broker-profile", daemon=True).start()
+        elif method == CANCEL_METHOD:
+            context = contexts.get((worker_index, request_id))
+            if context is not None:
+                context.cancel()
+        elif method not in REMOTE_METHODS:
+            response_queues[worker_index].put((request_id, ("error", f"Method not allowed: {method}", [], None)))
+        else:
+            # Registered up front so a cancel can reach work that is still queued
+            priority = message[7]
+            contexts[(worker_index, request_id)] = RequestContext(message[6], priority=priority)
+            if REMOTE_METHODS[method] in batchers:
+                handle_batched(*message)
+            else:
+                topology.submit_as(REMOTE_METHODS[method], priority, handle, *message)
+
+    registry.shutdown()
+    for batcher in batchers.values():
+        batcher.shutdown()
+    topology.shutdown()
+    if predictor.similarity is not None:
+        predictor.similarity.save_all()
+    print("Inference broker stopped")
+
+
+# ==================== CLIENT (WORKER SIDE) ====================
+
+class RemoteModel:
+    """Placeholder for a model that lives in the broker process"""
+
+    def __repr__(self):
+        return "<model in inference broker>"
+
+
+class RemoteModelLoader:
+    """ModelLoader look-alike exposing the broker's model metadata"""
+
+    def __init__(self, description):
+        """
+        Args:
+            description: Metadata dict reported by the broker when ready
+        """
+        self.classification_models = {
+            model_id: RemoteModel() if loaded else None
+            for model_id, loaded in description["classification_models"].items()
+        }
+        self.detection_model = RemoteModel() if description["detection"] else None
+        self.detection_count_model = RemoteModel() if description["count"] else None
+        self.classification_classes = description["classification_classes"]
+        self.detection_count_classes = description["detection_count_classes"]
+        self.model_files = description["model_files"]
+
+    def get_available_classification_models(self):
+        return [model_id for model_id, model in self.classification_models.items() if model is not None]
+
+
+class BrokerClient:
+    """Send predictor calls to the broker and wait for the matching response"""
+
+    def __init__(self, worker_index, request_queue, response_queue):
+        self.worker_index = worker_index
+        self.request_queue = request_queue
+        self.response_queue = response_queue
+        self._ids = itertools.count()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._reader = threading.Thread(target=self._read_responses, name="broker-client", daemon=True)
+        self._reader.start()
+
+    def _read_responses(self):
+        while True:
+            request_id, response = self.response_queue.get()
+            with self._lock:
+                future = self._pending.pop(request_id, None)
+            if future is not None:
+                future.set_result(response)
+            elif response[0] == "ok" and isinstance(response[1], dict) \
+                    and is_shm_descriptor(response[1].get('annotated_image')):
+                # Response meant for a previous worker on this queue - free its image
+                array_from_shm(response[1]['annotated_image'], unlink=True)
+
+    def call(self, method, args, kwargs, profile=False, context=None):
+        """
+        Run a predictor method in the broker (blocking)
+        Args:
+            context: Optional RequestContext - its deadline and priority class are
+                forwarded and the broker is told to drop the work if the request is abandoned
+        Returns:
+            tuple: (status, payload, log lines, stage timings)
+        """
+        if context is not None:
+            # Already past its deadline or disconnected: never reaches the broker
+            context.check()
+        # Prefix with the pid so a restarted worker never matches stale responses
+        request_id = (os.getpid(), next(self._ids))
+        future = Future()
+        with self._lock:
+            self._pending[request_id] = future
+
+        blocks = []
+        wire_args = []
+        for arg in args:
+            if isinstance(arg, list):
+                encoded = []
+                for item in arg:
+                    shm, descriptor = array_to_shm(np.asarray(item))
+                    blocks.append(shm)
+                    encoded.append(descriptor)
+                wire_args.append(encoded)
+            elif isinstance(arg, (np.ndarray, Image.Image)):
+                shm, descriptor = array_to_shm(np.asarray(arg))
+                blocks.append(shm)
+                wire_args.append(descriptor)
+            else:
+                wire_args.append(arg)
+
+        deadline_ms = context.remaining_ms() if context is not None else None
+        if deadline_ms is not None:
+            # 0 would mean "no deadline" to set_deadline; keep an expired budget expired
+            deadline_ms = max(deadline_ms, 0.001)
+        priority = context.priority if context is not None else INTERACTIVE
+        try:
+            self.request_queue.put((self.worker_index, request_id, method, wire_args, kwargs, profile,
+                                    deadline_ms, priority))
+            if context is None:
+                return future.result()
+            while True:
+                try:
+                    return future.result(timeout=context.poll_interval)
+                except FutureTimeout:
+                    if not context.aborted:
+                        continue
+                    with self._lock:
+                        abandoned = self._pending.pop(request_id, None) is not None
+                    if abandoned:
+                        # A late response is freed by the reader as a stale one
+                        self.request_queue.put((self.worker_index, request_id, CANCEL_METHOD))
+                        context.check()
+        finally:
+            for shm in blocks:
+                shm.close()
+                shm.unlink()
+
+
+class RemotePredictor:
+    """BloodCellPredictor look-alike that runs inference in the broker"""
+
+    def __init__(self, client, model_loader):
+        """
+        Args:
+            client: BrokerClient for this worker
+            model_loader: RemoteModelLoader with the broker's metadata
+        """
+        # Local predictor for the cheap, framework-free helpers (decode, base64)
+        from interface import BloodCellPredictor
+        self._local = BloodCellPredictor(model_loader)
+        self.client = client
+        self.model_loader = model_loader
+        self.IMG_SIZE = self._local.IMG_SIZE
+
+    def _remote(self, method, args, kwargs):
+        logger = kwargs.pop('logger', None)
+        timer = kwargs.pop('timer', None)
+        profile = isinstance(timer, StageTimer)
+        context = timer if isinstance(timer, RequestContext) else None
+
+        status, payload, lines, stages = self.client.call(method, args, kwargs, profile=profile, context=context)
+
+        if logger is not None:
+            for level, line in lines:
+                getattr(logger, level)(f"[broker] {line}")
+        if profile and stages:
+            for name, ms in stages.items():
+                timer.stages[name] = timer.stages.get(name, 0.0) + ms
+
+        if status != "ok":
+            if context is not None:
+                # Report deadline/disconnect aborts as such, not as a generic failure
+                context.check()
+            raise RuntimeError(payload)
+
+        if isinstance(payload, dict) and is_shm_descriptor(payload.get('annotated_image')):
+            payload['annotated_image'] = array_from_shm(payload['annotated_image'], unlink=True)
+        return payload
+
+    def predict_classification(self, image, **kwargs):
+        return self._remote('predict_classification', [image], kwargs)
+
+    def predict_classification_batch(self, images, **kwargs):
+        return self._remote('predict_classification_batch', [list(images)], kwargs)
+
+    def embed_classification(self, image, **kwargs):
+        return self._remote('embed_classification', [image], kwargs)
+
+    def predict_detection(self, image, **kwargs):
+        return self._remote('predict_detection', [image], kwargs)
+
+    def predict_detection_count(self, image, **kwargs):
+        return self._remote('predict_detection_count', [image], kwargs)
+
+    def pool_stats(self):
+        status, payload, _, _ = self.client.call(STATS_METHOD, [], {})
+        return payload if status == "ok" else None
+
+    def registry_call(self, action, **kwargs):
+        status, payload, _, _ = self.client.call(REGISTRY_METHOD, [action], kwargs)
+        if status != "ok":
+            raise ValueError(payload)
+        return payload
+
+    def capture_profile(self, **kwargs):
+        """
+        Capture a sampling profile in the broker (see SamplingProfiler.capture)
+        Raises:
+            RuntimeError: A capture is already running in the broker
+        """
+        status, payload, _, _ = self.client.call(PROFILE_METHOD, [], kwargs)
+        if status == "busy":
+            raise RuntimeError(payload)
+        if status != "ok":
+            raise ValueError(payload)
+        return payload
+
+    def preprocess_upload(self, file_bytes, logger=None):
+        return self._local.preprocess_upload(file_bytes, logger=logger)
+
+    def image_to_base64(self, image_array):
+        return self._local.image_to_base64(image_array)
@@ -1,21 +1,219 @@
 """
 Interface - Prediction and Preprocessing functions for blood cell analysis
 """
+import os
 import numpy as np
 import cv2
 from PIL import Image
 import io
+import time
 import base64
 
+from profiler import NULL_TIMER
+from deadlines import RequestAborted
+
+
+# Dihedral (D4) views of an NHWC batch for test-time augmentation, most useful first
+TTA_VIEWS = [
+    ('identity', lambda x: x),
+    ('hflip', lambda x: x[:, :, ::-1]),
+    ('vflip', lambda x: x[:, ::-1]),
+    ('rot180', lambda x: x[:, ::-1, ::-1]),
+    ('rot90', lambda x: np.rot90(x, 1, axes=(1, 2))),
+    ('rot270', lambda x: np.rot90(x, 3, axes=(1, 2))),
+    ('transpose', lambda x: np.swapaxes(x, 1, 2)),
+    ('transverse', lambda x: np.swapaxes(x[:, ::-1, ::-1], 1, 2))
+]
+
+
+def tta_batch(img_array, views):
+    """
+    Build the augmented views of a preprocessed image as one batch
+    Args:
+        img_array: Preprocessed (1, H, W, C) array (square, so every view keeps its shape)
+        views: Number of views (1-8)
+    Returns:
+        (views, H, W, C) array
+    """
+    return np.concatenate([view(img_array) for _, view in TTA_VIEWS[:views]], axis=0)
+
+
+# ==================== ANNOTATION ====================
+
+# Ultralytics' default palette, used when ultralytics.utils.plotting is not importable
+PALETTE_HEX = ("042AFF", "0BDBEB", "F3F3F3", "00DFB7", "111F68", "FF6FDD", "FF444F", "CCED00", "00F344", "BD00FF",
+               "00B4FF", "DD00BA", "00FFFF", "26C000", "01FFB3", "7D24FF", "7B0068", "FF1B6C", "FC6D2F", "A2FF0B")
+
+
+def box_color(cls):
+    """Color tuple Ultralytics' plot() draws a class with (its BGR palette entry)"""
+    try:
+        from ultralytics.utils.plotting import colors
+        return tuple(int(v) for v in colors(int(cls), True))
+    except ImportError:
+        value = PALETTE_HEX[int(cls) % len(PALETTE_HEX)]
+        return tuple(int(value[i:i + 2], 16) for i in (4, 2, 0))
+
+
+def label_text_color(color):
+    # Dark text on light label backgrounds, white otherwise
+    luminance = 0.299 * color[0] + 0.587 * color[1] + 0.114 * color[2]
+    return (0, 0, 0) if luminance > 160 else (255, 255, 255)
+
+
+def rect_corners(boxes):
+    """(N, 4) integer [x1, y1, x2, y2] boxes -> (N, 4, 2) corners in cv2.rectangle's order"""
+    return np.stack([boxes[:, [0, 1]], boxes[:, [2, 1]], boxes[:, [2, 3]], boxes[:, [0, 3]]], axis=1)
+
+
+def _paste_max(plane, mask, left, top):
+    # Merge a label's coverage into the text plane, clipped to the image
+    x0, y0 = max(left, 0), max(top, 0)
+    x1, y1 = min(left + mask.shape[1], plane.shape[1]), min(top + mask.shape[0], plane.shape[0])
+    if x0 >= x1 or y0 >= y1:
+        return
+    view = plane[y0:y1, x0:x1]
+    np.maximum(view, mask[y0 - top:y1 - top, x0 - left:x1 - left], out=view)
+
+
+class BoxRenderer:
+    """
+    Draw detections like Ultralytics' results.plot(), with batched OpenCV calls
+    plot() draws every box and label with its own cv2 calls from Python. Here
+    the outlines and label backgrounds of each class are drawn with a single
+    polylines/fillPoly call, and the label text is blended in one numpy
+    operation from masks rendered once and cached in an atlas. Line width,
+    font scale, colors and label placement follow plot(); labels are drawn
+    above all boxes instead of interleaved with them.
+    """
+
+    def __init__(self, max_side=0, atlas_size=4096):
+        """
+        Args:
+            max_side: Downscale images whose longer side exceeds this before drawing (0 = full resolution)
+            atlas_size: Cached label masks kept before the atlas is rebuilt
+        """
+        self.max_side = max_side
+        self.atlas_size = atlas_size
+        self._atlas = {}
+        self._colors = {}
+
+    def color(self, cls):
+        color = self._colors.get(cls)
+        if color is None:
+            color = self._colors[cls] = box_color(cls)
+        return color
+
+    def label_mask(self, text, scale, thickness):
+        """
+        Anti-aliased coverage mask of a label, rendered once per (text, scale, thickness)
+        Returns:
+            tuple (uint8 mask, text width, text height, padding around the text)
+        """
+        key = (text, scale, thickness)
+        entry = self._atlas.get(key)
+        if entry is None:
+            (width, height), baseline = cv2.getTextSize(text, cv2.FONT_HERSHEY_SIMPLEX, scale, thickness)
+            pad = thickness + 1
+            mask = np.zeros((height + baseline + 2 * pad, width + 2 * pad), dtype=np.uint8)
+            cv2.putText(mask, text, (pad, height + pad), cv2.FONT_HERSHEY_SIMPLEX, scale, 255, thickness,
+                        cv2.LINE_AA)
+            if len(self._atlas) >= self.atlas_size:
+                self._atlas.clear()
+            entry = self._atlas[key] = (mask, width, height, pad)
+        return entry
+
+    def render(self, image, xyxy, classes, confidences, names, show_labels=True):
+        """
+        Draw boxes (and labels) onto a copy of the image
+        Args:
+            image: HxWx3 uint8 array (left untouched)
+            xyxy: (N, 4) boxes in image coordinates
+            classes: N class indices
+            confidences: N confidence scores
+            names: Class index to name mapping
+            show_labels: Draw "<class> <confidence>" labels (False = boxes only)
+        Returns:
+            Annotated array, downscaled when the image is larger than max_side
+        """
+        image = np.asarray(image)
+        scale = 1.0
+        longest = max(image.shape[:2])
+        if self.max_side and longest > self.max_side:
+            scale = self.max_side / longest
+            size = (max(round(image.shape[1] * scale), 1), max(round(image.shape[0] * scale), 1))
+            canvas = cv2.resize(image, size, interpolation=cv2.INTER_AREA)
+        else:
+            canvas = image.copy()
+
+        boxes = (np.asarray(xyxy, dtype=np.float32).reshape(-1, 4) * scale).astype(np.int32)
+        if len(boxes) == 0:
+            return canvas
+        classes = np.asarray(classes).reshape(-1).astype(np.int64)
+        line_width = max(round(sum(canvas.shape) / 2 * 0.003), 2)
+
+        for cls in np.unique(classes).tolist():
+            corners = rect_corners(boxes[classes == cls])
+            cv2.polylines(canvas, list(corners), True, self.color(cls), line_width, cv2.LINE_AA)
+
+        if not show_labels:
+            return canvas
+
+        thickness = max(line_width - 1, 1)
+        font_scale = line_width / 3
+        height, width = canvas.shape[:2]
+        backgrounds = {}
+        planes = {}
+        for (x1, y1, _, _), cls, score in zip(boxes.tolist(), classes.tolist(),
+                                              np.asarray(confidences).reshape(-1).tolist()):
+            mask, text_w, text_h, pad = self.label_mask(f"{names[cls]} {score:.2f}", font_scale, thickness)
+            label_h = text_h + 3
+            outside = y1 >= label_h
+            x1 = min(x1, width - text_w)
+            y2 = y1 - label_h if outside else y1 + label_h
+            backgrounds.setdefault(cls, []).append([[x1, y1], [x1 + text_w, y1], [x1 + text_w, y2], [x1, y2]])
+
+            baseline_y = y1 - 2 if outside else y1 + label_h - 1
+            text_color = label_text_color(self.color(cls))
+            plane = planes.get(text_color)
+            if plane is None:
+                plane = planes[text_color] = np.zeros((height, width), dtype=np.uint8)
+            _paste_max(plane, mask, x1 - pad, baseline_y - text_h - pad)
+
+        for cls, rects in backgrounds.items():
+            cv2.fillPoly(canvas, list(np.asarray(rects, dtype=np.int32)), self.color(cls), cv2.LINE_AA)
+
+        for text_color, plane in planes.items():
+            ys, xs = np.nonzero(plane)
+            alpha = plane[ys, xs, None].astype(np.float32) / 255.0
+            pixels = canvas[ys, xs].astype(np.float32)
+            color = np.asarray(text_color, dtype=np.float32)
+            canvas[ys, xs] = (pixels + (color - pixels) * alpha + 0.5).astype(np.uint8)
+        return canvas
+
+
+def build_renderer():
+    """
+    Create the annotation renderer from environment variables
+    DL_ANNOTATE_MAX_SIDE: longest side of annotated images, larger ones are downscaled first (default 0 = off)
+    Returns:
+        BoxRenderer
+    """
+    return BoxRenderer(max_side=int(os.environ.get('DL_ANNOTATE_MAX_SIDE', '0')))
+
 
 class BloodCellPredictor:
-    def __init__(self, model_loader):
+    def __init__(self, model_loader, similarity=None, renderer=None):
         """
         Initialize predictor with loaded models
         Args:
             model_loader: Instance of ModelLoader class
+            similarity: Optional SimilarityIndex storing classification embeddings
+            renderer: BoxRenderer drawing annotated images (default: from environment variables)
         """
         self.model_loader = model_loader
+        self.similarity = similarity
+        self.renderer = renderer or build_renderer()
         self.IMG_SIZE = 224  # For classification
     
     # ==================== CLASSIFICATION ====================
@@ -43,17 +241,20 @@ class BloodCellPredictor:
         
         return img_array
     
-    def predict_classification(self, image, model_id='mobilenet-v2', logger=None):
+    def predict_classification(self, image, model_id='mobilenet-v2', logger=None, timer=None, tta=0):
         """
         Predict blood cell type classification
         Args:
             image: PIL Image, numpy array, or file path (string)
             model_id: Model identifier (resnet-50, densenet-121, mobilenet-v2, efficientnet-b0, cnn, vit-base)
             logger: Logger instance for this request
+            timer: Optional StageTimer collecting the stage breakdown
+            tta: Test-time augmentation views (2-8 flips/rotations run as one batch, 0 or 1 = off)
         Returns:
-            dict with prediction results
+            dict with prediction results (plus a 'tta' summary when enabled)
         """
         log = logger.info if logger else print
+        timer = timer or NULL_TIMER
         
         log(f"predict_classification called with model_id: {model_id}")
         log(f"Image type: {type(image)}")
@@ -70,18 +271,46 @@ class BloodCellPredictor:
         
         # Preprocess
         log("Preprocessing image for classification...")
-        processed_img = self.preprocess_for_classification(image)
+        with timer.stage("preprocess"):
+            processed_img = self.preprocess_for_classification(image)
         log(f"Preprocessed image shape: {processed_img.shape}")
         
-        # Get model
-        log(f"Getting classification model: {model_id}")
-        model = self.model_loader.get_classification_model(model_id)
+        views = min(max(int(tta or 1), 1), len(TTA_VIEWS))
+        if views > 1:
+            with timer.stage("augment"):
+                processed_img = tta_batch(processed_img, views)
+            log(f"TTA: {views} views batched, shape: {processed_img.shape}")
         
-        # Predict
-        log("Running model prediction...")
-        predictions = model.predict(processed_img, verbose=0)
+        # Get model (with the embedding output when predictions are indexed)
+        log(f"Getting classification model: {model_id}")
+        indexing = self.similarity is not None and self.similarity.index_predictions
+        with self.model_loader.lease(model_id) as model:
+            version = self.model_loader.version_of(model)
+            if indexing:
+                model = self.model_loader.get_embedding_model(model_id, model)
+            
+            # Predict
+            log("Running model prediction...")
+            with timer.stage("inference"):
+                predictions = model.predict(processed_img, verbose=0)
+        if indexing:
+            embeddings, predictions = predictions
         log(f"Predictions shape: {predictions.shape}")
         
+        tta_summary = None
+        if views > 1:
+            # Average the views' probabilities; the spread shows how stable the prediction is
+            view_predictions = predictions
+            predictions = view_predictions.mean(axis=0, keepdims=True)
+            variance = view_predictions.var(axis=0)
+            votes = np.argmax(view_predictions, axis=1)
+            tta_summary = {
+                "views": [name for name, _ in TTA_VIEWS[:views]],
+                "variance": {name: float(variance[i]) for i, name in enumerate(self.model_loader.classification_classes)},
+                "agreement": float(np.mean(votes == np.argmax(predictions[0])))
+            }
+            log(f"TTA agreement: {tta_summary['agreement']:.2f}")
+        
         # Get predicted class
         pred_class_index = np.argmax(predictions[0])
         num_classes = predictions.shape[1]
@@ -99,86 +328,262 @@ class BloodCellPredictor:
             probabilities[class_name] = float(predictions[0][i])
             log(f"Probability[{class_name}] = {predictions[0][i]:.4f}")
         
-        return {
+        if indexing:
+            # The un-augmented view's embedding; a failure here must not fail the prediction
+            try:
+                with timer.stage("index"):
+                    self.similarity.add(model_id, embeddings[0], self.similarity.image_key(processed_img[0]),
+                                        image=image, version=version, predicted_class=pred_class_name,
+                                        confidence=round(confidence, 6), source="prediction")
+            except Exception as e:
+                log(f"Warning: could not index embedding: {str(e)}")
+        
+        result = {
             "predicted_class": pred_class_name,
             "confidence": confidence,
             "probabilities": probabilities,
             "model_used": model_id
         }
+        if tta_summary is not None:
+            result["tta"] = tta_summary
+        return result
     
-    # ==================== DETECTION ====================
-    
-    def predict_detection(self, image, conf=0.25, show_labels=True, logger=None):
+    def embed_classification(self, image, model_id='mobilenet-v2', k=10, add=True, logger=None, timer=None):
         """
-        Predict blood cell detection with bounding boxes
+        Extract a cell's penultimate-layer embedding and find the most similar indexed cells
         Args:
             image: PIL Image, numpy array, or file path (string)
-            conf: Confidence threshold
-            show_labels: Whether to show class labels on bounding boxes
+            model_id: Classification model whose embedding space is used
+            k: Number of neighbours to return
+            add: Also add this image to the index
             logger: Logger instance for this request
+            timer: Optional StageTimer collecting the stage breakdown
         Returns:
-            dict with detection results
+            dict with the embedding, the prediction from the same forward pass and the neighbours
         """
         log = logger.info if logger else print
+        timer = timer or NULL_TIMER
         
-        log(f"predict_detection called with conf={conf}")
-        log(f"Image type: {type(image)}")
+        if self.similarity is None:
+            raise ValueError("Similarity index is disabled (DL_EMBEDDING_INDEX=0)")
+        
+        if isinstance(image, str):
+            image = Image.open(image).convert('RGB')
+        elif isinstance(image, np.ndarray):
+            image = Image.fromarray(image).convert('RGB')
         
-        # Get model
-        model = self.model_loader.get_detection_model()
-        log("Detection model loaded")
+        with timer.stage("preprocess"):
+            processed_img = self.preprocess_for_classification(image)
         
-        # Convert to file path or numpy array for YOLO
+        with self.model_loader.lease(model_id) as model:
+            version = self.model_loader.version_of(model)
+            model = self.model_loader.get_embedding_model(model_id, model)
+            with timer.stage("inference"):
+                embeddings, predictions = model.predict(processed_img, verbose=0)
+        embedding = embeddings[0]
+        key = self.similarity.image_key(processed_img[0])
+        log(f"Embedding: {embedding.shape[0]}-d from {model_id} version {version}")
+        
+        with timer.stage("search"):
+            neighbours = self.similarity.search(model_id, embedding, k=k, exclude=key, version=version)
+        log(f"Found {len(neighbours)} neighbour(s)")
+        
+        pred_class_index = int(np.argmax(predictions[0]))
+        pred_class_name = self.model_loader.classification_classes[pred_class_index]
+        confidence = float(predictions[0][pred_class_index])
+        
+        item_id = None
+        if add:
+            with timer.stage("index"):
+                item_id = self.similarity.add(model_id, embedding, key, image=image, version=version,
+                                              predicted_class=pred_class_name,
+                                              confidence=round(confidence, 6), source="embedding")
+        
+        return {
+            "embedding": np.asarray(embedding, dtype=np.float64).tolist(),
+            "dim": int(embedding.shape[0]),
+            "item_id": item_id,
+            "predicted_class": pred_class_name,
+            "confidence": confidence,
+            "model_used": model_id,
+            "model_version": version,
+            "neighbours": neighbours
+        }
+
+    def predict_classification_batch(self, images, model_id='mobilenet-v2', logger=None, timer=None):
+        """
+        Classify several images with a single forward pass
+        Args:
+            images: List of PIL Images, numpy arrays, or file paths
+            model_id: Model identifier
+            logger: Logger instance for this batch
+            timer: Optional StageTimer collecting the stage breakdown
+        Returns:
+            list of dicts with prediction results (same format as predict_classification)
+        """
+        log = logger.info if logger else print
+        timer = timer or NULL_TIMER
+
+        log(f"predict_classification_batch called with {len(images)} images, model_id: {model_id}")
+
+        with timer.stage("preprocess"):
+            batch = []
+            for image in images:
+                if isinstance(image, str):
+                    image = Image.open(image).convert('RGB')
+                elif isinstance(image, np.ndarray):
+                    image = Image.fromarray(image).convert('RGB')
+                batch.append(self.preprocess_for_classification(image))
+            batch = np.concatenate(batch, axis=0)
+
+        with self.model_loader.lease(model_id) as model:
+            with timer.stage("inference"):
+                predictions = model.predict(batch, verbose=0)
+        log(f"Predictions shape: {predictions.shape}")
+
+        classes = self.model_loader.classification_classes
+        results = []
+        for row in predictions:
+            pred_class_index = int(np.argmax(row))
+            results.append({
+                "predicted_class": classes[pred_class_index],
+                "confidence": float(row[pred_class_index]),
+                "probabilities": {name: float(row[i]) for i, name in enumerate(classes)},
+                "model_used": model_id
+            })
+
+        return results
+
+    # ==================== DETECTION ====================
+    
+    def _to_yolo_input(self, image, log):
+        """Convert a PIL Image to the numpy array YOLO expects (paths/arrays pass through)"""
         if isinstance(image, Image.Image):
             # Convert PIL to numpy
             log(f"Converting PIL to numpy, size: {image.size}")
             image = np.array(image)
             log(f"Numpy array shape: {image.shape}")
+        return image
+    
+    def _annotate(self, results, show_labels, log, timer):
+        """Draw the detections onto the image"""
+        # Same drawing as YOLO plot() (show_labels=False hides class names and confidence scores)
+        with timer.stage("annotate"):
+            boxes = results.boxes
+            annotated_img = self.renderer.render(
+                results.orig_img,
+                boxes.xyxy.cpu().numpy(),
+                boxes.cls.cpu().numpy(),
+                boxes.conf.cpu().numpy(),
+                results.names,
+                show_labels
+            )
+
+        log(f"Annotated image shape: {annotated_img.shape}")
+        log(f"Labels displayed: {show_labels}")
+        return annotated_img
+    
+    def _format_detection(self, results, model, show_labels, log, timer, annotate=True):
+        """Build the detection response from one image's YOLO results"""
+        with timer.stage("postprocess"):
+            # Extract detections
+            detections = []
+            for i, box in enumerate(results.boxes):
+                log(f"Processing box {i+1}/{len(results.boxes)}")
+                log(f"box.cls type: {type(box.cls)}, shape: {box.cls.shape if hasattr(box.cls, 'shape') else 'N/A'}")
+                log(f"box.conf type: {type(box.conf)}, shape: {box.conf.shape if hasattr(box.conf, 'shape') else 'N/A'}")
+            
+                # Fix: Extract scalar values from tensors
+                cls = int(box.cls.cpu().numpy()[0])
+                confidence = float(box.conf.cpu().numpy()[0])
+                xyxy = box.xyxy[0].cpu().numpy().tolist()
+            
+                log(f"Box {i+1}: class={cls}, confidence={confidence:.4f}, bbox={xyxy}")
+            
+                detections.append({
+                    "class": model.names[cls],
+                    "confidence": confidence,
+                    "bbox": xyxy  # [x1, y1, x2, y2]
+                })
         
-        # Predict
-        log("Running YOLO detection...")
-        results = model.predict(image, conf=conf, verbose=False)[0]
-        log(f"Detection complete, found {len(results.boxes)} boxes")
+        annotated_img = self._annotate(results, show_labels, log, timer) if annotate else None
         
-        # Extract detections
-        detections = []
-        for i, box in enumerate(results.boxes):
-            log(f"Processing box {i+1}/{len(results.boxes)}")
-            log(f"box.cls type: {type(box.cls)}, shape: {box.cls.shape if hasattr(box.cls, 'shape') else 'N/A'}")
-            log(f"box.conf type: {type(box.conf)}, shape: {box.conf.shape if hasattr(box.conf, 'shape') else 'N/A'}")
+        return {
+            "detections": detections,
+            "count": len(detections),
+            "annotated_image": annotated_img
+        }
+    
+    def _format_count(self, results, show_labels, log, timer, annotate=True):
+        """Build the cell count response from one image's YOLO results"""
+        with timer.stage("postprocess"):
+            # Count cells
+            counts = {"RBC": 0, "WBC": 0}
+            detections = []
+        
+            for i, box in enumerate(results.boxes):
+                log(f"Processing cell {i+1}/{len(results.boxes)}")
             
-            # Fix: Extract scalar values from tensors
-            cls = int(box.cls.cpu().numpy()[0])
-            confidence = float(box.conf.cpu().numpy()[0])
-            xyxy = box.xyxy[0].cpu().numpy().tolist()
+                # Fix: Extract scalar values from tensors
+                cls = int(box.cls.cpu().numpy()[0])
+                label = self.model_loader.detection_count_classes[cls]
+                confidence = float(box.conf.cpu().numpy()[0])
+                xyxy = box.xyxy[0].cpu().numpy().tolist()
             
-            log(f"Box {i+1}: class={cls}, confidence={confidence:.4f}, bbox={xyxy}")
+                log(f"Cell {i+1}: {label}, confidence={confidence:.4f}")
             
-            detections.append({
-                "class": model.names[cls],
-                "confidence": confidence,
-                "bbox": xyxy  # [x1, y1, x2, y2]
-            })
-        
-        # Get annotated image (YOLO plot() returns RGB in recent versions)
-        # Control label display: labels=False hides class names, conf=False hides confidence scores
-        if show_labels:
-            annotated_img = results.plot()
-        else:
-            annotated_img = results.plot(labels=False, conf=False)
+                counts[label] += 1
+                detections.append({
+                    "class": label,
+                    "confidence": confidence,
+                    "bbox": xyxy
+                })
         
-        log(f"Annotated image shape: {annotated_img.shape}")
-        log(f"Labels displayed: {show_labels}")
+        annotated_img = self._annotate(results, show_labels, log, timer) if annotate else None
         
         return {
+            "counts": counts,
+            "total_cells": counts["RBC"] + counts["WBC"],
             "detections": detections,
-            "count": len(detections),
             "annotated_image": annotated_img
         }
     
+    def predict_detection(self, image, conf=0.25, show_labels=True, logger=None, timer=None,
+                          annotate=True):
+        """
+        Predict blood cell detection with bounding boxes
+        Args:
+            image: PIL Image, numpy array, or file path (string)
+            conf: Confidence threshold
+            show_labels: Whether to show class labels on bounding boxes
+            logger: Logger instance for this request
+            timer: Optional StageTimer collecting the stage breakdown
+            annotate: Draw the annotated image (False leaves annotated_image None)
+        Returns:
+            dict with detection results
+        """
+        log = logger.info if logger else print
+        timer = timer or NULL_TIMER
+        
+        log(f"predict_detection called with conf={conf}")
+        log(f"Image type: {type(image)}")
+        
+        # Convert to file path or numpy array for YOLO
+        image = self._to_yolo_input(image, log)
+        
+        # Predict
+        log("Running YOLO detection...")
+        with self.model_loader.lease('detection') as model:
+            with timer.stage("inference"):
+                results = model.predict(image, conf=conf, verbose=False)[0]
+        log(f"Detection complete, found {len(results.boxes)} boxes")
+        
+        return self._format_detection(results, model, show_labels, log, timer, annotate)
+    
     # ==================== DETECTION COUNT ====================
     
-    def predict_detection_count(self, image, conf=0.25, show_labels=True, logger=None):
+    def predict_detection_count(self, image, conf=0.25, show_labels=True, logger=None, timer=None,
+                                annotate=True):
         """
         Predict and count RBC and WBC cells
         Args:
@@ -186,68 +591,87 @@ class BloodCellPredictor:
             conf: Confidence threshold
             show_labels: Whether to show class labels on bounding boxes
             logger: Logger instance for this request
+            timer: Optional StageTimer collecting the stage breakdown
+            annotate: Draw the annotated image (False leaves annotated_image None)
         Returns:
             dict with count results
         """
         log = logger.info if logger else print
+        timer = timer or NULL_TIMER
         
         log(f"predict_detection_count called with conf={conf}")
         log(f"Image type: {type(image)}")
         
-        # Get model
-        model = self.model_loader.get_detection_count_model()
-        log("Detection count model loaded")
-        
         # Convert to file path or numpy array for YOLO
-        if isinstance(image, Image.Image):
-            # Convert PIL to numpy
-            log(f"Converting PIL to numpy, size: {image.size}")
-            image = np.array(image)
-            log(f"Numpy array shape: {image.shape}")
+        image = self._to_yolo_input(image, log)
         
         # Predict
         log("Running YOLO cell counting...")
-        results = model.predict(image, conf=conf, verbose=False)[0]
+        with self.model_loader.lease('count') as model:
+            with timer.stage("inference"):
+                results = model.predict(image, conf=conf, verbose=False)[0]
         log(f"Detection complete, found {len(results.boxes)} cells")
         
-        # Count cells
-        counts = {"RBC": 0, "WBC": 0}
-        detections = []
-        
-        for i, box in enumerate(results.boxes):
-            log(f"Processing cell {i+1}/{len(results.boxes)}")
-            
-            # Fix: Extract scalar values from tensors
-            cls = int(box.cls.cpu().numpy()[0])
-            label = self.model_loader.detection_count_classes[cls]
-            confidence = float(box.conf.cpu().numpy()[0])
-            xyxy = box.xyxy[0].cpu().numpy().tolist()
+        return self._format_count(results, show_labels, log, timer, annotate)
+    
+    # ==================== BATCHED DETECTION ====================
+    
+    def predict_detection_batch(self, images, confs, show_labels, task='detection', loggers=None, timers=None,
+                                annotate=True):
+        """
+        Run detection or counting for several requests with one forward pass
+        Ultralytics letterboxes the images into a common batch tensor; the
+        batch runs at the lowest threshold and each request's own conf is
+        applied afterwards (NMS never lets a lower-score box suppress a
+        higher one, so this matches running each request alone).
+        Args:
+            images: List of PIL Images, numpy arrays, or file paths
+            confs: Confidence threshold per image
+            show_labels: Label flag per image
+            task: 'detection' or 'count'
+            loggers: Optional logger per image
+            timers: Optional StageTimer per image
+            annotate: Draw the annotated images, for all images or per image
+                (False leaves annotated_image None)
+        Returns:
+            list of dicts (same format as predict_detection / predict_detection_count),
+            with a RequestAborted in place of requests abandoned mid-batch
+        """
+        loggers = loggers or [None] * len(images)
+        timers = [timer or NULL_TIMER for timer in (timers or [None] * len(images))]
+        logs = [logger.info if logger else print for logger in loggers]
+        annotates = annotate if isinstance(annotate, (list, tuple)) else [annotate] * len(images)
+        
+        inputs = [self._to_yolo_input(image, log) for image, log in zip(images, logs)]
+        batch_conf = min(confs)
+        
+        with self.model_loader.lease(task) as model:
+            start = time.perf_counter()
+            batch_results = model.predict(inputs, conf=batch_conf, verbose=False)
+            inference_ms = (time.perf_counter() - start) * 1000
+        
+        outputs = []
+        for i, results in enumerate(batch_results):
+            log, timer = logs[i], timers[i]
+            log(f"Batched YOLO {task}: {len(inputs)} images in {inference_ms:.1f}ms (batch conf={batch_conf})")
+            timer.add("inference", inference_ms)
             
-            log(f"Cell {i+1}: {label}, confidence={confidence:.4f}")
+            # Apply this request's own threshold
+            keep = results.boxes.conf >= confs[i]
+            results = results[keep]
+            log(f"Detection complete, found {len(results.boxes)} boxes at conf={confs[i]}")
             
-            counts[label] += 1
-            detections.append({
-                "class": label,
-                "confidence": confidence,
-                "bbox": xyxy
-            })
-        
-        # Get annotated image (YOLO plot() returns RGB in recent versions)
-        # Control label display: labels=False hides class names, conf=False hides confidence scores
-        if show_labels:
-            annotated_img = results.plot()
-        else:
-            annotated_img = results.plot(labels=False, conf=False)
-        
-        log(f"Annotated image shape: {annotated_img.shape}")
-        log(f"Labels displayed: {show_labels}")
-        
-        return {
-            "counts": counts,
-            "total_cells": counts["RBC"] + counts["WBC"],
-            "detections": detections,
-            "annotated_image": annotated_img
-        }
+            try:
+                if task == 'detection':
+                    outputs.append(self._format_detection(results, model, show_labels[i], log, timer, annotates[i]))
+                else:
+                    outputs.append(self._format_count(results, show_labels[i], log, timer, annotates[i]))
+            except RequestAborted as e:
+                # One abandoned request must not fail the rest of the batch
+                log(f"Request abandoned after inference: {str(e)}")
+                outputs.append(e)
+        
+        return outputs
     
     # ==================== UTILITY FUNCTIONS ====================
     
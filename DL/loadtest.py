@@ -0,0 +1,449 @@
+"""
+Load Test - Replay recorded or synthetic traffic against a running DL server
+Produces latency-vs-throughput curves and saturation-point reports
+
+Usage:
+    # Open loop: sweep offered load using a trace exported by backend/exportTraffic.js
+    python loadtest.py --url http://localhost:8000 --trace traffic_trace.jsonl --rps 1,2,4,8 --duration 30
+
+    # Replay the trace's own arrival times, 20x faster
+    python loadtest.py --trace traffic_trace.jsonl --replay --speedup 20
+
+    # Closed loop with a synthetic mix
+    python loadtest.py --mix classification:0.6,count:0.3,detection:0.1 --closed-loop 1,4,16
+"""
+import argparse
+import asyncio
+import csv
+import io
+import json
+import random
+import time
+from collections import defaultdict
+from datetime import datetime
+
+import httpx
+from PIL import Image
+
+from benchmark import latency_summary
+from standins import synthetic_smear, CLASSIFIER_IDS
+
+
+TASK_PATHS = {
+    "classification": "/predict/classification",
+    "detection": "/predict/detection",
+    "count": "/predict/count"
+}
+
+
+def parse_weights(value, cast=str):
+    """
+    Parse 'a:0.6,b:0.4' into a {key: weight} dict
+    """
+    weights = {}
+    for part in value.split(','):
+        if not part.strip():
+            continue
+        key, _, weight = part.partition(':')
+        weights[cast(key.strip())] = float(weight) if weight else 1.0
+    return weights
+
+
+def weighted_choice(rng, weights):
+    keys = list(weights.keys())
+    return rng.choices(keys, weights=[weights[k] for k in keys], k=1)[0]
+
+
+# ==================== TRAFFIC SOURCES ====================
+
+class TraceTraffic:
+    """Traffic recorded from the backend's Upload collection (JSONL)"""
+
+    def __init__(self, path, task_mix=None):
+        """
+        Args:
+            path: JSONL trace file
+            task_mix: Optional task weights overriding the recorded tasks
+        """
+        self.records = []
+        with open(path, 'r', encoding='utf-8') as f:
+            for line in f:
+                if line.strip():
+                    self.records.append(json.loads(line))
+        if not self.records:
+            raise ValueError(f"Trace {path} is empty")
+        self.task_mix = task_mix
+        self._index = 0
+
+    def next_spec(self, rng):
+        record = self.records[self._index % len(self.records)]
+        self._index += 1
+        spec = dict(record)
+        # Only classifications are stored in Mongo, let the mix re-weight tasks
+        if self.task_mix:
+            spec["task"] = weighted_choice(rng, self.task_mix)
+        return spec
+
+    def arrival_offsets(self, speedup, duration):
+        """Recorded arrival times (seconds), compressed by speedup"""
+        offsets = []
+        for record in self.records:
+            offset = record.get("offset_s", 0.0) / speedup
+            if offset > duration:
+                break
+            offsets.append(offset)
+        return offsets
+
+
+class SyntheticTraffic:
+    """Traffic drawn from configured task/model/image-size mixes"""
+
+    def __init__(self, task_mix, model_mix, size_mix, conf):
+        self.task_mix = task_mix
+        self.model_mix = model_mix
+        self.size_mix = size_mix
+        self.conf = conf
+
+    def next_spec(self, rng):
+        size = weighted_choice(rng, self.size_mix)
+        return {
+            "task": weighted_choice(rng, self.task_mix),
+            "model_id": weighted_choice(rng, self.model_mix),
+            "conf": self.conf,
+            "width": size,
+            "height": size
+        }
+
+
+class PayloadCache:
+    """Encoded request bodies, cached by image source"""
+
+    def __init__(self, max_entries=256):
+        self.max_entries = max_entries
+        self._cache = {}
+
+    def image_bytes(self, spec):
+        key = spec.get("image") or (spec.get("width") or 640, spec.get("height") or 480)
+        if key not in self._cache:
+            if len(self._cache) >= self.max_entries:
+                self._cache.pop(next(iter(self._cache)))
+            if isinstance(key, str):
+                with open(key, 'rb') as f:
+                    self._cache[key] = f.read()
+            else:
+                buffered = io.BytesIO()
+                Image.fromarray(synthetic_smear(key[0], key[1], seed=key[0] * 7 + key[1])).save(
+                    buffered, format="JPEG", quality=90
+                )
+                self._cache[key] = buffered.getvalue()
+        return self._cache[key]
+
+    def request(self, spec, default_conf):
+        task = spec.get("task", "classification")
+        files = {"image": ("load.jpg", self.image_bytes(spec), "image/jpeg")}
+        if task == "classification":
+            data = {"model_id": spec.get("model_id") or "mobilenet-v2"}
+        else:
+            data = {"conf": str(spec.get("conf") or default_conf), "show_labels": "true"}
+        return TASK_PATHS[task], files, data
+
+
+# ==================== LOAD STEPS ====================
+
+class StepRecorder:
+    """Collect outcomes for one load step"""
+
+    def __init__(self):
+        self.latencies = []
+        self.by_task = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.dropped = 0
+        self.last_done = None
+
+    def record(self, task, scheduled, status):
+        done = time.perf_counter()
+        self.last_done = done
+        # Measure from the scheduled send time so queueing in the client is not hidden
+        latency = (done - scheduled) * 1000
+        if status == 200:
+            self.latencies.append(latency)
+            self.by_task[task].append(latency)
+        else:
+            self.errors[str(status)] += 1
+
+    def timed_out(self, count):
+        # Requests still unanswered when the step's drain timeout ran out
+        self.errors["timeout"] += count
+
+    def summary(self, started, duration):
+        completed = len(self.latencies)
+        failed = sum(self.errors.values())
+        elapsed = max((self.last_done or started) - started, duration)
+        result = {
+            "completed": completed,
+            "failed": failed,
+            "dropped": self.dropped,
+            "errors": dict(self.errors),
+            "elapsed_s": round(elapsed, 3),
+            "achieved_rps": round(completed / elapsed, 3) if elapsed else 0.0,
+            "error_rate": round(failed / max(completed + failed, 1), 4),
+            "tasks": {task: dict(count=len(v), **latency_summary(v)) for task, v in self.by_task.items()}
+        }
+        result.update(latency_summary(self.latencies))
+        return result
+
+
+async def send(client, payloads, spec, default_conf, scheduled, recorder):
+    path, files, data = payloads.request(spec, default_conf)
+    try:
+        response = await client.post(path, files=files, data=data)
+        status = response.status_code
+    except httpx.HTTPError as e:
+        status = type(e).__name__
+    recorder.record(spec.get("task", "classification"), scheduled, status)
+
+
+async def run_open_loop(client, traffic, payloads, args, offsets, rng):
+    """
+    Fire requests at fixed arrival offsets regardless of completions
+    Args:
+        offsets: Arrival times in seconds from the start of the step
+    """
+    recorder = StepRecorder()
+    in_flight = set()
+    started = time.perf_counter()
+
+    for offset in offsets:
+        scheduled = started + offset
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(in_flight) >= args.max_outstanding:
+            recorder.dropped += 1
+            continue
+        spec = traffic.next_spec(rng)
+        task = asyncio.create_task(send(client, payloads, spec, args.conf, scheduled, recorder))
+        in_flight.add(task)
+        task.add_done_callback(in_flight.discard)
+
+    if in_flight:
+        _, pending = await asyncio.wait(in_flight, timeout=args.drain_timeout)
+        if pending:
+            # Cancel stragglers so they neither go uncounted nor load the next step
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+            recorder.timed_out(sum(1 for task in pending if task.cancelled()))
+    return recorder.summary(started, offsets[-1] if offsets else 0.0)
+
+
+async def run_closed_loop(client, traffic, payloads, args, concurrency, rng):
+    """Keep a fixed number of requests outstanding for the step duration"""
+    recorder = StepRecorder()
+    started = time.perf_counter()
+    stop_at = started + args.duration
+
+    async def worker():
+        while time.perf_counter() < stop_at:
+            spec = traffic.next_spec(rng)
+            await send(client, payloads, spec, args.conf, time.perf_counter(), recorder)
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return recorder.summary(started, args.duration)
+
+
+def poisson_offsets(rng, rps, duration):
+    offsets = []
+    t = rng.expovariate(rps)
+    while t < duration:
+        offsets.append(t)
+        t += rng.expovariate(rps)
+    return offsets
+
+
+def constant_offsets(rps, duration):
+    return [i / rps for i in range(int(rps * duration))]
+
+
+# ==================== ANALYSIS ====================
+
+def find_saturation(curve, slo_ms, key):
+    """
+    Locate the saturation point on a latency-vs-throughput curve
+    Args:
+        curve: Step results ordered by increasing load
+        slo_ms: p99 latency objective
+        key: 'offered_rps' (open loop) or 'concurrency' (closed loop)
+    Returns:
+        dict describing the last healthy step and the peak throughput
+    """
+    last_ok = None
+    saturated_at = None
+    reason = None
+    previous = None
+
+    for step in curve:
+        p99 = step.get("p99_ms", float('inf'))
+        if key == "offered_rps" and step["achieved_rps"] < 0.95 * step["offered_rps"]:
+            reason = "achieved throughput fell below offered load"
+        elif step["error_rate"] > 0.01 or step["dropped"] > 0:
+            reason = "errors or client-side drops"
+        elif slo_ms and p99 > slo_ms:
+            reason = f"p99 {p99:.1f}ms exceeded SLO {slo_ms}ms"
+        elif key == "concurrency" and previous and step["achieved_rps"] < previous["achieved_rps"] * 1.05:
+            reason = "throughput stopped scaling with concurrency"
+        else:
+            reason = None
+
+        if reason:
+            saturated_at = step
+            break
+        last_ok = step
+        previous = step
+
+    peak = max(curve, key=lambda s: s["achieved_rps"]) if curve else None
+    return {
+        "max_sustainable": last_ok[key] if last_ok else None,
+        "max_sustainable_rps": last_ok["achieved_rps"] if last_ok else None,
+        "saturated_at": saturated_at[key] if saturated_at else None,
+        "reason": reason,
+        "peak_rps": peak["achieved_rps"] if peak else None
+    }
+
+
+# ==================== DRIVER ====================
+
+async def run_load_test(args):
+    rng = random.Random(args.seed)
+    task_mix = parse_weights(args.mix) if args.mix else None
+
+    if args.trace:
+        traffic = TraceTraffic(args.trace, task_mix=task_mix)
+    else:
+        traffic = SyntheticTraffic(
+            task_mix or {"classification": 1.0},
+            parse_weights(args.model_mix) if args.model_mix else {model_id: 1.0 for model_id in CLASSIFIER_IDS},
+            parse_weights(args.sizes, int),
+            args.conf
+        )
+
+    payloads = PayloadCache()
+    limits = httpx.Limits(max_connections=args.max_outstanding, max_keepalive_connections=args.max_outstanding)
+    curve = []
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        # Warm up the server (model caches, lazy allocations)
+        for _ in range(args.warmup):
+            await send(client, payloads, traffic.next_spec(rng), args.conf, time.perf_counter(), StepRecorder())
+
+        if args.closed_loop:
+            mode, key = "closed_loop", "concurrency"
+            for concurrency in [int(c) for c in args.closed_loop.split(',')]:
+                step = await run_closed_loop(client, traffic, payloads, args, concurrency, rng)
+                step["concurrency"] = concurrency
+                curve.append(step)
+                print(f"✓ concurrency={concurrency:<4d} {step['achieved_rps']:8.2f} rps  "
+                      f"p50={step.get('p50_ms', 0):8.1f}ms  p99={step.get('p99_ms', 0):8.1f}ms  "
+                      f"errors={step['failed']}")
+        elif args.replay:
+            mode, key = "replay", "offered_rps"
+            offsets = traffic.arrival_offsets(args.speedup, args.duration)
+            step = await run_open_loop(client, traffic, payloads, args, offsets, rng)
+            span = offsets[-1] if offsets and offsets[-1] > 0 else 1.0
+            step["offered_rps"] = round(len(offsets) / span, 3)
+            curve.append(step)
+            print(f"✓ replay x{args.speedup}: offered {step['offered_rps']:.2f} rps, "
+                  f"achieved {step['achieved_rps']:.2f} rps, p99={step.get('p99_ms', 0):.1f}ms")
+        else:
+            mode, key = "open_loop", "offered_rps"
+            for rps in [float(r) for r in args.rps.split(',')]:
+                if args.arrivals == "poisson":
+                    offsets = poisson_offsets(rng, rps, args.duration)
+                else:
+                    offsets = constant_offsets(rps, args.duration)
+                step = await run_open_loop(client, traffic, payloads, args, offsets, rng)
+                step["offered_rps"] = rps
+                curve.append(step)
+                print(f"✓ offered={rps:<7.2f} {step['achieved_rps']:8.2f} rps  "
+                      f"p50={step.get('p50_ms', 0):8.1f}ms  p99={step.get('p99_ms', 0):8.1f}ms  "
+                      f"errors={step['failed']} dropped={step['dropped']}")
+
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "url": args.url,
+        "mode": mode,
+        "config": {
+            "trace": args.trace,
+            "mix": args.mix,
+            "model_mix": args.model_mix,
+            "sizes": args.sizes,
+            "duration_s": args.duration,
+            "arrivals": args.arrivals,
+            "speedup": args.speedup,
+            "slo_ms": args.slo_ms,
+            "seed": args.seed,
+            "label": args.label
+        },
+        "curve": curve,
+        "saturation": find_saturation(curve, args.slo_ms, key)
+    }
+
+
+def write_curve_csv(report, path):
+    """Write the flat latency-vs-throughput curve (one row per step)"""
+    columns = ["offered_rps", "concurrency", "achieved_rps", "completed", "failed", "dropped",
+               "error_rate", "p50_ms", "p95_ms", "p99_ms", "mean_ms", "max_ms"]
+    with open(path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=columns, extrasaction='ignore')
+        writer.writeheader()
+        writer.writerows(report["curve"])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Load test the blood cell DL service")
+    parser.add_argument("--url", default="http://localhost:8000", help="DL server base URL")
+    parser.add_argument("--trace", default=None, help="JSONL trace from backend/exportTraffic.js")
+    parser.add_argument("--mix", default=None, help="Task mix, e.g. classification:0.6,count:0.3,detection:0.1")
+    parser.add_argument("--model-mix", default=None, help="Classifier mix, e.g. mobilenet-v2:0.7,resnet-50:0.3")
+    parser.add_argument("--sizes", default="640:1", help="Synthetic image size mix, e.g. 224:0.2,1280:0.8")
+    parser.add_argument("--rps", default="1,2,4,8", help="Open-loop offered load steps")
+    parser.add_argument("--arrivals", choices=["poisson", "constant"], default="poisson")
+    parser.add_argument("--closed-loop", default=None, help="Closed-loop concurrency steps, e.g. 1,4,16")
+    parser.add_argument("--replay", action="store_true", help="Replay the trace's recorded arrival times")
+    parser.add_argument("--speedup", type=float, default=1.0, help="Time compression for --replay")
+    parser.add_argument("--duration", type=float, default=30.0, help="Seconds per load step")
+    parser.add_argument("--conf", type=float, default=0.25, help="Detection confidence threshold")
+    parser.add_argument("--slo-ms", type=float, default=None, help="p99 latency objective for saturation")
+    parser.add_argument("--max-outstanding", type=int, default=256, help="Client-side in-flight limit")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Per-request timeout (seconds)")
+    parser.add_argument("--drain-timeout", type=float, default=120.0, help="Wait for stragglers after a step, then count them as timeout errors")
+    parser.add_argument("--warmup", type=int, default=3, help="Unmeasured warmup requests")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument("--label", default=None, help="Free-form label (e.g. the server settings under test)")
+    parser.add_argument("--output", default="loadtest_results.json", help="JSON report path")
+    parser.add_argument("--csv", default=None, help="Optional CSV path for the curve")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    if args.replay and not args.trace:
+        raise SystemExit("--replay requires --trace")
+
+    print("=" * 60)
+    print(f"Load testing {args.url}")
+    print("=" * 60)
+    report = asyncio.run(run_load_test(args))
+
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    if args.csv:
+        write_curve_csv(report, args.csv)
+
+    saturation = report["saturation"]
+    print("=" * 60)
+    print(f"Peak throughput: {saturation['peak_rps']} rps")
+    print(f"Max sustainable: {saturation['max_sustainable']} ({saturation['max_sustainable_rps']} rps)")
+    if saturation["saturated_at"] is not None:
+        print(f"Saturated at: {saturation['saturated_at']} - {saturation['reason']}")
+    print(f"✓ Report written to {args.output}")
@@ -3,27 +3,51 @@ FastAPI Server for Blood Cell Analysis
 Provides endpoints for classification, detection, and cell counting
 """
 import os
+import time
+# Measured from here so /health/startup can report the app import time
+MODULE_STARTED = time.perf_counter()
 # Force TensorFlow to use legacy Keras 2.x for compatibility with older models
 os.environ['TF_USE_LEGACY_KERAS'] = '1'
 
-from fastapi import FastAPI, File, UploadFile, HTTPException, Form
+from fastapi import FastAPI, File, UploadFile, HTTPException, Form, Header, Depends, Request, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import FileResponse
 from pydantic import BaseModel
 from typing import Optional, Dict
 from contextlib import asynccontextmanager
 import uvicorn
+import asyncio
+import threading
 import base64
-import io
-from PIL import Image
 
-from model_loader import ModelLoader
-from interface import BloodCellPredictor
 from logger_config import logger_manager
+from profiler import NULL_TIMER, sampling_profiler
+from startup import StartupTracker
+from coalescing import SingleFlight, request_key
+from deadlines import RequestContext, RequestAborted
+from executors import INTERACTIVE
+from streaming import CountStream, CellTracker, StreamStats, FRAME_LOGGER
+from serialization import (FastJSONResponse, CompressionMiddleware, compression_settings, serialization_stats,
+                           format_boxes, BOX_FORMATS)
 
 # Global variables for models and predictor
 model_loader = None
 predictor = None
+topology = None  # Classification/detection worker pools (in-process serving)
+batchers = {}  # Task -> DetectionBatcher for the YOLO models (in-process serving)
+decoder = None  # ImageDecoder for uploads (see decoding.py)
+stream_stats = StreamStats()  # Live counting sessions (see streaming.py)
+registry = None  # ModelRegistry for hot model reloads (in-process serving)
+
+# 'eager' loads models before the server listens, 'lazy' loads them in the background
+STARTUP_MODE = os.environ.get('DL_STARTUP_MODE', 'eager').lower()
+startup = StartupTracker(STARTUP_MODE, started=MODULE_STARTED)
+
+# Deadline applied when a request does not bring its own (unset = none)
+DEFAULT_DEADLINE_MS = float(os.environ.get('DL_DEFAULT_DEADLINE_MS', '0')) or None
+
+# Identical concurrent predictions share one computation (DL_COALESCING=0 disables)
+single_flight = SingleFlight(enabled=os.environ.get('DL_COALESCING', '1') != '0')
 
 
 # Pydantic models for request/response
@@ -32,35 +56,103 @@ class PredictRequest(BaseModel):
     task: str  # 'classification', 'detection', or 'count'
     model_id: Optional[str] = 'mobilenet-v2'  # For classification task
     conf: Optional[float] = 0.25  # Confidence threshold for detection tasks
+    tta: Optional[int] = 0  # Test-time augmentation views for classification (0 = off)
+    deadline_ms: Optional[float] = None  # Time budget; abandoned with 504 when exceeded
+    priority: Optional[str] = None  # 'interactive' (default) or 'bulk'
+    box_format: Optional[str] = 'objects'  # Detections as 'objects' or compact 'columnar' lists
 
 
 # ==================== LIFESPAN HANDLER ====================
 
+def load_models():
+    """Import the frameworks, load every model and build the predictor"""
+    global model_loader, predictor, topology, batchers, decoder, registry
+    
+    startup.mark_loading()
+    try:
+        with startup.stage("import_frameworks"):
+            # Imported here so the server can listen (and HTTP workers that
+            # never load models can run) without TensorFlow/torch
+            from model_loader import ModelLoader
+            from interface import BloodCellPredictor
+            from executors import ExecutionTopology
+            from batching import build_batchers
+            from decoding import build_decoder
+            from similarity import build_similarity_index
+            from registry import build_registry
+        
+        with startup.stage("configure_threads"):
+            topology = ExecutionTopology.from_env()
+            topology.configure_frameworks()
+        
+        with startup.stage("load_models"):
+            loader = ModelLoader(models_dir="models")
+            # Each pool loads its own models so framework threads inherit its CPU affinity
+            topology.load_models(loader)
+        
+        with startup.stage("build_predictor"):
+            new_predictor = BloodCellPredictor(loader, similarity=build_similarity_index())
+            new_batchers = build_batchers(new_predictor, topology)
+            new_registry = build_registry(loader, topology, new_predictor, new_batchers)
+        
+        with startup.stage("build_decoder"):
+            new_decoder = build_decoder()
+        
+        # Publish the predictor last so requests never see a half-built service
+        model_loader = loader
+        batchers = new_batchers
+        decoder = new_decoder
+        registry = new_registry
+        predictor = new_predictor
+        startup.mark_ready()
+        print(f"✓ API ready to serve predictions! (startup {startup.ready_ms / 1000:.1f}s)")
+        print("=" * 60)
+    except Exception as e:
+        startup.mark_failed(e)
+        print(f"✗ Error during startup: {str(e)}")
+        print("⚠ API started but models may not be loaded properly")
+        print("=" * 60)
+
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     """Load models on startup and cleanup on shutdown"""
-    global model_loader, predictor
-    
+    global decoder
     # Startup
     print("=" * 60)
     print("Starting Blood Cell Analysis API...")
     print("=" * 60)
+    startup.add("import_app", startup.elapsed_ms())
     
-    try:
-        model_loader = ModelLoader(models_dir="models")
-        model_loader.load_all_models()
-        predictor = BloodCellPredictor(model_loader)
-        print("✓ API ready to serve predictions!")
-        print("=" * 60)
-    except Exception as e:
-        print(f"✗ Error during startup: {str(e)}")
-        print("⚠ API started but models may not be loaded properly")
+    if predictor is not None:
+        # Models were provided by the serving supervisor (see serve.py)
+        from decoding import build_decoder
+        with startup.stage("build_decoder"):
+            decoder = build_decoder()
+        startup.mark_ready()
+        print(f"✓ Worker {os.getpid()} using shared models from the inference broker")
         print("=" * 60)
+    elif startup.mode == 'lazy':
+        threading.Thread(target=load_models, name="model-loader", daemon=True).start()
+        print("✓ Lazy startup: listening now, models load in the background (see /health/ready)")
+    else:
+        load_models()
+    startup.mark_listening()
     
     yield
     
     # Shutdown
     print("\nShutting down Blood Cell Analysis API...")
+    for batcher in batchers.values():
+        batcher.shutdown()
+    if registry is not None:
+        registry.shutdown()
+    if topology is not None:
+        topology.shutdown()
+    if decoder is not None:
+        decoder.shutdown()
+    if getattr(predictor, 'similarity', None) is not None:
+        predictor.similarity.save_all()
 
 
 # Initialize FastAPI app with lifespan handler
@@ -68,7 +160,8 @@ app = FastAPI(
     title="Blood Cell Analysis API",
     description="Deep Learning API for blood cell classification, detection, and counting",
     version="1.0.0",
-    lifespan=lifespan
+    lifespan=lifespan,
+    default_response_class=FastJSONResponse
 )
 
 # Add CORS middleware
@@ -80,6 +173,123 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Compress responses with the best encoding the client accepts (DL_COMPRESSION)
+compression = compression_settings()
+if compression is not None:
+    app.add_middleware(CompressionMiddleware, **compression)
+
+
+async def request_context(
+    request: Request,
+    x_request_deadline_ms: Optional[float] = Header(None),
+    x_request_priority: Optional[str] = Header(None)
+):
+    """
+    Per-request deadline, priority class and client-disconnect watcher, used as the stage timer
+    The deadline comes from the X-Request-Deadline-Ms header (a deadline_ms
+    field overrides it) or DL_DEFAULT_DEADLINE_MS. The priority class comes
+    from the X-Request-Priority header (a priority field overrides it).
+    """
+    context = RequestContext(deadline_ms=x_request_deadline_ms or DEFAULT_DEADLINE_MS)
+    set_request_options(context, priority=x_request_priority)
+    context.watch(request)
+    try:
+        yield context
+    finally:
+        context.close()
+
+
+def set_request_options(context, deadline_ms=None, priority=None):
+    """Apply per-request deadline/priority overrides, rejecting unknown priority classes"""
+    context.set_deadline(deadline_ms)
+    try:
+        context.set_priority(priority)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+def check_box_format(box_format):
+    """Reject unknown detection encodings with 400"""
+    if box_format not in BOX_FORMATS:
+        raise HTTPException(status_code=400, detail=f"Unknown box_format: {box_format}. Use one of {BOX_FORMATS}")
+
+
+async def run_inference(task, fn, *args, priority=INTERACTIVE, **kwargs):
+    """
+    Run a predictor call off the event loop, on the pool that owns the task
+    Args:
+        task: 'classification', 'detection' or 'count'
+        fn: Predictor method to call
+        priority: Scheduling class in the pool, 'interactive' or 'bulk'
+    Returns:
+        The predictor method's result
+    """
+    if topology is None:
+        # Remote predictor (serve.py) - the broker schedules by the context's priority
+        return await asyncio.to_thread(fn, *args, **kwargs)
+    return await topology.run_as(task, priority, fn, *args, **kwargs)
+
+
+async def run_detection(task, image, conf=0.25, show_labels=True, logger=None, timer=None, priority=INTERACTIVE,
+                        annotate=True):
+    """
+    Run YOLO detection or counting, batched with concurrent requests when enabled
+    Args:
+        task: 'detection' or 'count'
+        image: PIL Image
+        priority: Scheduling class, 'interactive' or 'bulk'
+        annotate: Draw the annotated image (False leaves annotated_image None)
+    Returns:
+        The same result as predict_detection / predict_detection_count
+    """
+    if task in batchers:
+        return await asyncio.wrap_future(
+            batchers[task].submit(image, conf=conf, show_labels=show_labels, logger=logger, timer=timer,
+                                  priority=priority, annotate=annotate)
+        )
+    method = predictor.predict_detection if task == 'detection' else predictor.predict_detection_count
+    return await run_inference(task, method, image, conf=conf, show_labels=show_labels, logger=logger,
+                               timer=timer, priority=priority, annotate=annotate)
+
+
+async def run_coalesced(key, fn, *args, logger=None, timer=NULL_TIMER, **kwargs):
+    """
+    Run an inference helper, sharing it with identical in-flight requests
+    The computation runs in the timer's priority class; only requests of
+    the same class share one, so interactive work never waits on a bulk one.
+    Args:
+        key: Coalescing key (see coalescing.request_key)
+        fn: run_inference or run_detection
+    Returns:
+        The helper's result (a private copy for dict results)
+    """
+    start = time.perf_counter()
+    priority = getattr(timer, 'priority', INTERACTIVE)
+    try:
+        result, coalesced = await single_flight.run(
+            key + (priority,), lambda: fn(*args, logger=logger, timer=timer, priority=priority, **kwargs)
+        )
+    except RequestAborted:
+        if getattr(timer, 'aborted', None):
+            raise
+        # The request that started the shared computation was abandoned - run our own
+        return await fn(*args, logger=logger, timer=timer, priority=priority, **kwargs)
+    if coalesced:
+        timer.add("coalesced_wait", (time.perf_counter() - start) * 1000)
+        if logger:
+            logger.info("Coalesced with an identical in-flight request, reusing its result")
+    return result
+
+
+def pool_stats():
+    """Worker pool split, utilization, batching and similarity index (local or from the inference broker)"""
+    if topology is not None:
+        return dict(topology.stats(), batching={task: b.stats() for task, b in batchers.items()},
+                    similarity=predictor.similarity.stats() if predictor and predictor.similarity else None)
+    if hasattr(predictor, 'pool_stats'):
+        return predictor.pool_stats()
+    return None
+
 
 # ==================== ENDPOINTS ====================
 
@@ -93,7 +303,7 @@ async def get_available_models():
     if model_loader is None:
         raise HTTPException(status_code=503, detail="Models not loaded")
     
-    return JSONResponse(content={
+    return FastJSONResponse(content={
         "success": True,
         "models": {
             "classification": model_loader.get_available_classification_models(),
@@ -103,6 +313,72 @@ async def get_available_models():
     })
 
 
+@app.get("/health/live")
+async def health_live():
+    """
+    Liveness probe - answers as soon as the server is listening
+    Returns:
+        Process id and startup state
+    """
+    return FastJSONResponse(content={
+        "status": "alive",
+        "pid": os.getpid(),
+        "startup_state": startup.state
+    })
+
+
+@app.get("/health/ready")
+async def health_ready():
+    """
+    Readiness probe - 503 until the models are loaded
+    Returns:
+        Startup state (and error, if loading failed)
+    """
+    ready = startup.ready and predictor is not None
+    return FastJSONResponse(
+        status_code=200 if ready else 503,
+        content={
+            "status": "ready" if ready else startup.state,
+            "current_phase": startup.current_phase,
+            "error": startup.error
+        }
+    )
+
+
+@app.get("/health/startup")
+async def health_startup():
+    """
+    Startup time breakdown
+    Returns:
+        Startup mode, state, per-phase timings and milestones
+    """
+    return FastJSONResponse(content={
+        "success": True,
+        "startup": startup.summary()
+    })
+
+
+@app.get("/metrics")
+async def get_metrics():
+    """
+    Runtime metrics for the inference service
+    Returns:
+        Worker pool resource split, utilization, YOLO batching, request coalescing, image decoding,
+        live counting streams and response serialization/compression
+    """
+    # Off the event loop: under serve.py this waits on the inference broker
+    pools = await asyncio.to_thread(pool_stats)
+    return FastJSONResponse(content={
+        "success": True,
+        "pid": os.getpid(),
+        "pools": pools,
+        "coalescing": single_flight.stats(),
+        "decoding": decoder.stats() if decoder is not None else None,
+        "streaming": stream_stats.stats(),
+        "serialization": serialization_stats.stats()
+    })
+
+
 @app.get("/logs")
 async def list_logs():
     """
@@ -132,7 +408,7 @@ async def list_logs():
     # Sort by creation time (newest first)
     log_files.sort(key=lambda x: x['created'], reverse=True)
     
-    return JSONResponse(content={
+    return FastJSONResponse(content={
         "success": True,
         "total_logs": len(log_files),
         "logs": log_files
@@ -164,7 +440,7 @@ async def get_log_content(filename: str):
         with open(filepath, 'r', encoding='utf-8') as f:
             content = f.read()
         
-        return JSONResponse(content={
+        return FastJSONResponse(content={
             "success": True,
             "filename": filename,
             "content": content
@@ -184,7 +460,7 @@ async def cleanup_old_logs(days: int = 7):
     """
     try:
         deleted_count = logger_manager.cleanup_old_logs(days)
-        return JSONResponse(content={
+        return FastJSONResponse(content={
             "success": True,
             "message": f"Cleaned up {deleted_count} log file(s) older than {days} days",
             "deleted_count": deleted_count
@@ -193,24 +469,211 @@ async def cleanup_old_logs(days: int = 7):
         raise HTTPException(status_code=500, detail=f"Error cleaning up logs: {str(e)}")
 
 
+# ==================== ADMIN ====================
+
+def process_memory():
+    """
+    Memory usage of this process from /proc (Linux)
+    Returns:
+        dict with RSS, PSS and USS (private) in MB
+    """
+    fields = {}
+    try:
+        with open('/proc/self/smaps_rollup') as f:
+            for line in f:
+                parts = line.split()
+                if len(parts) >= 2 and parts[0].endswith(':') and parts[1].isdigit():
+                    fields[parts[0][:-1]] = int(parts[1]) / 1024  # kB -> MB
+    except OSError:
+        return {}
+    
+    return {
+        "rss_mb": round(fields.get("Rss", 0.0), 1),
+        "pss_mb": round(fields.get("Pss", 0.0), 1),
+        "uss_mb": round(fields.get("Private_Clean", 0.0) + fields.get("Private_Dirty", 0.0), 1),
+        "shared_mb": round(fields.get("Shared_Clean", 0.0) + fields.get("Shared_Dirty", 0.0), 1)
+    }
+
+
+@app.get("/admin/memory")
+async def get_memory():
+    """
+    Memory usage of the worker process that served this request
+    Returns:
+        pid and RSS/PSS/USS figures
+    """
+    return FastJSONResponse(content={
+        "success": True,
+        "pid": os.getpid(),
+        "memory": process_memory()
+    })
+
+
+# ==================== MODEL REGISTRY ====================
+
+def registry_call(action, **kwargs):
+    """Run a model registry action here or in the inference broker"""
+    if registry is not None:
+        return getattr(registry, action)(**kwargs)
+    if hasattr(predictor, 'registry_call'):
+        return predictor.registry_call(action, **kwargs)
+    raise HTTPException(status_code=503, detail="Models not loaded")
+
+
+@app.get("/admin/models")
+async def get_model_versions():
+    """
+    Served model versions, reloads in progress and replaced versions still draining
+    Returns:
+        Registry state (see registry.py)
+    """
+    stats = await asyncio.to_thread(registry_call, 'stats')
+    return FastJSONResponse(content={"success": True, **stats})
+
+
+@app.post("/admin/models/reload")
+async def reload_models(model_id: Optional[str] = None, version: Optional[str] = None,
+                        file: Optional[str] = None):
+    """
+    Hot-reload models without restarting
+    The new version loads and warms up in the background, then replaces the
+    current one; requests already running finish on the old version.
+    Args:
+        model_id: Model to reload (classification model id, 'detection' or 'count');
+            omitted = reload every model whose version differs from models/registry.json
+        version: Version label for model_id (default: the manifest's)
+        file: Model file name in models/ for model_id (default: the manifest's or current file);
+            absolute paths, '..' and sub-directories are rejected with 400
+    Returns:
+        The reloads started (progress in GET /admin/models)
+    """
+    try:
+        if model_id:
+            started = [await asyncio.to_thread(registry_call, 'reload', key=model_id, version=version,
+                                               filename=file)]
+        else:
+            started = await asyncio.to_thread(registry_call, 'check_manifest')
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return FastJSONResponse(status_code=202, content={"success": True, "started": started})
+
+
+# ==================== PROFILING ====================
+
+@app.get("/admin/profile")
+async def capture_profile(seconds: float = 10.0, interval_ms: float = 5.0,
+                          include_idle: bool = False, ops: bool = True):
+    """
+    Capture a sampling profile of live traffic
+    Under serve.py the capture runs in the inference broker, where the models run.
+    Args:
+        seconds: Capture duration (max 120)
+        interval_ms: Milliseconds between stack samples
+        include_idle: Keep stacks of threads that are parked waiting
+        ops: Also record TensorFlow/torch op-level timings
+    Returns:
+        Collapsed-stack file (flamegraph.pl / speedscope compatible)
+    """
+    if seconds <= 0 or seconds > 120:
+        raise HTTPException(status_code=400, detail="seconds must be between 0 and 120")
+    # In-process serving samples this process, serve.py workers ask the broker,
+    # which rejects a capture while one from any worker is running
+    capture_fn = getattr(predictor, 'capture_profile', None)
+    if capture_fn is None:
+        if sampling_profiler.busy:
+            raise HTTPException(status_code=409, detail="A profile capture is already running")
+        capture_fn = sampling_profiler.capture
+    try:
+        # Sample from a worker thread so the event loop keeps serving traffic
+        capture = await asyncio.to_thread(
+            capture_fn,
+            seconds=seconds,
+            interval=interval_ms / 1000.0,
+            include_idle=include_idle,
+            ops=ops
+        )
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    
+    return FileResponse(
+        os.path.join(sampling_profiler.profiles_dir, capture['filename']),
+        media_type="text/plain",
+        filename=capture['filename'],
+        headers={
+            "X-Profile-Samples": str(capture['samples']),
+            "X-Profile-Artifacts": ",".join(capture['artifacts'].values())
+        }
+    )
+
+
+@app.get("/admin/profiles")
+async def list_profiles():
+    """
+    List captured profiles and op-level artifacts
+    Returns:
+        List of profile artifact names
+    """
+    profiles = sampling_profiler.list_profiles()
+    return FastJSONResponse(content={
+        "success": True,
+        "total_profiles": len(profiles),
+        "profiles": profiles
+    })
+
+
+@app.get("/admin/profiles/{filename}")
+async def get_profile(filename: str):
+    """
+    Download a captured profile artifact
+    Args:
+        filename: Name of the profile file
+    Returns:
+        Profile file content
+    """
+    # Security check - prevent directory traversal
+    if '/' in filename or '\\' in filename or filename.startswith('.'):
+        raise HTTPException(status_code=400, detail="Invalid filename")
+    
+    filepath = os.path.join(sampling_profiler.profiles_dir, filename)
+    if not os.path.isfile(filepath):
+        raise HTTPException(status_code=404, detail="Profile not found")
+    
+    # TensorFlow op profiles are zipped TensorBoard trace directories
+    media_type = "application/zip" if filename.endswith('.zip') else "text/plain"
+    return FileResponse(filepath, media_type=media_type, filename=filename)
+
+
 @app.post("/predict/classification")
 async def predict_classification(
     image: UploadFile = File(...),
-    model_id: str = Form('mobilenet-v2')
+    model_id: str = Form('mobilenet-v2'),
+    tta: int = Form(0),
+    deadline_ms: Optional[float] = Form(None),
+    priority: Optional[str] = Form(None),
+    profile: bool = False,
+    context: RequestContext = Depends(request_context)
 ):
     """
     Classify blood cell type
     Args:
         image: Uploaded image file
         model_id: Classification model to use (resnet-50, densenet-121, mobilenet-v2, efficientnet-b0, cnn)
+        tta: Test-time augmentation views (2-8 flips/rotations in one forward pass, 0 = off)
+        deadline_ms: Time budget in ms (or X-Request-Deadline-Ms header); 504 when exceeded
+        priority: 'interactive' (default) or 'bulk' (or X-Request-Priority header)
+        profile: Attach a stage-timing breakdown to the response (?profile=1)
     Returns:
         Prediction results with cell type and confidence
     """
     # Create unique logger for this request
     logger, log_filename = logger_manager.create_logger('classification', model_id)
+    set_request_options(context, deadline_ms, priority)
+    timer = context
     
     logger.info(f"Endpoint: POST /predict/classification")
     logger.info(f"Model ID: {model_id}")
+    if tta > 1:
+        logger.info(f"TTA views: {tta}")
     logger.info(f"Image filename: {image.filename}")
     logger.info(f"Image content type: {image.content_type}")
     
@@ -221,15 +684,21 @@ async def predict_classification(
     try:
         # Read image
         logger.info("Step 1: Reading image bytes...")
-        image_bytes = await image.read()
+        with timer.stage("read_upload"):
+            image_bytes = await image.read()
         logger.info(f"Step 1: Read {len(image_bytes)} bytes")
         
-        logger.info("Step 2: Preprocessing upload...")
-        pil_image = predictor.preprocess_upload(image_bytes, logger=logger)
+        logger.info("Step 2: Decoding upload...")
+        pil_image = await decoder.decode_async(image_bytes, draft_size=predictor.IMG_SIZE, timer=timer)
+        logger.info(f"Decoded image, size: {pil_image.size}")
         
         # Predict
         logger.info("Step 3: Running classification prediction...")
-        result = predictor.predict_classification(pil_image, model_id=model_id, logger=logger)
+        result = await context.run(run_coalesced(
+            request_key('classification', image_bytes, model_id=model_id, tta=tta),
+            run_inference, 'classification', predictor.predict_classification,
+            pil_image, model_id=model_id, tta=tta, logger=logger, timer=timer
+        ))
         
         logger.info("SUCCESS: Classification complete!")
         logger.info(f"Result: {result['predicted_class']} ({result['confidence']:.2%})")
@@ -238,13 +707,21 @@ async def predict_classification(
         
         # Add log filename to response
         result['log_file'] = log_filename
+        if profile:
+            result['profile'] = timer.summary()
         
-        return JSONResponse(content={
+        return FastJSONResponse(content={
             "success": True,
             "task": "classification",
             "result": result
         })
     
+    except RequestAborted as e:
+        # Deadline passed or client went away - remaining stages were skipped
+        logger.warning(f"Request abandoned: {str(e)}")
+        logger.info("="*60)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    
     except Exception as e:
         logger.error(f"Classification failed: {str(e)}")
         logger.error(f"Exception type: {type(e).__name__}")
@@ -258,7 +735,12 @@ async def predict_classification(
 async def predict_detection(
     image: UploadFile = File(...),
     conf: float = Form(0.25),
-    show_labels: bool = Form(True)
+    show_labels: bool = Form(True),
+    box_format: str = Form('objects'),
+    deadline_ms: Optional[float] = Form(None),
+    priority: Optional[str] = Form(None),
+    profile: bool = False,
+    context: RequestContext = Depends(request_context)
 ):
     """
     Detect blood cells with bounding boxes
@@ -266,11 +748,18 @@ async def predict_detection(
         image: Uploaded image file
         conf: Confidence threshold
         show_labels: Whether to show class labels and confidence on bounding boxes (default: True)
+        box_format: 'objects' (one dict per box, default) or 'columnar' (one list per field)
+        deadline_ms: Time budget in ms (or X-Request-Deadline-Ms header); 504 when exceeded
+        priority: 'interactive' (default) or 'bulk' (or X-Request-Priority header)
+        profile: Attach a stage-timing breakdown to the response (?profile=1)
     Returns:
         Detection results with bounding boxes and annotated image
     """
     # Create unique logger for this request
     logger, log_filename = logger_manager.create_logger('detection')
+    set_request_options(context, deadline_ms, priority)
+    check_box_format(box_format)
+    timer = context
     
     logger.info(f"Endpoint: POST /predict/detection")
     logger.info(f"Confidence threshold: {conf}")
@@ -285,36 +774,52 @@ async def predict_detection(
     try:
         # Read image
         logger.info("Step 1: Reading image bytes...")
-        image_bytes = await image.read()
+        with timer.stage("read_upload"):
+            image_bytes = await image.read()
         logger.info(f"Step 1: Read {len(image_bytes)} bytes")
         
-        logger.info("Step 2: Preprocessing upload...")
-        pil_image = predictor.preprocess_upload(image_bytes, logger=logger)
+        logger.info("Step 2: Decoding upload...")
+        pil_image = await decoder.decode_async(image_bytes, timer=timer)
+        logger.info(f"Decoded image, size: {pil_image.size}")
         
         # Predict
         logger.info("Step 3: Running detection prediction...")
-        result = predictor.predict_detection(pil_image, conf=conf, show_labels=show_labels, logger=logger)
+        result = await context.run(run_coalesced(
+            request_key('detection', image_bytes, conf=conf, show_labels=show_labels),
+            run_detection, 'detection', pil_image, conf=conf, show_labels=show_labels, logger=logger, timer=timer
+        ))
         
         # Convert annotated image to base64
         logger.info("Step 4: Converting annotated image to base64...")
-        annotated_base64 = predictor.image_to_base64(result['annotated_image'])
+        with timer.stage("encode_image"):
+            annotated_base64 = predictor.image_to_base64(result['annotated_image'])
         
         logger.info("SUCCESS: Detection complete!")
         logger.info(f"Result: Found {result['count']} detections")
         logger.info(f"Log saved to: logs/{log_filename}")
         logger.info("="*60)
         
-        return JSONResponse(content={
+        response_result = {
+            "detections": format_boxes(result['detections'], box_format),
+            "count": result['count'],
+            "annotated_image": annotated_base64,
+            "log_file": log_filename
+        }
+        if profile:
+            response_result['profile'] = timer.summary()
+        
+        return FastJSONResponse(content={
             "success": True,
             "task": "detection",
-            "result": {
-                "detections": result['detections'],
-                "count": result['count'],
-                "annotated_image": annotated_base64,
-                "log_file": log_filename
-            }
+            "result": response_result
         })
     
+    except RequestAborted as e:
+        # Deadline passed or client went away - remaining stages were skipped
+        logger.warning(f"Request abandoned: {str(e)}")
+        logger.info("="*60)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    
     except Exception as e:
         logger.error(f"Detection failed: {str(e)}")
         logger.error(f"Exception type: {type(e).__name__}")
@@ -328,7 +833,12 @@ async def predict_detection(
 async def predict_count(
     image: UploadFile = File(...),
     conf: float = Form(0.25),
-    show_labels: bool = Form(True)
+    show_labels: bool = Form(True),
+    box_format: str = Form('objects'),
+    deadline_ms: Optional[float] = Form(None),
+    priority: Optional[str] = Form(None),
+    profile: bool = False,
+    context: RequestContext = Depends(request_context)
 ):
     """
     Count RBC and WBC cells
@@ -336,11 +846,18 @@ async def predict_count(
         image: Uploaded image file
         conf: Confidence threshold
         show_labels: Whether to show class labels and confidence on bounding boxes (default: True)
+        box_format: 'objects' (one dict per box, default) or 'columnar' (one list per field)
+        deadline_ms: Time budget in ms (or X-Request-Deadline-Ms header); 504 when exceeded
+        priority: 'interactive' (default) or 'bulk' (or X-Request-Priority header)
+        profile: Attach a stage-timing breakdown to the response (?profile=1)
     Returns:
         Cell counts and annotated image
     """
     # Create unique logger for this request
     logger, log_filename = logger_manager.create_logger('count')
+    set_request_options(context, deadline_ms, priority)
+    check_box_format(box_format)
+    timer = context
     
     logger.info(f"Endpoint: POST /predict/count")
     logger.info(f"Confidence threshold: {conf}")
@@ -355,37 +872,53 @@ async def predict_count(
     try:
         # Read image
         logger.info("Step 1: Reading image bytes...")
-        image_bytes = await image.read()
+        with timer.stage("read_upload"):
+            image_bytes = await image.read()
         logger.info(f"Step 1: Read {len(image_bytes)} bytes")
         
-        logger.info("Step 2: Preprocessing upload...")
-        pil_image = predictor.preprocess_upload(image_bytes, logger=logger)
+        logger.info("Step 2: Decoding upload...")
+        pil_image = await decoder.decode_async(image_bytes, timer=timer)
+        logger.info(f"Decoded image, size: {pil_image.size}")
         
         # Predict
         logger.info("Step 3: Running cell counting...")
-        result = predictor.predict_detection_count(pil_image, conf=conf, show_labels=show_labels, logger=logger)
+        result = await context.run(run_coalesced(
+            request_key('count', image_bytes, conf=conf, show_labels=show_labels),
+            run_detection, 'count', pil_image, conf=conf, show_labels=show_labels, logger=logger, timer=timer
+        ))
         
         # Convert annotated image to base64
         logger.info("Step 4: Converting annotated image to base64...")
-        annotated_base64 = predictor.image_to_base64(result['annotated_image'])
+        with timer.stage("encode_image"):
+            annotated_base64 = predictor.image_to_base64(result['annotated_image'])
         
         logger.info("SUCCESS: Cell counting complete!")
         logger.info(f"Result: RBC: {result['counts']['RBC']}, WBC: {result['counts']['WBC']}")
         logger.info(f"Log saved to: logs/{log_filename}")
         logger.info("="*60)
         
-        return JSONResponse(content={
+        response_result = {
+            "counts": result['counts'],
+            "total_cells": result['total_cells'],
+            "detections": format_boxes(result['detections'], box_format),
+            "annotated_image": annotated_base64,
+            "log_file": log_filename
+        }
+        if profile:
+            response_result['profile'] = timer.summary()
+        
+        return FastJSONResponse(content={
             "success": True,
             "task": "count",
-            "result": {
-                "counts": result['counts'],
-                "total_cells": result['total_cells'],
-                "detections": result['detections'],
-                "annotated_image": annotated_base64,
-                "log_file": log_filename
-            }
+            "result": response_result
         })
     
+    except RequestAborted as e:
+        # Deadline passed or client went away - remaining stages were skipped
+        logger.warning(f"Request abandoned: {str(e)}")
+        logger.info("="*60)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    
     except Exception as e:
         logger.error(f"Cell counting failed: {str(e)}")
         logger.error(f"Exception type: {type(e).__name__}")
@@ -395,63 +928,236 @@ async def predict_count(
         raise HTTPException(status_code=500, detail=f"Cell counting failed: {str(e)}")
 
 
+@app.websocket("/ws/count")
+async def stream_count(
+    websocket: WebSocket,
+    conf: float = 0.25,
+    track: bool = True,
+    iou: float = 0.3,
+    min_hits: int = 2,
+    max_missed: int = 5,
+    boxes: bool = False,
+    max_latency_ms: float = 1000
+):
+    """
+    Live RBC/WBC counting for a stream of microscope frames
+    The client sends each frame as a binary message (JPEG/PNG bytes). When
+    inference falls behind, only the newest waiting frame is processed and
+    frames older than max_latency_ms are dropped, so results never lag the
+    camera by more than about one inference plus max_latency_ms. Each
+    processed frame gets one JSON text message; a text message
+    {"type": "reset"} restarts the distinct-cell totals.
+    Args:
+        conf: Confidence threshold
+        track: Track cells across frames and report distinct-cell totals
+        iou: Minimum IoU for a detection to continue a track
+        min_hits: Frames a track needs before it is counted
+        max_missed: Processed frames a track survives without a match
+        boxes: Include [class, confidence, x1, y1, x2, y2(, track_id)] per detection
+        max_latency_ms: Frame age limit (0 = no limit)
+    Returns:
+        Messages {"type": "counts", "frame", "counts", "total_cells", "skipped",
+        "latency_ms"(, "new", "distinct", "detections")} or {"type": "error", "frame", "detail"}
+    """
+    await websocket.accept()
+    if predictor is None:
+        await websocket.close(code=1013, reason="Models not loaded")  # Try Again Later
+        return
+    
+    # One log file per session; frames are not logged individually
+    logger, log_filename = logger_manager.create_logger('stream')
+    logger.info(f"Endpoint: WS /ws/count")
+    logger.info(f"Confidence threshold: {conf}, tracking: {track}, max latency: {max_latency_ms}ms")
+    
+    async def decode(data, timer):
+        return await decoder.decode_async(data, timer=timer)
+    
+    async def detect(image, conf, timer):
+        return await run_detection('count', image, conf=conf, show_labels=False, logger=FRAME_LOGGER,
+                                   timer=timer, annotate=False)
+    
+    session = CountStream(
+        websocket, decode, detect, conf=conf, max_latency_ms=max_latency_ms,
+        tracker=CellTracker(iou, max_missed, min_hits) if track else None,
+        boxes=boxes, logger=logger
+    )
+    stream_stats.opened()
+    try:
+        await session.run()
+    finally:
+        stream_stats.closed(session)
+        logger.info(f"Log saved to: logs/{log_filename}")
+        logger.info("="*60)
+
+
+@app.post("/embeddings")
+async def extract_embedding(
+    image: UploadFile = File(...),
+    model_id: str = Form('mobilenet-v2'),
+    k: int = Form(10),
+    add: bool = Form(True),
+    include_embedding: bool = Form(True),
+    deadline_ms: Optional[float] = Form(None),
+    priority: Optional[str] = Form(None),
+    profile: bool = False,
+    context: RequestContext = Depends(request_context)
+):
+    """
+    Penultimate-layer embedding of a cell image and the most similar previously seen cells
+    Args:
+        image: Uploaded image file
+        model_id: Classification model whose embedding space is used
+        k: Number of similar cells to return
+        add: Add this image to the index for later searches
+        include_embedding: Return the embedding vector itself
+        deadline_ms: Time budget in ms (or X-Request-Deadline-Ms header); 504 when exceeded
+        priority: 'interactive' (default) or 'bulk' (or X-Request-Priority header)
+        profile: Attach a stage-timing breakdown to the response (?profile=1)
+    Returns:
+        Embedding, prediction and neighbours (id, similarity, stored prediction, thumbnail)
+    """
+    logger, log_filename = logger_manager.create_logger('embedding', model_id)
+    set_request_options(context, deadline_ms, priority)
+    timer = context
+    
+    logger.info(f"Endpoint: POST /embeddings")
+    logger.info(f"Model ID: {model_id}, k={k}, add={add}")
+    
+    if predictor is None:
+        logger.error("Predictor not loaded!")
+        raise HTTPException(status_code=503, detail="Models not loaded")
+    if k < 1 or k > 100:
+        raise HTTPException(status_code=400, detail="k must be between 1 and 100")
+    
+    try:
+        with timer.stage("read_upload"):
+            image_bytes = await image.read()
+        pil_image = await decoder.decode_async(image_bytes, draft_size=predictor.IMG_SIZE, timer=timer)
+        
+        result = await context.run(run_coalesced(
+            request_key('embedding', image_bytes, model_id=model_id, k=k, add=add),
+            run_inference, 'classification', predictor.embed_classification,
+            pil_image, model_id=model_id, k=k, add=add, logger=logger, timer=timer
+        ))
+        
+        logger.info(f"SUCCESS: {result['dim']}-d embedding, {len(result['neighbours'])} neighbour(s)")
+        logger.info("="*60)
+        
+        if not include_embedding:
+            del result['embedding']
+        result['log_file'] = log_filename
+        if profile:
+            result['profile'] = timer.summary()
+        
+        return FastJSONResponse(content={
+            "success": True,
+            "task": "embedding",
+            "result": result
+        })
+    
+    except RequestAborted as e:
+        logger.warning(f"Request abandoned: {str(e)}")
+        logger.info("="*60)
+        raise HTTPException(status_code=e.status_code, detail=str(e))
+    
+    except Exception as e:
+        logger.error(f"Embedding failed: {str(e)}")
+        import traceback
+        logger.error(f"Traceback:\n{traceback.format_exc()}")
+        logger.info("="*60)
+        raise HTTPException(status_code=500, detail=f"Embedding failed: {str(e)}")
+
+
 @app.post("/predict")
-async def predict_multi(request: PredictRequest):
+async def predict_multi(
+    request: PredictRequest,
+    profile: bool = False,
+    context: RequestContext = Depends(request_context)
+):
     """
     Unified prediction endpoint supporting all tasks
     Args:
-        request: PredictRequest with base64 image and task type
+        request: PredictRequest with base64 image, task type and optional deadline_ms/priority
+        profile: Attach a stage-timing breakdown to the response (?profile=1)
     Returns:
         Prediction results based on task type
     """
     if predictor is None:
         raise HTTPException(status_code=503, detail="Models not loaded")
     
+    set_request_options(context, request.deadline_ms, request.priority)
+    check_box_format(request.box_format)
+    timer = context
+    
     try:
         # Decode base64 image
-        image_data = base64.b64decode(request.image)
-        pil_image = Image.open(io.BytesIO(image_data)).convert('RGB')
+        with timer.stage("decode_base64"):
+            image_data = base64.b64decode(request.image)
+        draft_size = predictor.IMG_SIZE if request.task == "classification" else None
+        pil_image = await decoder.decode_async(image_data, draft_size=draft_size, timer=timer)
         
         # Route to appropriate prediction
         if request.task == "classification":
             model_id = request.model_id if request.model_id else 'mobilenet-v2'
-            result = predictor.predict_classification(pil_image, model_id=model_id)
-            return JSONResponse(content={
+            result = await context.run(run_coalesced(
+                request_key('classification', image_data, model_id=model_id, tta=request.tta),
+                run_inference, 'classification', predictor.predict_classification, pil_image,
+                model_id=model_id, tta=request.tta, timer=timer
+            ))
+            if profile:
+                result['profile'] = timer.summary()
+            return FastJSONResponse(content={
                 "success": True,
                 "task": "classification",
                 "result": result
             })
         
         elif request.task == "detection":
-            result = predictor.predict_detection(pil_image, conf=request.conf)
-            annotated_base64 = predictor.image_to_base64(result['annotated_image'])
-            return JSONResponse(content={
+            result = await context.run(run_coalesced(
+                request_key('detection', image_data, conf=request.conf, show_labels=True),
+                run_detection, 'detection', pil_image, conf=request.conf, timer=timer
+            ))
+            with timer.stage("encode_image"):
+                annotated_base64 = predictor.image_to_base64(result['annotated_image'])
+            response_result = {
+                "detections": format_boxes(result['detections'], request.box_format),
+                "count": result['count'],
+                "annotated_image": annotated_base64
+            }
+            if profile:
+                response_result['profile'] = timer.summary()
+            return FastJSONResponse(content={
                 "success": True,
                 "task": "detection",
-                "result": {
-                    "detections": result['detections'],
-                    "count": result['count'],
-                    "annotated_image": annotated_base64
-                }
+                "result": response_result
             })
         
         elif request.task == "count":
-            result = predictor.predict_detection_count(pil_image, conf=request.conf)
-            annotated_base64 = predictor.image_to_base64(result['annotated_image'])
-            return JSONResponse(content={
+            result = await context.run(run_coalesced(
+                request_key('count', image_data, conf=request.conf, show_labels=True),
+                run_detection, 'count', pil_image, conf=request.conf, timer=timer
+            ))
+            with timer.stage("encode_image"):
+                annotated_base64 = predictor.image_to_base64(result['annotated_image'])
+            response_result = {
+                "counts": result['counts'],
+                "total_cells": result['total_cells'],
+                "detections": format_boxes(result['detections'], request.box_format),
+                "annotated_image": annotated_base64
+            }
+            if profile:
+                response_result['profile'] = timer.summary()
+            return FastJSONResponse(content={
                 "success": True,
                 "task": "count",
-                "result": {
-                    "counts": result['counts'],
-                    "total_cells": result['total_cells'],
-                    "detections": result['detections'],
-                    "annotated_image": annotated_base64
-                }
+                "result": response_result
             })
         
         else:
             raise HTTPException(status_code=400, detail="Invalid task. Use 'classification', 'detection', or 'count'")
     
+    except RequestAborted as e:
+        raise HTTPException(status_code=e.status_code, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Prediction failed: {str(e)}")
 
@@ -463,6 +1169,7 @@ if __name__ == "__main__":
     print("\nStarting server...")
     print("API will be available at: http://localhost:8000")
     print("Documentation: http://localhost:8000/docs")
+    print("Development mode (auto-reload) - use serve.py for multi-worker production serving")
     print("=" * 60 + "\n")
     
     uvicorn.run(
@@ -4,10 +4,16 @@ Model Loader - Loads all deep learning models for blood cell analysis
 import os
 # Force TensorFlow to use legacy Keras 2.x for compatibility with older models
 os.environ['TF_USE_LEGACY_KERAS'] = '1'
+import json
+import time
+import hashlib
+import threading
+import importlib.util
 import tensorflow as tf
 from tensorflow import keras
 from tensorflow.keras import layers
 from ultralytics import YOLO
+from contextlib import contextmanager
 
 
 # Custom layers for Vision Transformer (ViT) model
@@ -60,6 +66,31 @@ class PatchEncoder(layers.Layer):
         })
         return config
 
+# Exported YOLO formats, fastest first: (format, path suffix, runtime package)
+DETECTION_EXPORTS = [
+    ('openvino', '_openvino_model', 'openvino'),
+    ('onnx', '.onnx', 'onnxruntime'),
+]
+
+# Written by export_models.py next to the checkpoints
+EXPORT_MANIFEST = "exports.json"
+
+def file_sha256(path):
+    """SHA-256 of a file (identifies the checkpoint an export was made from)"""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# Versioned model files, read at startup and watched for hot reloads (see registry.py)
+REGISTRY_MANIFEST = "registry.json"
+
+# Version reported for models loaded from the built-in file names
+BUILTIN_VERSION = "builtin"
+
+
 class ModelLoader:
     def __init__(self, models_dir="models"):
         """
@@ -82,6 +113,17 @@ class ModelLoader:
         self.detection_model = None
         self.detection_count_model = None
         
+        # YOLO checkpoints and the format each one is served from ('pt', 'onnx' or 'openvino')
+        self.detection_files = {
+            'detection': 'yolov8n.pt',
+            'count': 'wbc_rbc_best.pt'
+        }
+        self.detection_formats = {}
+        
+        # Model id -> (classifier, two-output embedding view of it)
+        self.embedding_models = {}
+        self._embedding_lock = threading.Lock()
+        
         # Class names for classification (actual trained classes - 5 classes)
         self.classification_classes = [
             'basophil',
@@ -103,6 +145,197 @@ class ModelLoader:
             'cnn': 'best_CNN.h5',
             'vit-base': 'best_vit.h5'
         }
+        
+        # Model key (classification model id, 'detection' or 'count') -> served version
+        self.versions = {}
+        self.manifest_versions = {}
+        # id(model) -> version it was loaded as (see version_of)
+        self._model_versions = {}
+        # id(model) -> requests currently running on it (see lease)
+        self._leases = {}
+        self._lease_lock = threading.Lock()
+        self.apply_registry_manifest()
+    
+    # ==================== VERSIONS ====================
+    
+    def read_registry_manifest(self):
+        """
+        Read the versioned model manifest
+        Format: {"classification": {model_id: {"version", "file"}},
+                 "detection": {"version", "file"}, "count": {"version", "file"}}
+        with files relative to models_dir
+        Returns:
+            dict mapping model key to {"version", "file"} (empty without a manifest)
+        """
+        path = os.path.join(self.models_dir, REGISTRY_MANIFEST)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠ Ignoring unreadable model manifest {path}: {str(e)}")
+            return {}
+        
+        entries = {}
+        for model_id, entry in (manifest.get('classification') or {}).items():
+            if model_id not in self.classification_models:
+                print(f"⚠ Model manifest: unknown classification model '{model_id}', ignored")
+                continue
+            entries[model_id] = entry
+        for task in ('detection', 'count'):
+            if manifest.get(task):
+                entries[task] = manifest[task]
+        
+        versions = {}
+        for key, entry in entries.items():
+            if not isinstance(entry, dict) or not entry.get('file'):
+                continue
+            try:
+                self.model_file_path(entry['file'])
+            except ValueError as e:
+                print(f"⚠ Model manifest: {str(e)}, '{key}' ignored")
+                continue
+            versions[key] = {"version": str(entry.get('version', BUILTIN_VERSION)), "file": entry['file']}
+        return versions
+    
+    def apply_registry_manifest(self):
+        """Point the model file mappings at the manifest's versions (used by the initial load)"""
+        for key, entry in self.read_registry_manifest().items():
+            if key in self.detection_files:
+                self.detection_files[key] = entry['file']
+            else:
+                self.model_files[key] = entry['file']
+            self.manifest_versions[key] = entry['version']
+    
+    def model_file_path(self, filename):
+        """
+        Path of a model file named by the manifest or the admin API
+        Only plain file names inside models_dir are accepted: loading a model
+        unpickles it, so absolute paths, '..' and sub-directories are rejected.
+        Args:
+            filename: File name in models_dir
+        Returns:
+            Path inside models_dir
+        Raises:
+            ValueError: If the name could point outside models_dir
+        """
+        if not isinstance(filename, str) or not filename or os.path.isabs(filename) or '..' in filename \
+                or '/' in filename or '\\' in filename or os.sep in filename:
+            raise ValueError(f"Invalid model file '{filename}': expected a file name in {self.models_dir}")
+        path = os.path.join(self.models_dir, filename)
+        root = os.path.realpath(self.models_dir)
+        if os.path.commonpath([root, os.path.realpath(path)]) != root:
+            raise ValueError(f"Invalid model file '{filename}': resolves outside {self.models_dir}")
+        return path
+    
+    def _record_version(self, key, path, version=None, model=None):
+        self.versions[key] = {
+            "version": version or self.manifest_versions.get(key, BUILTIN_VERSION),
+            "path": path,
+            "loaded_at": time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        if model is not None:
+            self._model_versions[id(model)] = self.versions[key]["version"]
+    
+    def version_of(self, model):
+        """Version a model object was loaded as (stays correct while a replaced version drains)"""
+        return self._model_versions.get(id(model), BUILTIN_VERSION)
+    
+    def forget(self, model):
+        """Drop the bookkeeping for a released model version"""
+        self._model_versions.pop(id(model), None)
+    
+    def current_model(self, key):
+        """Model currently served for a key (None if not loaded)"""
+        if key == 'detection':
+            return self.detection_model
+        if key == 'count':
+            return self.detection_count_model
+        return self.classification_models.get(key)
+    
+    @contextmanager
+    def lease(self, key):
+        """
+        Hold the current model for one inference
+        A hot swap frees the previous version only after its leases are returned.
+        Args:
+            key: Classification model id, 'detection' or 'count'
+        Yields:
+            The model (loaded on demand like get_classification_model)
+        """
+        if key == 'detection':
+            model = self.get_detection_model()
+        elif key == 'count':
+            model = self.get_detection_count_model()
+        else:
+            model = self.get_classification_model(key)
+        with self._lease_lock:
+            self._leases[id(model)] = self._leases.get(id(model), 0) + 1
+        try:
+            yield model
+        finally:
+            with self._lease_lock:
+                remaining = self._leases[id(model)] - 1
+                if remaining:
+                    self._leases[id(model)] = remaining
+                else:
+                    del self._leases[id(model)]
+    
+    def in_flight(self, model):
+        """Number of leases held on a model"""
+        with self._lease_lock:
+            return self._leases.get(id(model), 0)
+    
+    def build_model(self, key, filename):
+        """
+        Load a model file without serving it (see install)
+        Args:
+            key: Classification model id, 'detection' or 'count'
+            filename: File name in models_dir (see model_file_path)
+        Returns:
+            tuple: (model, path, format)
+        """
+        path = self.model_file_path(filename)
+        if key in self.detection_files:
+            model, path, fmt = self._load_yolo(key, None, filename)
+            if model is None:
+                raise FileNotFoundError(f"{key} model not found at {path}")
+            return model, path, fmt
+        return self._read_classifier(path), path, 'keras'
+    
+    def install(self, key, model, version, path, fmt=None, embedding_model=None, filename=None):
+        """
+        Atomically serve a loaded model; requests already holding the old one finish on it
+        Args:
+            key: Classification model id, 'detection' or 'count'
+            embedding_model: Optional pre-built get_embedding_model view of the new model
+            filename: File name in models_dir the model was built from (becomes the served file)
+        Returns:
+            The previously served model (None if there was none)
+        """
+        with self._lease_lock:
+            previous = self.current_model(key)
+            if key == 'detection':
+                self.detection_model = model
+            elif key == 'count':
+                self.detection_count_model = model
+            else:
+                self.classification_models[key] = model
+            if key in self.detection_files:
+                self.detection_formats[key] = fmt or 'pt'
+                if filename:
+                    self.detection_files[key] = filename
+            elif filename:
+                self.model_files[key] = filename
+            self._record_version(key, path, version, model)
+        if key in self.classification_models:
+            with self._embedding_lock:
+                if embedding_model is not None:
+                    self.embedding_models[key] = (model, embedding_model)
+                else:
+                    self.embedding_models.pop(key, None)
+        return previous
     
     def load_classification_model(self, model_id='mobilenet-v2', model_path=None):
         """
@@ -117,6 +350,13 @@ class ModelLoader:
         if model_path is None:
             model_path = os.path.join(self.models_dir, self.model_files[model_id])
         
+        self.classification_models[model_id] = self._read_classifier(model_path)
+        self._record_version(model_id, model_path, model=self.classification_models[model_id])
+        
+        print(f"✓ Classification model '{model_id}' loaded from {model_path}")
+        return self.classification_models[model_id]
+    
+    def _read_classifier(self, model_path):
         if not os.path.exists(model_path):
             raise FileNotFoundError(f"Classification model not found at {model_path}")
         
@@ -127,14 +367,11 @@ class ModelLoader:
         }
         
         # Load model (using legacy Keras for compatibility)
-        self.classification_models[model_id] = tf.keras.models.load_model(
+        return tf.keras.models.load_model(
             model_path, 
             compile=False,
             custom_objects=custom_objects
         )
-        
-        print(f"✓ Classification model '{model_id}' loaded from {model_path}")
-        return self.classification_models[model_id]
     
     def load_all_classification_models(self):
         """
@@ -161,54 +398,139 @@ class ModelLoader:
         
         return loaded, failed
     
-    def load_detection_model(self, model_path=None):
+    def read_export_manifest(self):
         """
-        Load the detection model (YOLO v8n)
+        Read the export manifest written by export_models.py
+        Returns:
+            dict mapping checkpoint filename to export settings
+        """
+        path = os.path.join(self.models_dir, EXPORT_MANIFEST)
+        if not os.path.exists(path):
+            return {}
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError) as e:
+            print(f"⚠ Ignoring unreadable export manifest {path}: {str(e)}")
+            return {}
+    
+    def resolve_detection_weights(self, filename):
+        """
+        Pick the serving format for a YOLO checkpoint
+        Exported models (OpenVINO IR, then ONNX) are preferred when present, their
+        runtime is installed and they were exported from the current checkpoint.
+        DL_DETECTION_FORMAT=pt|onnx|openvino forces one.
         Args:
-            model_path: Path to the .pt model file
+            filename: Checkpoint filename in models_dir (e.g. 'yolov8n.pt')
+        Returns:
+            tuple: (model path, format)
         """
+        preferred = os.environ.get('DL_DETECTION_FORMAT', 'auto').lower()
+        stem = os.path.splitext(filename)[0]
+        checkpoint = os.path.join(self.models_dir, filename)
+        exports = self.read_export_manifest().get(filename, {})
+        
+        for fmt, suffix, runtime in DETECTION_EXPORTS:
+            if preferred not in ('auto', fmt):
+                continue
+            path = os.path.join(self.models_dir, stem + suffix)
+            if not os.path.exists(path):
+                continue
+            if importlib.util.find_spec(runtime) is None:
+                print(f"⚠ Found {path} but {runtime} is not installed, skipping")
+                continue
+            if not self._export_matches(checkpoint, path, exports.get(fmt, {})):
+                print(f"⚠ {path} was not exported from the current {filename}, skipping "
+                      f"(re-run export_models.py)")
+                continue
+            return path, fmt
+        
+        return checkpoint, 'pt'
+    
+    def _export_matches(self, checkpoint, export_path, export):
+        # Exports made before checksums were recorded: the export must be newer than the checkpoint
+        if not os.path.exists(checkpoint):
+            return True
+        if export.get('checkpoint_sha256'):
+            if export.get('checkpoint_size') not in (None, os.path.getsize(checkpoint)):
+                return False
+            return export['checkpoint_sha256'] == file_sha256(checkpoint)
+        return os.path.getmtime(export_path) >= os.path.getmtime(checkpoint)
+    
+    def _load_yolo(self, task, model_path, filename=None):
         if model_path is None:
-            model_path = os.path.join(self.models_dir, "yolov8n.pt")
+            model_path, fmt = self.resolve_detection_weights(filename or self.detection_files[task])
+        else:
+            fmt = next((f for f, suffix, _ in DETECTION_EXPORTS if model_path.rstrip('/\\').endswith(suffix)), 'pt')
         
         if not os.path.exists(model_path):
+            return None, model_path, fmt
+        
+        # Exported models carry no task metadata Ultralytics can rely on
+        model = YOLO(model_path, task='detect')
+        return model, model_path, fmt
+    
+    def load_detection_model(self, model_path=None):
+        """
+        Load the detection model (YOLO v8n)
+        Args:
+            model_path: Path to the .pt model or exported model (default: best available format)
+        """
+        model, model_path, fmt = self._load_yolo('detection', model_path)
+        if model is None:
             raise FileNotFoundError(f"Detection model not found at {model_path}")
         
-        self.detection_model = YOLO(model_path)
-        print(f"✓ Detection model (YOLOv8n) loaded from {model_path}")
+        self.detection_model = model
+        self.detection_formats['detection'] = fmt
+        self._record_version('detection', model_path, model=model)
+        print(f"✓ Detection model (YOLOv8n, {fmt}) loaded from {model_path}")
         return self.detection_model
     
     def load_detection_count_model(self, model_path=None):
         """
         Load the detection count model (WBC/RBC counter)
         Args:
-            model_path: Path to the .pt model file
+            model_path: Path to the .pt model or exported model (default: best available format)
         """
-        if model_path is None:
-            model_path = os.path.join(self.models_dir, "wbc_rbc_best.pt")
-        
-        if not os.path.exists(model_path):
+        model, model_path, fmt = self._load_yolo('count', model_path)
+        if model is None:
             raise FileNotFoundError(f"Detection count model not found at {model_path}")
         
-        self.detection_count_model = YOLO(model_path)
-        print(f"✓ Detection count model (WBC/RBC counter) loaded from {model_path}")
+        self.detection_count_model = model
+        self.detection_formats['count'] = fmt
+        self._record_version('count', model_path, model=model)
+        print(f"✓ Detection count model (WBC/RBC counter, {fmt}) loaded from {model_path}")
         return self.detection_count_model
     
-    def load_all_models(self):
+    def detection_batch_limit(self, task, filename=None, fmt=None):
         """
-        Load all models at once
+        Largest batch the served YOLO model accepts
+        Args:
+            task: 'detection' or 'count'
+            filename: Checkpoint to check instead of the served one (e.g. a version about to be installed)
+            fmt: Serving format of that checkpoint
+        Returns:
+            None for PyTorch and dynamic-shape exports, otherwise the static batch size
+        """
+        # detection_files holds the served checkpoint; install() updates it on hot reloads
+        if filename is None:
+            filename, fmt = self.detection_files[task], self.detection_formats.get(task, 'pt')
+        if (fmt or 'pt') == 'pt':
+            return None
+        export = self.read_export_manifest().get(filename, {}).get(fmt, {})
+        if export.get('dynamic'):
+            return None
+        # Static exports are traced with batch 1 and accept nothing else
+        return 1
+    
+    def load_all_detection_models(self):
+        """
+        Load the detection and detection count models
+        Returns:
+            True if both models loaded
         """
-        print("="*60)
-        print("Loading all models...")
-        print("="*60)
-        
         success = True
         
-        # Load classification models
-        loaded, failed = self.load_all_classification_models()
-        if not loaded:
-            print("⚠ Warning: No classification models loaded")
-            success = False
-        
         # Load detection model
         try:
             self.load_detection_model()
@@ -223,6 +545,28 @@ class ModelLoader:
             print(f"⚠ Detection count model not loaded: {str(e)}")
             success = False
         
+        return success
+    
+    def load_all_models(self):
+        """
+        Load all models at once
+        """
+        print("="*60)
+        print("Loading all models...")
+        print("="*60)
+        
+        success = True
+        
+        # Load classification models
+        loaded, failed = self.load_all_classification_models()
+        if not loaded:
+            print("⚠ Warning: No classification models loaded")
+            success = False
+        
+        # Load detection models
+        if not self.load_all_detection_models():
+            success = False
+        
         print("="*60)
         if success:
             print("✓ All models loaded successfully!")
@@ -250,6 +594,37 @@ class ModelLoader:
         
         return self.classification_models[model_id]
     
+    def get_embedding_model(self, model_id='mobilenet-v2', model=None):
+        """
+        Get a view of a classification model with two outputs: the penultimate
+        features and the softmax. It shares the classifier's weights, so one
+        forward pass gives both.
+        Args:
+            model_id: Model identifier
+            model: Classifier to wrap (default: the one currently served, see lease)
+        """
+        if model is None:
+            model = self.get_classification_model(model_id)
+        with self._embedding_lock:
+            cached = self.embedding_models.get(model_id)
+            if cached is not None and cached[0] is model:
+                return cached[1]
+            view = self.build_embedding_model(model)
+            if model is self.classification_models.get(model_id):
+                # Requests still draining on a replaced version get an uncached view
+                self.embedding_models[model_id] = (model, view)
+                print(f"✓ Embedding model for '{model_id}': {view.outputs[0].shape[-1]}-d penultimate features")
+        return view
+    
+    def build_embedding_model(self, model):
+        """Two-output (features, softmax) view of a classifier"""
+        # Input of the final Dense layer, skipping trailing Activation/Dropout layers
+        index = len(model.layers) - 1
+        while index > 0 and not model.layers[index].weights:
+            index -= 1
+        features = model.layers[index].input
+        return tf.keras.Model(inputs=model.inputs, outputs=[features, model.outputs[0]])
+    
     def get_available_classification_models(self):
         """
         Get list of loaded classification models
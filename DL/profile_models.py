@@ -0,0 +1,486 @@
+"""
+Profile Models - Measure every classifier on this machine and regenerate the model metadata
+Loads each classification model in its own child process and records load time, memory,
+latency and throughput at several batch sizes, plus accuracy on a
+labelled dataset. It then reports the latency/accuracy Pareto front and
+rewrites backend/data/models.json (speed labels, metrics and the default
+model) from the measurements.
+
+Dataset layout: one sub-directory per class, named like the classes
+(basophil/, eosinophil/, lymphocyte/, monocyte/, neutrophil/).
+
+Usage:
+    python profile_models.py --dataset /data/bccd_test
+    python profile_models.py --dataset /data/bccd_test --latency-budget-ms 50 --batch-sizes 1,8,32
+    python profile_models.py --standin --dry-run
+"""
+import os
+# Force TensorFlow to use legacy Keras 2.x for compatibility with older models
+os.environ['TF_USE_LEGACY_KERAS'] = '1'
+
+import argparse
+import gc
+import json
+import sys
+import threading
+import time
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+
+import numpy as np
+from PIL import Image
+
+from interface import BloodCellPredictor
+from standins import synthetic_smear, CLASSIFIER_IDS
+from benchmark import latency_summary, current_rss_mb, environment_info, quiet_logger
+from bulk_score import IMAGE_EXTENSIONS
+
+
+METADATA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'backend', 'data', 'models.json')
+
+# Speed label by batch-1 latency relative to the fastest model
+SPEED_LABELS = [(1.5, "Very Fast"), (3.0, "Fast"), (6.0, "Medium")]
+
+
+# ==================== DATASET ====================
+
+def load_dataset(path, classes, limit_per_class=None):
+    """
+    Collect labelled images from class sub-directories
+    Args:
+        path: Dataset root
+        classes: Class names of the classifiers (directory names match case-insensitively)
+        limit_per_class: Optional cap on images per class
+    Returns:
+        list of (image path, class index)
+    """
+    folders = {name.lower(): name for name in os.listdir(path) if os.path.isdir(os.path.join(path, name))}
+    samples = []
+    for index, name in enumerate(classes):
+        folder = folders.get(name.lower())
+        if folder is None:
+            print(f"⚠ Dataset has no '{name}' directory")
+            continue
+        files = sorted(f for f in os.listdir(os.path.join(path, folder)) if f.lower().endswith(IMAGE_EXTENSIONS))
+        samples.extend((os.path.join(path, folder, f), index) for f in files[:limit_per_class])
+    extra = sorted(set(folders) - {name.lower() for name in classes})
+    if extra:
+        print(f"⚠ Ignoring dataset directories that are not classes: {extra}")
+    return samples
+
+
+def load_images(paths):
+    return [Image.open(p).convert('RGB') for p in paths]
+
+
+# ==================== MEASUREMENTS ====================
+
+class PeakMemory:
+    """Sample the resident set size in the background and keep the maximum"""
+
+    def __init__(self, interval=0.01):
+        self.interval = interval
+        self.peak = current_rss_mb() or 0.0
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.peak = max(self.peak, current_rss_mb() or 0.0)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        self._thread.join()
+        self.peak = max(self.peak, current_rss_mb() or 0.0)
+
+
+def measure_latency(predictor, model_id, images, batch_size, iterations, warmup):
+    """
+    Time predictor calls at one batch size
+    Returns:
+        dict with per-call latency percentiles and images/second
+    """
+    batch = (images * (batch_size // len(images) + 1))[:batch_size]
+    if batch_size == 1:
+        call = lambda: predictor.predict_classification(batch[0], model_id=model_id, logger=quiet_logger)
+    else:
+        call = lambda: predictor.predict_classification_batch(batch, model_id=model_id, logger=quiet_logger)
+
+    for _ in range(warmup):
+        call()
+    latencies = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        call()
+        latencies.append((time.perf_counter() - start) * 1000)
+
+    row = {"batch_size": batch_size}
+    row.update(latency_summary(latencies))
+    row["per_image_ms"] = round(row["p50_ms"] / batch_size, 3)
+    row["throughput_ips"] = round(batch_size * 1000 / row["p50_ms"], 2) if row["p50_ms"] else 0.0
+    return row
+
+
+def measure_accuracy(predictor, model_id, samples, classes, batch_size):
+    """
+    Classify the labelled samples
+    Returns:
+        dict with accuracy, macro precision/recall/F1, per-class recall and the confusion matrix
+    """
+    n = len(classes)
+    confusion = np.zeros((n, n), dtype=np.int64)
+    index = {name: i for i, name in enumerate(classes)}
+    for start in range(0, len(samples), batch_size):
+        chunk = samples[start:start + batch_size]
+        results = predictor.predict_classification_batch(
+            load_images([path for path, _ in chunk]), model_id=model_id, logger=quiet_logger
+        )
+        for (_, label), result in zip(chunk, results):
+            confusion[label, index[result["predicted_class"]]] += 1
+
+    true_positives = np.diag(confusion).astype(np.float64)
+    predicted = confusion.sum(axis=0)
+    actual = confusion.sum(axis=1)
+    precision = np.divide(true_positives, predicted, out=np.zeros(n), where=predicted > 0)
+    recall = np.divide(true_positives, actual, out=np.zeros(n), where=actual > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall, out=np.zeros(n), where=(precision + recall) > 0)
+    # Macro averages over the classes present in the dataset
+    present = actual > 0
+    return {
+        "samples": int(confusion.sum()),
+        "accuracy": round(float(true_positives.sum() / max(confusion.sum(), 1)), 4),
+        "precision": round(float(precision[present].mean()), 4) if present.any() else 0.0,
+        "recall": round(float(recall[present].mean()), 4) if present.any() else 0.0,
+        "f1": round(float(f1[present].mean()), 4) if present.any() else 0.0,
+        "per_class_recall": {name: round(float(recall[i]), 4) for i, name in enumerate(classes) if present[i]},
+        "confusion": confusion.tolist()
+    }
+
+
+def release_model(loader, model_id):
+    """Drop a classifier so the next one is measured on its own"""
+    loader.classification_models[model_id] = None
+    getattr(loader, 'embedding_models', {}).pop(model_id, None)
+    if 'tensorflow' in sys.modules:
+        sys.modules['tensorflow'].keras.backend.clear_session()
+    gc.collect()
+
+
+def profile_model(loader, predictor, model_id, images, samples, args):
+    """
+    Load, time and evaluate one classifier
+    Returns:
+        dict with load, memory, latency and accuracy measurements
+    """
+    rss_before = current_rss_mb()
+    with PeakMemory() as memory:
+        start = time.perf_counter()
+        loader.load_classification_model(model_id)
+        load_s = time.perf_counter() - start
+        rss_loaded = current_rss_mb()
+
+        latency = [
+            measure_latency(predictor, model_id, images, size, args.iterations, args.warmup)
+            for size in args.batch_sizes
+        ]
+        accuracy = measure_accuracy(predictor, model_id, samples, loader.classification_classes,
+                                    args.eval_batch_size) if samples else None
+
+    result = {
+        "model_id": model_id,
+        "load_s": round(load_s, 3),
+        "memory_mb": round(rss_loaded - rss_before, 1) if rss_before is not None else None,
+        "peak_rss_mb": round(memory.peak, 1),
+        "latency": latency,
+        "accuracy": accuracy
+    }
+    release_model(loader, model_id)
+    return result
+
+
+def build_loader(args):
+    if args.standin:
+        from standins import StandInModelLoader
+        return StandInModelLoader(models_dir=args.models_dir)
+    from model_loader import ModelLoader
+    return ModelLoader(models_dir=args.models_dir)
+
+
+def profile_in_child(model_id, images, samples, args):
+    """Child process entry point: profile one classifier with nothing else loaded"""
+    loader = build_loader(args)
+    return profile_model(loader, BloodCellPredictor(loader), model_id, images, samples, args)
+
+
+def profile_isolated(model_id, images, samples, args):
+    """
+    Profile one classifier in a fresh spawned process
+    Memory figures then cover this model only, not the allocator and
+    framework state left behind by the models profiled before it.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=multiprocessing.get_context('spawn')) as pool:
+        return pool.submit(profile_in_child, model_id, images, samples, args).result()
+
+
+# ==================== PARETO AND DEFAULT ====================
+
+def parse_percent(value):
+    try:
+        return float(str(value).rstrip('%')) / 100
+    except ValueError:
+        return None
+
+
+def pareto_front(points):
+    """
+    Models not beaten on both latency and accuracy
+    Args:
+        points: dict model_id -> (latency_ms, accuracy)
+    Returns:
+        set of model ids on the front
+    """
+    front = set()
+    for model_id, (latency, accuracy) in points.items():
+        dominated = any(
+            other_latency <= latency and other_accuracy >= accuracy
+            and (other_latency < latency or other_accuracy > accuracy)
+            for other_id, (other_latency, other_accuracy) in points.items() if other_id != model_id
+        )
+        if not dominated:
+            front.add(model_id)
+    return front
+
+
+def choose_default(points, front, budget_ms):
+    """Most accurate Pareto model within the latency budget (the fastest model if none fits)"""
+    within = [model_id for model_id in front if points[model_id][0] <= budget_ms]
+    if within:
+        return max(within, key=lambda model_id: (points[model_id][1], -points[model_id][0]))
+    return min(points, key=lambda model_id: points[model_id][0])
+
+
+def speed_label(latency_ms, fastest_ms):
+    ratio = latency_ms / fastest_ms if fastest_ms else 1.0
+    for limit, label in SPEED_LABELS:
+        if ratio <= limit:
+            return label
+    return "Slow"
+
+
+def summarize(profiles, metadata, budget_ms):
+    """
+    Build the trade-off summary
+    Accuracy comes from the dataset run, or from the existing metadata when no
+    dataset was given (marked as 'metadata')
+    The default is picked only among models listed in the metadata, which
+    are the ones the backend and the predict page can offer.
+    Returns:
+        dict with per-model points, the Pareto front and the default model
+    """
+    static = {entry['id']: parse_percent(entry.get('accuracy')) for entry in metadata.get('models', [])}
+    points = {}
+    sources = {}
+    for profile in profiles:
+        model_id = profile["model_id"]
+        batch_one = next((row for row in profile["latency"] if row["batch_size"] == 1), profile["latency"][0])
+        latency = batch_one["per_image_ms"]
+        if profile["accuracy"] is not None:
+            accuracy, sources[model_id] = profile["accuracy"]["accuracy"], "measured"
+        elif static.get(model_id) is not None:
+            accuracy, sources[model_id] = static[model_id], "metadata"
+        else:
+            accuracy, sources[model_id] = 0.0, "unknown"
+        points[model_id] = (latency, accuracy)
+
+    front = pareto_front(points)
+    listed = {model_id: point for model_id, point in points.items() if model_id in static}
+    default = choose_default(listed, pareto_front(listed), budget_ms) if listed else None
+    return {
+        "points": {
+            model_id: {"latency_ms": round(latency, 3), "accuracy": accuracy,
+                       "accuracy_source": sources[model_id], "pareto": model_id in front}
+            for model_id, (latency, accuracy) in sorted(points.items(), key=lambda item: item[1][0])
+        },
+        "pareto_front": sorted(front, key=lambda model_id: points[model_id][0]),
+        "default_model": default,
+        "latency_budget_ms": budget_ms
+    }
+
+
+# ==================== METADATA ====================
+
+def update_metadata(metadata, profiles, summary, environment, dataset):
+    """
+    Rewrite the classifier entries of backend/data/models.json from the measurements
+    Names, descriptions and non-classifier entries are kept as written.
+    Returns:
+        The updated metadata dict
+    """
+    by_id = {profile["model_id"]: profile for profile in profiles}
+    fastest = min((point["latency_ms"] for point in summary["points"].values()), default=0.0)
+    for entry in metadata.get("models", []):
+        profile = by_id.get(entry["id"])
+        if profile is None:
+            continue
+        point = summary["points"][entry["id"]]
+        entry["speed"] = speed_label(point["latency_ms"], fastest)
+        entry["latencyMs"] = point["latency_ms"]
+        entry["throughputIps"] = max(row["throughput_ips"] for row in profile["latency"])
+        entry["memoryMb"] = profile["memory_mb"]
+        entry["loadTimeS"] = profile["load_s"]
+        if profile["accuracy"] is not None:
+            measured = profile["accuracy"]
+            entry["accuracy"] = f"{measured['accuracy'] * 100:.1f}%"
+            entry["precision"] = f"{measured['precision'] * 100:.1f}%"
+            entry["recall"] = f"{measured['recall'] * 100:.1f}%"
+            entry["f1Score"] = f"{measured['f1'] * 100:.1f}%"
+        entry["pareto"] = point["pareto"]
+        entry["recommended"] = entry["id"] == summary["default_model"]
+
+    missing = sorted(set(by_id) - {entry["id"] for entry in metadata.get("models", [])})
+    if missing:
+        print(f"⚠ Profiled but not listed in the metadata (left out): {missing}")
+
+    if summary["default_model"] is not None:
+        metadata["defaultModel"] = summary["default_model"]
+    metadata["profile"] = {
+        "profiledAt": environment["timestamp"],
+        "processor": environment["processor"] or environment["platform"],
+        "cpuCount": environment["cpu_count"],
+        "dataset": os.path.basename(os.path.normpath(dataset)) if dataset else None,
+        "latencyBudgetMs": summary["latency_budget_ms"]
+    }
+    return metadata
+
+
+def write_json(path, data):
+    # Write-then-rename so the backend never reads a half-written file
+    with open(path + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(data, f, indent=2)
+        f.write('\n')
+    os.replace(path + '.tmp', path)
+
+
+# ==================== RUN ====================
+
+def print_table(profiles, summary):
+    print("=" * 60)
+    print(f"{'model':16s} {'ms/img':>8s} {'best img/s':>10s} {'mem MB':>7s} {'load s':>7s} {'accuracy':>9s}")
+    for profile in sorted(profiles, key=lambda p: summary["points"][p["model_id"]]["latency_ms"]):
+        point = summary["points"][profile["model_id"]]
+        marks = (" *" if point["pareto"] else "") + (" (default)" if profile["model_id"] == summary["default_model"] else "")
+        accuracy = f"{point['accuracy'] * 100:.1f}%" if point["accuracy_source"] != "unknown" else "-"
+        print(f"{profile['model_id']:16s} {point['latency_ms']:8.2f} "
+              f"{max(row['throughput_ips'] for row in profile['latency']):10.1f} "
+              f"{profile['memory_mb'] if profile['memory_mb'] is not None else '-':>7} {profile['load_s']:7.2f} "
+              f"{accuracy:>9s}{marks}")
+    print("* = on the latency/accuracy Pareto front")
+    print("=" * 60)
+
+
+def run(args):
+    # Only used for the class names; every model is loaded in its own child process
+    loader = build_loader(args)
+
+    samples = []
+    if args.dataset:
+        samples = load_dataset(args.dataset, loader.classification_classes, args.limit_per_class)
+        if not samples:
+            print(f"✗ No labelled images found in {args.dataset}")
+            return 1
+        print(f"✓ Dataset: {len(samples)} labelled image(s)")
+    else:
+        print("⚠ No --dataset: accuracy is taken from the existing metadata, not measured")
+
+    # Latency inputs: real cells when available, else synthetic smears
+    if samples:
+        images = load_images([path for path, _ in samples[:8]])
+    else:
+        images = [Image.fromarray(synthetic_smear(360, 360, seed=i)) for i in range(8)]
+
+    model_ids = args.models or CLASSIFIER_IDS
+    profiles = []
+    for model_id in model_ids:
+        try:
+            profile = profile_isolated(model_id, images, samples, args)
+        except Exception as e:
+            print(f"✗ {model_id}: {str(e)}")
+            continue
+        profiles.append(profile)
+        accuracy = profile["accuracy"]["accuracy"] if profile["accuracy"] else None
+        print(f"✓ {model_id:16s} load {profile['load_s']:.2f}s, "
+              f"{profile['latency'][0]['per_image_ms']:.2f}ms/img at batch {profile['latency'][0]['batch_size']}"
+              + (f", accuracy {accuracy * 100:.1f}%" if accuracy is not None else ""))
+    if not profiles:
+        print("✗ No model could be profiled")
+        return 1
+
+    with open(args.metadata, 'r', encoding='utf-8') as f:
+        metadata = json.load(f)
+    environment = environment_info()
+    summary = summarize(profiles, metadata, args.latency_budget_ms)
+    print_table(profiles, summary)
+
+    report = {
+        "environment": environment,
+        "config": {
+            "standin": args.standin,
+            "models": model_ids,
+            "batch_sizes": args.batch_sizes,
+            "iterations": args.iterations,
+            "warmup": args.warmup,
+            "dataset": args.dataset,
+            "samples": len(samples)
+        },
+        "profiles": profiles,
+        "summary": summary
+    }
+    write_json(args.output, report)
+    print(f"✓ Report written to {args.output}")
+
+    if args.dry_run:
+        print(f"Default model would be: {summary['default_model']} (metadata not changed)")
+    else:
+        write_json(args.metadata, update_metadata(metadata, profiles, summary, environment, args.dataset))
+        print(f"✓ Updated {os.path.normpath(args.metadata)} (default model: {summary['default_model']})")
+    return 0
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Profile the classifiers and regenerate the model metadata")
+    parser.add_argument("--dataset", default=None, help="Labelled images, one sub-directory per class")
+    parser.add_argument("--limit-per-class", type=int, default=None, help="Max dataset images per class")
+    parser.add_argument("--models", default="", help="Comma-separated classifier ids (default all)")
+    parser.add_argument("--batch-sizes", default="1,8,32", help="Batch sizes to time")
+    parser.add_argument("--iterations", type=int, default=20, help="Timed calls per batch size")
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed calls per batch size")
+    parser.add_argument("--eval-batch-size", type=int, default=32, help="Batch size for the accuracy run")
+    parser.add_argument("--latency-budget-ms", type=float, default=100.0,
+                        help="Per-image latency the default model must meet (default 100)")
+    parser.add_argument("--metadata", default=METADATA_PATH, help="Model metadata to regenerate")
+    parser.add_argument("--output", default=f"model_profile_{datetime.now():%Y%m%d_%H%M%S}.json",
+                        help="Profiling report")
+    parser.add_argument("--dry-run", action="store_true", help="Write the report only, not the metadata")
+    parser.add_argument("--standin", action="store_true", help="Use stand-in models (no weights needed)")
+    parser.add_argument("--models-dir", default="models", help="Directory containing the model files")
+    return parser
+
+
+if __name__ == "__main__":
+    args = build_parser().parse_args()
+    args.models = [m.strip() for m in args.models.split(',') if m.strip()]
+    for model_id in args.models:
+        if model_id not in CLASSIFIER_IDS:
+            print(f"✗ Unknown model: {model_id}. Available: {CLASSIFIER_IDS}")
+            sys.exit(2)
+    args.batch_sizes = sorted({max(int(b), 1) for b in args.batch_sizes.split(',') if b.strip()})
+    args.eval_batch_size = max(args.eval_batch_size, 1)
+    print("=" * 60)
+    print("Blood Cell Model Profiling")
+    print("=" * 60)
+    sys.exit(run(args))
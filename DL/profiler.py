@@ -0,0 +1,262 @@
+"""
+Profiler - On-demand sampling profiler and per-request stage timing
+"""
+import os
+import sys
+import time
+import shutil
+import threading
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+
+
+# Leaf frames that mean a thread is parked rather than doing work
+IDLE_FRAMES = {
+    ('threading.py', 'wait'),
+    ('threading.py', '_wait_for_tstate_lock'),
+    ('queue.py', 'get'),
+    ('selectors.py', 'select'),
+    ('base_events.py', '_run_once'),
+    ('socket.py', 'accept'),
+}
+
+
+class StageTimer:
+    """Collect wall-clock timings for the stages of a single request"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.stages = {}
+
+    @contextmanager
+    def stage(self, name):
+        """
+        Time a block of work under the given stage name
+        Args:
+            name: Stage name (repeated stages are summed)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = (time.perf_counter() - start) * 1000
+            self.stages[name] = self.stages.get(name, 0.0) + elapsed
+
+    def add(self, name, ms):
+        """
+        Record time measured elsewhere (e.g. a shared batch forward pass)
+        Args:
+            name: Stage name
+            ms: Milliseconds to add
+        """
+        self.stages[name] = self.stages.get(name, 0.0) + ms
+
+    def check(self):
+        """Raise if the request should be abandoned (see deadlines.RequestContext)"""
+
+    def summary(self):
+        """
+        Get the stage breakdown
+        Returns:
+            dict with per-stage and total milliseconds
+        """
+        total = (time.perf_counter() - self.started) * 1000
+        return {
+            "stages_ms": {name: round(ms, 3) for name, ms in self.stages.items()},
+            "total_ms": round(total, 3)
+        }
+
+
+class NullTimer:
+    """Stage timer that records nothing (used when profiling is off)"""
+
+    def stage(self, name):
+        return nullcontext()
+
+    def add(self, name, ms):
+        pass
+
+    def check(self):
+        pass
+
+    def summary(self):
+        return {}
+
+
+NULL_TIMER = NullTimer()
+
+
+class SamplingProfiler:
+    """Sample Python stacks of every thread and emit collapsed (flamegraph) stacks"""
+
+    def __init__(self, profiles_dir="profiles"):
+        """
+        Initialize profiler
+        Args:
+            profiles_dir: Directory to store captured profiles
+        """
+        self.profiles_dir = profiles_dir
+        self._lock = threading.Lock()
+        os.makedirs(self.profiles_dir, exist_ok=True)
+
+    @property
+    def busy(self):
+        return self._lock.locked()
+
+    def _frame_label(self, frame):
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        # ';' separates frames in the collapsed format, keep labels clean
+        return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(';', ':')
+
+    def _sample(self, own_ident, thread_names, include_idle):
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own_ident:
+                continue
+            leaf = (os.path.basename(frame.f_code.co_filename), frame.f_code.co_name)
+            if not include_idle and leaf in IDLE_FRAMES:
+                continue
+            labels = []
+            while frame is not None:
+                labels.append(self._frame_label(frame))
+                frame = frame.f_back
+            labels.append(thread_names.get(ident, f"thread-{ident}"))
+            stacks.append(';'.join(reversed(labels)))
+        return stacks
+
+    def capture(self, seconds=10.0, interval=0.005, include_idle=False, ops=True):
+        """
+        Capture a time-boxed sampling profile of the running process
+        Args:
+            seconds: Capture duration
+            interval: Seconds between samples
+            include_idle: Whether to keep stacks of parked threads
+            ops: Whether to also record TensorFlow/torch op-level timings
+        Returns:
+            dict with the collapsed-stack filename and capture metadata
+        """
+        if not self._lock.acquire(blocking=False):
+            raise RuntimeError("A profile capture is already running")
+
+        try:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+            base_name = f"{timestamp}_profile"
+            own_ident = threading.get_ident()
+            counts = Counter()
+            samples = 0
+
+            op_profiler = FrameworkOpProfiler(os.path.join(self.profiles_dir, base_name)) if ops else None
+            if op_profiler:
+                op_profiler.start()
+
+            deadline = time.perf_counter() + seconds
+            try:
+                while time.perf_counter() < deadline:
+                    thread_names = {t.ident: t.name for t in threading.enumerate()}
+                    counts.update(self._sample(own_ident, thread_names, include_idle))
+                    samples += 1
+                    time.sleep(interval)
+            finally:
+                artifacts = op_profiler.stop() if op_profiler else {}
+
+            folded_name = f"{base_name}.folded"
+            with open(os.path.join(self.profiles_dir, folded_name), 'w', encoding='utf-8') as f:
+                for stack, count in counts.most_common():
+                    f.write(f"{stack} {count}\n")
+
+            return {
+                "filename": folded_name,
+                "samples": samples,
+                "unique_stacks": len(counts),
+                "seconds": seconds,
+                "interval": interval,
+                "artifacts": artifacts
+            }
+        finally:
+            self._lock.release()
+
+    def list_profiles(self):
+        """
+        List captured profile artifacts
+        Returns:
+            List of filenames, newest first
+        """
+        if not os.path.exists(self.profiles_dir):
+            return []
+        return sorted(os.listdir(self.profiles_dir), reverse=True)
+
+
+class FrameworkOpProfiler:
+    """Record op-level timings from TensorFlow and torch when they are loaded"""
+
+    def __init__(self, base_path):
+        """
+        Args:
+            base_path: Path prefix for the op-level artifacts
+        """
+        self.base_path = base_path
+        self.torch_profiler = None
+        self.tf_logdir = None
+
+    def start(self):
+        # Only profile frameworks that are already imported - never pull them in here
+        if 'torch' in sys.modules:
+            try:
+                import torch
+                self.torch_profiler = torch.profiler.profile(
+                    activities=[torch.profiler.ProfilerActivity.CPU]
+                )
+                self.torch_profiler.__enter__()
+            except Exception as e:
+                print(f"⚠ torch op profiler unavailable: {str(e)}")
+                self.torch_profiler = None
+
+        if 'tensorflow' in sys.modules:
+            try:
+                import tensorflow as tf
+                self.tf_logdir = f"{self.base_path}_tf"
+                tf.profiler.experimental.start(self.tf_logdir)
+            except Exception as e:
+                print(f"⚠ TensorFlow op profiler unavailable: {str(e)}")
+                self.tf_logdir = None
+
+    def stop(self):
+        """
+        Stop recording and write artifacts
+        Returns:
+            dict mapping framework name to artifact filename
+        """
+        artifacts = {}
+
+        if self.torch_profiler is not None:
+            try:
+                self.torch_profiler.__exit__(None, None, None)
+                table = self.torch_profiler.key_averages().table(
+                    sort_by="self_cpu_time_total", row_limit=50
+                )
+                ops_path = f"{self.base_path}.torch_ops.txt"
+                with open(ops_path, 'w', encoding='utf-8') as f:
+                    f.write(table)
+                artifacts["torch"] = os.path.basename(ops_path)
+            except Exception as e:
+                print(f"⚠ Failed to write torch op profile: {str(e)}")
+
+        if self.tf_logdir is not None:
+            try:
+                import tensorflow as tf
+                tf.profiler.experimental.stop()
+                # TensorBoard trace directory, zipped so it downloads as one file
+                # (unzip and open with the TensorBoard Profile plugin)
+                archive = shutil.make_archive(self.tf_logdir, 'zip', root_dir=self.tf_logdir)
+                shutil.rmtree(self.tf_logdir, ignore_errors=True)
+                artifacts["tensorflow"] = os.path.basename(archive)
+            except Exception as e:
+                print(f"⚠ Failed to write TensorFlow op profile: {str(e)}")
+
+        return artifacts
+
+
+# Global profiler
+sampling_profiler = SamplingProfiler()
@@ -0,0 +1,331 @@
+"""
+Registry - Hot reload of versioned models without restarting the server
+models/registry.json pins a version and file for each model. When the
+manifest changes, or an admin asks for a reload, the new version is
+loaded in the background and warmed up on its own worker pool at bulk
+priority. It is then swapped in atomically. The old version is released
+once the requests still running on it have finished.
+"""
+import os
+import gc
+import time
+import threading
+from collections import deque
+
+import numpy as np
+
+from model_loader import REGISTRY_MANIFEST
+from batching import update_batcher, limit_batcher
+
+
+# Registry methods that may be called remotely (see inference_broker.py)
+REGISTRY_ACTIONS = ('stats', 'reload', 'check_manifest')
+
+# Finished reloads kept for GET /admin/models
+HISTORY_SIZE = 20
+
+
+class ModelRegistry:
+    """Load, warm up and swap model versions in the background"""
+
+    def __init__(self, model_loader, topology=None, warmup_batches=(1,), embeddings=False,
+                 drain_timeout=300.0):
+        """
+        Args:
+            model_loader: ModelLoader serving the models
+            topology: ExecutionTopology whose pools run the warm-up (None = reload thread)
+            warmup_batches: Batch sizes run through a new version before it serves
+            embeddings: Also build and warm the embedding view of new classifiers
+            drain_timeout: Seconds to wait for requests on a replaced version
+                before releasing it anyway (it stays alive while they hold it)
+        """
+        self.model_loader = model_loader
+        self.topology = topology
+        self.warmup_batches = tuple(sorted({max(int(n), 1) for n in warmup_batches})) or (1,)
+        self.embeddings = embeddings
+        self.drain_timeout = drain_timeout
+        self.manifest_path = os.path.join(model_loader.models_dir, REGISTRY_MANIFEST)
+
+        self._lock = threading.Lock()
+        self._reloading = {}
+        self._retired = []
+        self._history = deque(maxlen=HISTORY_SIZE)
+        self._drainer = None
+        self._stop = threading.Event()
+        self._watch_seconds = 0.0
+        self._install_hooks = []
+        self._prepare_hooks = []
+
+    @staticmethod
+    def task_for(key):
+        return key if key in ('detection', 'count') else 'classification'
+
+    def on_prepare(self, hook):
+        """
+        Register a callback run after warm-up, just before a new version is swapped in
+        Args:
+            hook: callable(key, filename, fmt); an error aborts the swap
+        """
+        self._prepare_hooks.append(hook)
+
+    def on_install(self, hook):
+        """
+        Register a callback run after a new version is swapped in
+        Args:
+            hook: callable(key, version, model); errors are reported, the swap stands
+        """
+        self._install_hooks.append(hook)
+
+    def _known(self, key):
+        return key in self.model_loader.classification_models or key in self.model_loader.detection_files
+
+    # ==================== RELOAD ====================
+
+    def reload(self, key, version=None, filename=None):
+        """
+        Start loading a model version in the background
+        Args:
+            key: Classification model id, 'detection' or 'count'
+            version: Version label (default: the manifest's, else a timestamp)
+            filename: File name in models_dir (default: the manifest's, else the current file)
+        Returns:
+            dict describing the started reload
+        """
+        if not self._known(key):
+            raise ValueError(f"Unknown model: {key}")
+        loader = self.model_loader
+        entry = loader.read_registry_manifest().get(key, {})
+        filename = filename or entry.get('file') or loader.detection_files.get(key) or loader.model_files[key]
+        # Rejects paths outside models_dir before anything is loaded
+        loader.model_file_path(filename)
+        version = str(version or entry.get('version') or time.strftime('%Y%m%d-%H%M%S'))
+
+        with self._lock:
+            if key in self._reloading:
+                raise ValueError(f"A reload of '{key}' is already in progress")
+            job = {"key": key, "version": version, "file": filename, "state": "loading",
+                   "started_at": time.strftime('%Y-%m-%dT%H:%M:%S')}
+            self._reloading[key] = job
+        threading.Thread(target=self._run, args=(job,), name=f"reload-{key}", daemon=True).start()
+        print(f"Reloading {key}: version {version} from {filename}")
+        return dict(job)
+
+    def check_manifest(self):
+        """
+        Start reloads for manifest entries whose version is not the one served
+        Returns:
+            list of started reloads
+        """
+        started = []
+        for key, entry in self.model_loader.read_registry_manifest().items():
+            served = self.model_loader.versions.get(key, {}).get('version')
+            if entry['version'] == served:
+                continue
+            try:
+                started.append(self.reload(key, entry['version'], entry['file']))
+            except ValueError as e:
+                print(f"⚠ {str(e)}")
+        return started
+
+    def _run(self, job):
+        key = job["key"]
+        loader = self.model_loader
+        try:
+            start = time.perf_counter()
+            model, path, fmt = loader.build_model(key, job["file"])
+            job["load_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+            job["state"] = "warming"
+            start = time.perf_counter()
+            if self.topology is not None:
+                # Runs between requests on the model's own pool without taking interactive capacity
+                embedding = self.topology.submit_as(self.task_for(key), 'bulk', self._warm, key, model, fmt).result()
+            else:
+                embedding = self._warm(key, model, fmt)
+            job["warmup_ms"] = round((time.perf_counter() - start) * 1000, 1)
+
+            for hook in self._prepare_hooks:
+                hook(key, job["file"], fmt)
+            previous_version = loader.versions.get(key, {}).get('version')
+            previous = loader.install(key, model, job["version"], path, fmt, embedding, filename=job["file"])
+            job["state"] = "serving"
+            print(f"✓ {key} version {job['version']} now serving "
+                  f"(load {job['load_ms']:.0f}ms, warm-up {job['warmup_ms']:.0f}ms)")
+            for hook in self._install_hooks:
+                try:
+                    hook(key, job["version"], model)
+                except Exception as e:
+                    print(f"⚠ Post-install step for {key} version {job['version']} failed: {str(e)}")
+            if previous is not None:
+                self._retire(key, previous_version, previous)
+        except Exception as e:
+            job["state"] = "failed"
+            job["error"] = str(e)
+            print(f"✗ Reload of {key} version {job['version']} failed, keeping the current version: {str(e)}")
+        finally:
+            job["finished_at"] = time.strftime('%Y-%m-%dT%H:%M:%S')
+            with self._lock:
+                self._reloading.pop(key, None)
+                self._history.append(job)
+
+    def _warm(self, key, model, fmt):
+        # First calls build graphs/allocate buffers; do it before real traffic arrives
+        loader = self.model_loader
+        if key in loader.detection_files:
+            if key == 'count' and len(model.names) != len(loader.detection_count_classes):
+                raise ValueError(f"Model has {len(model.names)} classes, expected "
+                                 f"{loader.detection_count_classes}")
+            image = np.zeros((640, 640, 3), dtype=np.uint8)
+            # Static-shape exports only accept single images
+            for size in (self.warmup_batches if fmt == 'pt' else (1,)):
+                model.predict([image] * size if size > 1 else image, verbose=False)
+            return None
+
+        shape = tuple(model.input_shape[1:])
+        for size in self.warmup_batches:
+            outputs = model.predict(np.zeros((size,) + shape, dtype=np.float32), verbose=0)
+        if outputs.shape[-1] != len(loader.classification_classes):
+            raise ValueError(f"Model outputs {outputs.shape[-1]} classes, expected "
+                             f"{len(loader.classification_classes)}")
+        if not self.embeddings:
+            return None
+        embedding = loader.build_embedding_model(model)
+        embedding.predict(np.zeros((1,) + shape, dtype=np.float32), verbose=0)
+        return embedding
+
+    # ==================== DRAIN ====================
+
+    def _retire(self, key, version, model):
+        with self._lock:
+            self._retired.append({"key": key, "version": version, "model": model, "retired": time.perf_counter()})
+            if self._drainer is None:
+                self._drainer = threading.Thread(target=self._drain, name="model-drain", daemon=True)
+                self._drainer.start()
+
+    def _drain(self):
+        while True:
+            released = []
+            with self._lock:
+                for item in list(self._retired):
+                    waited = time.perf_counter() - item["retired"]
+                    in_flight = self.model_loader.in_flight(item["model"])
+                    if in_flight and waited < self.drain_timeout:
+                        continue
+                    self._retired.remove(item)
+                    released.append((item, in_flight, waited))
+                if not self._retired and not released:
+                    self._drainer = None
+                    return
+
+            for item, in_flight, waited in released:
+                self.model_loader.forget(item["model"])
+                if in_flight:
+                    print(f"⚠ {item['key']} version {item['version']} still has {in_flight} request(s) "
+                          f"after {waited:.0f}s, releasing it anyway")
+                else:
+                    print(f"✓ {item['key']} version {item['version']} drained after {waited * 1000:.0f}ms, released")
+            if released:
+                # Drop our references first; Keras models hold reference cycles
+                item = released = None
+                gc.collect()
+            time.sleep(0.1)
+
+    # ==================== WATCH ====================
+
+    def _manifest_mtime(self):
+        try:
+            return os.path.getmtime(self.manifest_path)
+        except OSError:
+            return None
+
+    def watch(self, poll_seconds):
+        """
+        Poll the manifest and reload models whose version changed
+        Args:
+            poll_seconds: Seconds between checks (0 disables watching)
+        """
+        if poll_seconds <= 0:
+            return
+        self._watch_seconds = poll_seconds
+
+        def run():
+            seen = self._manifest_mtime()
+            while not self._stop.wait(poll_seconds):
+                mtime = self._manifest_mtime()
+                if mtime is not None and mtime != seen:
+                    seen = mtime
+                    self.check_manifest()
+
+        threading.Thread(target=run, name="model-watch", daemon=True).start()
+
+    def shutdown(self):
+        self._stop.set()
+
+    def stats(self):
+        """
+        Served versions, reloads in progress and versions still draining
+        Returns:
+            dict
+        """
+        loader = self.model_loader
+        models = {}
+        for key, info in loader.versions.items():
+            model = loader.current_model(key)
+            models[key] = dict(info, in_flight=loader.in_flight(model) if model is not None else 0)
+        with self._lock:
+            now = time.perf_counter()
+            return {
+                "manifest": self.manifest_path if os.path.exists(self.manifest_path) else None,
+                "watch_seconds": self._watch_seconds,
+                "models": models,
+                "reloading": [dict(job) for job in self._reloading.values()],
+                "draining": [
+                    {"key": item["key"], "version": item["version"],
+                     "in_flight": loader.in_flight(item["model"]),
+                     "waiting_s": round(now - item["retired"], 1)}
+                    for item in self._retired
+                ],
+                "history": [dict(job) for job in self._history]
+            }
+
+
+def build_registry(model_loader, topology=None, predictor=None, batchers=None):
+    """
+    Create the model registry from environment variables and start watching the manifest
+    Swapped detection/count models resize their batcher in batchers: it shrinks to the new
+    model's batch limit before the swap and grows after it (see batching.py).
+    DL_MODEL_WATCH_SECONDS: manifest poll interval (default 5, 0 = reload only via the admin API)
+    DL_MODEL_WARMUP_BATCHES: batch sizes run through a new version before it serves (default 1)
+    DL_MODEL_DRAIN_TIMEOUT_S: max wait for requests on a replaced version (default 300)
+    Returns:
+        ModelRegistry
+    """
+    registry = ModelRegistry(
+        model_loader,
+        topology=topology,
+        warmup_batches=[int(n) for n in os.environ.get('DL_MODEL_WARMUP_BATCHES', '1').split(',') if n.strip()],
+        embeddings=getattr(predictor, 'similarity', None) is not None,
+        drain_timeout=float(os.environ.get('DL_MODEL_DRAIN_TIMEOUT_S', '300'))
+    )
+    if batchers is not None and predictor is not None:
+        def shrink_batcher(key, filename, fmt):
+            # Batches formed from now on already fit a static-shape export
+            if key in model_loader.detection_files:
+                limit_batcher(batchers, model_loader, key, filename, fmt)
+        registry.on_prepare(shrink_batcher)
+
+        def resize_batcher(key, version, model):
+            # A static-shape export only accepts single images, a dynamic one batches again
+            if key in model_loader.detection_files:
+                update_batcher(batchers, predictor, topology, key)
+        registry.on_install(resize_batcher)
+    similarity = getattr(predictor, 'similarity', None)
+    if similarity is not None:
+        def open_similarity_index(key, version, model):
+            # A new classifier version embeds into a new space: start its own index
+            if key in model_loader.classification_models:
+                embedding = model_loader.get_embedding_model(key, model)
+                similarity.open_version(key, version, int(embedding.outputs[0].shape[-1]))
+        registry.on_install(open_similarity_index)
+    registry.watch(float(os.environ.get('DL_MODEL_WATCH_SECONDS', '5')))
+    return registry
@@ -0,0 +1,329 @@
+"""
+Serialization - Fast JSON responses, compact box encoding and response compression
+Responses are encoded with orjson when it is installed (native numpy
+support, several times faster than the json module) and compressed with
+zstd, brotli or gzip, whichever the client accepts and the server has.
+Encode time and bytes before/after compression are recorded per route.
+"""
+import os
+import gzip
+import json
+import time
+import threading
+import importlib.util
+
+import anyio.to_thread
+from starlette.datastructures import Headers, MutableHeaders
+from starlette.responses import JSONResponse
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+BOX_FORMATS = ['objects', 'columnar']
+
+# Server preference, best ratio per CPU first
+ENCODINGS = ['zstd', 'br', 'gzip']
+
+# Fast settings: responses are compressed on the request path
+COMPRESSION_LEVELS = {'zstd': 3, 'br': 4, 'gzip': 5}
+
+# Bodies at least this large are compressed in a worker thread instead of on the event loop
+OFFLOAD_BYTES = 64 * 1024
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/')
+
+
+# ==================== JSON ====================
+
+def _numpy_default(value):
+    # numpy scalars/arrays without importing numpy (orjson handles most natively)
+    if hasattr(value, 'tolist'):
+        return value.tolist()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+
+def dumps(content):
+    """
+    Encode a response body as compact UTF-8 JSON (numpy arrays and scalars allowed)
+    Returns:
+        bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY, default=_numpy_default)
+    return json.dumps(content, ensure_ascii=False, allow_nan=False, separators=(",", ":"),
+                      default=_numpy_default).encode("utf-8")
+
+
+class FastJSONResponse(JSONResponse):
+    """JSONResponse using orjson (when installed) and recording encode time"""
+
+    def render(self, content):
+        start = time.perf_counter()
+        body = dumps(content)
+        serialization_stats.record_render((time.perf_counter() - start) * 1000, len(body))
+        return body
+
+
+def columnar_boxes(detections):
+    """
+    Encode detections column-wise instead of one object per box
+    Confidences are rounded to 4 decimals and coordinates to 0.1 px.
+    Args:
+        detections: List of {"class", "confidence", "bbox"} dicts
+    Returns:
+        dict with the distinct class names, a class index per box, the
+        confidences and the boxes as one flat [x1, y1, x2, y2, ...] list
+    """
+    names = []
+    index = {}
+    classes = []
+    confidences = []
+    boxes = []
+    for detection in detections:
+        name = detection["class"]
+        if name not in index:
+            index[name] = len(names)
+            names.append(name)
+        classes.append(index[name])
+        confidences.append(round(float(detection["confidence"]), 4))
+        boxes.extend(round(float(v), 1) for v in detection["bbox"])
+    return {
+        "format": "columnar",
+        "names": names,
+        "class": classes,
+        "confidence": confidences,
+        "bbox": boxes
+    }
+
+
+def format_boxes(detections, box_format):
+    """Encode detections in the requested box format ('objects' leaves them as they are)"""
+    if box_format == 'columnar':
+        return columnar_boxes(detections)
+    return detections
+
+
+# ==================== COMPRESSION ====================
+
+def available_encoders():
+    """Content-Encoding name -> compress(bytes) for the installed codecs"""
+    encoders = {'gzip': lambda data: gzip.compress(data, compresslevel=COMPRESSION_LEVELS['gzip'], mtime=0)}
+    if importlib.util.find_spec('brotli') is not None:
+        import brotli
+        encoders['br'] = lambda data: brotli.compress(data, quality=COMPRESSION_LEVELS['br'])
+    if importlib.util.find_spec('zstandard') is not None:
+        import zstandard
+        local = threading.local()
+
+        def zstd_compress(data):
+            # ZstdCompressor instances are not thread-safe: one per thread
+            compressor = getattr(local, 'compressor', None)
+            if compressor is None:
+                compressor = local.compressor = zstandard.ZstdCompressor(level=COMPRESSION_LEVELS['zstd'])
+            return compressor.compress(data)
+        encoders['zstd'] = zstd_compress
+    return encoders
+
+
+def parse_accept_encoding(value):
+    """
+    Parse an Accept-Encoding header
+    Returns:
+        dict mapping coding (lowercase) to its q-value
+    """
+    accepted = {}
+    for part in value.split(','):
+        coding, _, params = part.strip().partition(';')
+        coding = coding.strip().lower()
+        if not coding:
+            continue
+        q = 1.0
+        for param in params.split(';'):
+            name, _, number = param.strip().partition('=')
+            if name.strip() == 'q':
+                try:
+                    q = float(number)
+                except ValueError:
+                    q = 0.0
+        accepted[coding] = q
+    return accepted
+
+
+def negotiate(accept_encoding, preference):
+    """
+    Pick the response encoding
+    Args:
+        accept_encoding: The request's Accept-Encoding header
+        preference: Encodings the server offers, best first
+    Returns:
+        The chosen encoding, or None for an uncompressed response
+    """
+    accepted = parse_accept_encoding(accept_encoding or '')
+    wildcard = accepted.get('*', 0.0)
+    best, best_q = None, 0.0
+    for encoding in preference:
+        q = accepted.get(encoding, wildcard)
+        if q > best_q:
+            best, best_q = encoding, q
+    return best
+
+
+class CompressionMiddleware:
+    """ASGI middleware compressing single-chunk JSON/text responses with the negotiated encoding"""
+
+    def __init__(self, app, encodings=None, minimum_size=1024, offload_size=OFFLOAD_BYTES):
+        """
+        Args:
+            app: ASGI application
+            encodings: Offered encodings, best first (default: every installed one of ENCODINGS)
+            minimum_size: Smaller bodies are sent uncompressed
+            offload_size: Larger bodies are compressed in a worker thread so the event loop keeps serving
+        """
+        self.app = app
+        installed = available_encoders()
+        self.encoders = {name: installed[name] for name in (encodings or ENCODINGS) if name in installed}
+        self.preference = [name for name in (encodings or ENCODINGS) if name in self.encoders]
+        self.minimum_size = minimum_size
+        self.offload_size = offload_size
+        serialization_stats.encodings = list(self.preference)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        encoding = negotiate(Headers(scope=scope).get("accept-encoding"), self.preference)
+        start_message = None
+        streaming = False
+
+        async def send_compressed(message):
+            nonlocal start_message, streaming
+            if message["type"] == "http.response.start":
+                start_message = message
+                return
+            if message["type"] != "http.response.body" or streaming:
+                await send(message)
+                return
+            if message.get("more_body", False):
+                # Streamed bodies (files) go out as they are
+                streaming = True
+                await send(start_message)
+                await send(message)
+                return
+            await self._send_body(scope, start_message, message, encoding, send)
+
+        await self.app(scope, receive, send_compressed)
+
+    async def _send_body(self, scope, start_message, message, encoding, send):
+        body = message.get("body", b"")
+        raw_size = len(body)
+        headers = MutableHeaders(raw=start_message["headers"])
+        used = "identity"
+        compress_ms = 0.0
+
+        if encoding and raw_size >= self.minimum_size and "content-encoding" not in headers \
+                and headers.get("content-type", "").startswith(COMPRESSIBLE_TYPES):
+            start = time.perf_counter()
+            if raw_size >= self.offload_size:
+                compressed = await anyio.to_thread.run_sync(self.encoders[encoding], body)
+            else:
+                compressed = self.encoders[encoding](body)
+            compress_ms = (time.perf_counter() - start) * 1000
+            headers.add_vary_header("Accept-Encoding")
+            # Already-compressed payloads (e.g. mostly base64 JPEG) can grow
+            if len(compressed) < raw_size:
+                body = compressed
+                used = encoding
+                headers["Content-Encoding"] = encoding
+                headers["Content-Length"] = str(len(body))
+
+        serialization_stats.record_response(scope, used, raw_size, len(body), compress_ms)
+        await send(start_message)
+        await send({"type": "http.response.body", "body": body})
+
+
+# ==================== METRICS ====================
+
+class SerializationStats:
+    """JSON encode time and response sizes before/after compression (reported by /metrics)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.encodings = []
+        self._renders = 0
+        self._render_ms = 0.0
+        self._max_render_ms = 0.0
+        self._render_bytes = 0
+        self._routes = {}
+
+    def record_render(self, ms, size):
+        with self._lock:
+            self._renders += 1
+            self._render_ms += ms
+            self._max_render_ms = max(self._max_render_ms, ms)
+            self._render_bytes += size
+
+    def record_response(self, scope, encoding, raw_size, sent_size, compress_ms):
+        # Keyed by route template so /logs/{filename} is one entry
+        route = getattr(scope.get("route"), "path", None) or "other"
+        with self._lock:
+            entry = self._routes.setdefault(route, {
+                "responses": 0, "raw_bytes": 0, "sent_bytes": 0, "compress_ms": 0.0, "encodings": {}
+            })
+            entry["responses"] += 1
+            entry["raw_bytes"] += raw_size
+            entry["sent_bytes"] += sent_size
+            entry["compress_ms"] += compress_ms
+            entry["encodings"][encoding] = entry["encodings"].get(encoding, 0) + 1
+
+    def stats(self):
+        with self._lock:
+            routes = {}
+            for route, entry in sorted(self._routes.items()):
+                responses = entry["responses"]
+                routes[route] = {
+                    "responses": responses,
+                    "mean_raw_bytes": round(entry["raw_bytes"] / responses),
+                    "mean_sent_bytes": round(entry["sent_bytes"] / responses),
+                    "compression_ratio": round(entry["raw_bytes"] / entry["sent_bytes"], 3) if entry["sent_bytes"] else 1.0,
+                    "mean_compress_ms": round(entry["compress_ms"] / responses, 3),
+                    "encodings": dict(entry["encodings"])
+                }
+            return {
+                "json_encoder": "orjson" if orjson is not None else "json",
+                "encodings": self.encodings,
+                "rendered": self._renders,
+                "mean_render_ms": round(self._render_ms / self._renders, 3) if self._renders else 0.0,
+                "max_render_ms": round(self._max_render_ms, 3),
+                "mean_render_bytes": round(self._render_bytes / self._renders) if self._renders else 0,
+                "routes": routes
+            }
+
+
+serialization_stats = SerializationStats()
+
+
+def compression_settings():
+    """
+    Compression settings from environment variables
+    DL_COMPRESSION: offered encodings, best first (default 'zstd,br,gzip'; 'off' disables)
+    DL_COMPRESSION_MIN_BYTES: smallest body worth compressing (default 1024)
+    DL_COMPRESSION_OFFLOAD_BYTES: bodies this large are compressed off the event loop (default 65536)
+    Returns:
+        dict of CompressionMiddleware keyword arguments, or None when disabled
+    """
+    value = os.environ.get('DL_COMPRESSION', ','.join(ENCODINGS)).strip().lower()
+    if value in ('', 'off', '0', 'none'):
+        return None
+    encodings = [name.strip() for name in value.split(',') if name.strip()]
+    unknown = [name for name in encodings if name not in ENCODINGS]
+    if unknown:
+        raise ValueError(f"Unknown DL_COMPRESSION encodings: {unknown}. Available: {ENCODINGS}")
+    return {
+        "encodings": encodings,
+        "minimum_size": int(os.environ.get('DL_COMPRESSION_MIN_BYTES', '1024')),
+        "offload_size": int(os.environ.get('DL_COMPRESSION_OFFLOAD_BYTES', str(OFFLOAD_BYTES)))
+    }
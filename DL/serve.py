@@ -0,0 +1,194 @@
+"""
+Serve - Production multi-worker server for the Blood Cell Analysis API
+One inference broker process loads every model once and N HTTP worker
+processes share it over shared memory, so adding a worker costs almost
+no memory. Workers never import TensorFlow or torch.
+
+Usage:
+    python serve.py --workers auto --port 8000
+    DL_CLASSIFICATION_THREADS=4 DL_DETECTION_THREADS=4 python serve.py --workers-per-core 0.5
+"""
+import os
+# Force TensorFlow to use legacy Keras 2.x for compatibility with older models
+os.environ['TF_USE_LEGACY_KERAS'] = '1'
+
+import argparse
+import math
+import multiprocessing as mp
+import queue
+import signal
+import socket
+import time
+
+from inference_broker import run_broker
+
+
+def available_cores():
+    """Number of cores this process may run on"""
+    if hasattr(os, 'sched_getaffinity'):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def resolve_worker_count(workers, workers_per_core):
+    """
+    Work out how many HTTP workers to start
+    Args:
+        workers: Explicit count or 'auto'
+        workers_per_core: Workers per available core when workers is 'auto'
+    Returns:
+        Number of workers (at least 1)
+    """
+    if workers and workers != 'auto':
+        return max(int(workers), 1)
+    return max(int(math.ceil(available_cores() * workers_per_core)), 1)
+
+
+def bind_socket(host, port, backlog=2048):
+    """Create the listening socket shared by every worker"""
+    sock = socket.socket(socket.AF_INET6 if ':' in host else socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(index, sock, request_queue, response_queue, description, log_level):
+    """
+    HTTP worker process entry point
+    Args:
+        index: Worker index (selects its response queue)
+        sock: Shared listening socket
+        request_queue: Broker request queue
+        response_queue: This worker's response queue
+        description: Model metadata reported by the broker
+        log_level: uvicorn log level
+    """
+    import uvicorn
+    import main
+    from inference_broker import BrokerClient, RemoteModelLoader, RemotePredictor
+
+    model_loader = RemoteModelLoader(description)
+    main.model_loader = model_loader
+    main.predictor = RemotePredictor(BrokerClient(index, request_queue, response_queue), model_loader)
+
+    config = uvicorn.Config(main.app, log_level=log_level)
+    server = uvicorn.Server(config)
+    server.run(sockets=[sock])
+
+
+class Supervisor:
+    """Start the broker and workers, restart crashed workers, shut down cleanly"""
+
+    def __init__(self, args):
+        self.args = args
+        self.ctx = mp.get_context('spawn')
+        self.num_workers = resolve_worker_count(args.workers, args.workers_per_core)
+        self.request_queue = self.ctx.Queue()
+        self.response_queues = [self.ctx.Queue() for _ in range(self.num_workers)]
+        self.ready_queue = self.ctx.Queue()
+        self.broker = None
+        self.workers = [None] * self.num_workers
+        self.description = None
+        self.sock = None
+        self.stopping = False
+
+    def start_broker(self):
+        self.broker = self.ctx.Process(
+            target=run_broker,
+            args=(self.request_queue, self.response_queues, self.ready_queue, self.args.models_dir),
+            name="inference-broker"
+        )
+        self.broker.start()
+
+        # Wait for the broker to finish loading models
+        while True:
+            try:
+                self.description = self.ready_queue.get(timeout=1.0)
+                return
+            except queue.Empty:
+                if not self.broker.is_alive():
+                    raise RuntimeError("Inference broker exited during startup")
+                if self.stopping:
+                    raise RuntimeError("Interrupted during startup")
+
+    def start_worker(self, index):
+        process = self.ctx.Process(
+            target=run_worker,
+            args=(index, self.sock, self.request_queue, self.response_queues[index],
+                  self.description, self.args.log_level),
+            name=f"http-worker-{index}"
+        )
+        process.start()
+        self.workers[index] = process
+        print(f"✓ HTTP worker {index} started (pid {process.pid})")
+
+    def handle_signal(self, signum, frame):
+        self.stopping = True
+
+    def run(self):
+        signal.signal(signal.SIGINT, self.handle_signal)
+        signal.signal(signal.SIGTERM, self.handle_signal)
+
+        print("=" * 60)
+        print("Blood Cell Analysis API - production serving")
+        print(f"Workers: {self.num_workers} ({available_cores()} cores available)")
+        print("=" * 60)
+
+        self.sock = bind_socket(self.args.host, self.args.port)
+        try:
+            self.start_broker()
+            for index in range(self.num_workers):
+                self.start_worker(index)
+            print(f"✓ API available at: http://{self.args.host}:{self.args.port}")
+
+            while not self.stopping:
+                time.sleep(1.0)
+                if not self.broker.is_alive():
+                    print("✗ Inference broker died, shutting down")
+                    break
+                for index, process in enumerate(self.workers):
+                    if not process.is_alive() and not self.stopping:
+                        print(f"⚠ HTTP worker {index} exited with code {process.exitcode}, restarting")
+                        self.start_worker(index)
+        finally:
+            self.shutdown()
+
+    def shutdown(self):
+        print("\nShutting down Blood Cell Analysis API...")
+        for process in self.workers:
+            if process is not None and process.is_alive():
+                process.terminate()
+        for process in self.workers:
+            if process is not None:
+                process.join(timeout=self.args.graceful_timeout)
+
+        if self.broker is not None and self.broker.is_alive():
+            self.request_queue.put(None)
+            self.broker.join(timeout=self.args.graceful_timeout)
+            if self.broker.is_alive():
+                self.broker.terminate()
+
+        if self.sock is not None:
+            self.sock.close()
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Multi-worker server for the blood cell DL service")
+    parser.add_argument("--host", default=os.environ.get("DL_HOST", "0.0.0.0"))
+    parser.add_argument("--port", type=int, default=int(os.environ.get("DL_PORT", "8000")))
+    parser.add_argument("--workers", default=os.environ.get("DL_WORKERS", "auto"),
+                        help="Number of HTTP workers or 'auto'")
+    parser.add_argument("--workers-per-core", type=float,
+                        default=float(os.environ.get("DL_WORKERS_PER_CORE", "1.0")),
+                        help="HTTP workers per available core when --workers is 'auto'")
+    parser.add_argument("--models-dir", default="models", help="Directory containing the model files")
+    parser.add_argument("--graceful-timeout", type=float, default=30.0,
+                        help="Seconds to wait for processes to exit on shutdown")
+    parser.add_argument("--log-level", default="info", help="uvicorn log level")
+    return parser
+
+
+if __name__ == "__main__":
+    Supervisor(build_parser().parse_args()).run()
@@ -0,0 +1,395 @@
+"""
+Similarity - Persistent nearest-neighbour index over classifier embeddings
+Every classification model version gets its own index of L2-normalized
+penultimate layer embeddings, so vectors from different embedding spaces
+are never compared. Vectors and metadata are appended to disk as they arrive;
+the hnswlib graph (or the exact numpy fallback when hnswlib is not
+installed) is rebuilt from them on startup if it is missing or stale.
+"""
+import os
+import re
+import json
+import base64
+import queue
+import pickle
+import hashlib
+import threading
+import importlib.util
+from datetime import datetime
+
+import numpy as np
+
+
+VECTORS_FILE = "vectors.f32"
+META_FILE = "meta.jsonl"
+GRAPH_FILE = "index.hnsw"
+GRAPH_INFO_FILE = "index.json"
+
+# Same as model_loader.BUILTIN_VERSION; indexes of built-in models keep the plain <model_id>/ directory
+BUILTIN_VERSION = "builtin"
+
+
+def index_name(model_id, version=None):
+    """Directory name of a model version's index: <model_id> or <model_id>@<version>"""
+    if not version or version == BUILTIN_VERSION:
+        return model_id
+    return f"{model_id}@{re.sub(r'[^A-Za-z0-9._-]', '_', str(version))}"
+
+
+def image_hash(array):
+    """Key identifying an image (its preprocessed pixels), so it is indexed once"""
+    return hashlib.sha1(np.ascontiguousarray(array).tobytes()).hexdigest()
+
+
+class EmbeddingIndex:
+    """Append-only embedding store with a nearest-neighbour index for one model"""
+
+    def __init__(self, directory, dim, use_hnsw=True, capacity=1024):
+        """
+        Args:
+            directory: Directory holding this model's vectors, metadata and graph
+            dim: Embedding size
+            use_hnsw: Use hnswlib (approximate) instead of exact numpy search
+            capacity: Initial number of slots, doubled as the index grows
+        """
+        self.directory = directory
+        self.dim = dim
+        self.use_hnsw = use_hnsw
+        self.capacity = capacity
+        self.meta = []
+        self.keys = {}
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()  # One graph write at a time
+        self._since_save = 0
+        self._vectors = np.empty((capacity, dim), dtype=np.float32)
+        self._graph = None
+        os.makedirs(directory, exist_ok=True)
+        self._load()
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _load(self):
+        meta_path = self._path(META_FILE)
+        if os.path.exists(meta_path):
+            with open(meta_path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        try:
+                            self.meta.append(json.loads(line))
+                        except ValueError:
+                            break  # Partially written last line
+        vectors_path = self._path(VECTORS_FILE)
+        vectors = np.fromfile(vectors_path, dtype=np.float32) if os.path.exists(vectors_path) else np.empty(0)
+        count = min(len(self.meta), len(vectors) // self.dim)
+        self.meta = self.meta[:count]
+        # Drop anything written after the last complete entry
+        with open(vectors_path, 'ab') as f:
+            f.truncate(count * self.dim * 4)
+        with open(meta_path, 'w', encoding='utf-8') as f:
+            f.writelines(json.dumps(m) + '\n' for m in self.meta)
+
+        self._grow(count)
+        self._vectors[:count] = vectors[:count * self.dim].reshape(count, self.dim)
+        self.keys = {m["image_hash"]: m["id"] for m in self.meta}
+        if self.use_hnsw:
+            self._load_graph(count)
+
+    def _grow(self, needed):
+        if needed <= len(self._vectors):
+            return
+        capacity = len(self._vectors)
+        while capacity < needed:
+            capacity *= 2
+        vectors = np.empty((capacity, self.dim), dtype=np.float32)
+        vectors[:len(self.meta)] = self._vectors[:len(self.meta)]
+        self._vectors = vectors
+        if self._graph is not None:
+            self._graph.resize_index(capacity)
+
+    def _load_graph(self, count):
+        import hnswlib
+
+        self._graph = hnswlib.Index(space='ip', dim=self.dim)
+        indexed = 0
+        info_path = self._path(GRAPH_INFO_FILE)
+        if os.path.exists(self._path(GRAPH_FILE)) and os.path.exists(info_path):
+            with open(info_path, 'r', encoding='utf-8') as f:
+                indexed = json.load(f).get("indexed", 0)
+            if 0 < indexed <= count:
+                self._graph.load_index(self._path(GRAPH_FILE), max_elements=len(self._vectors))
+            else:
+                indexed = 0
+        if not indexed:
+            self._graph.init_index(max_elements=len(self._vectors), ef_construction=200, M=16)
+        if indexed < count:
+            # Vectors appended after the graph was last saved
+            self._graph.add_items(self._vectors[indexed:count], np.arange(indexed, count))
+            self._since_save = count - indexed
+            print(f"✓ Added {count - indexed} embedding(s) to the index in {self.directory}")
+
+    def __len__(self):
+        return len(self.meta)
+
+    def add(self, vector, meta):
+        """
+        Append an embedding (ignored if its image_hash is already indexed)
+        Args:
+            vector: L2-normalized float32 vector
+            meta: JSON-serializable dict with at least 'image_hash'
+        Returns:
+            Item id, or the existing id for an already indexed image
+        """
+        with self._lock:
+            existing = self.keys.get(meta["image_hash"])
+            if existing is not None:
+                return existing
+            item_id = len(self.meta)
+            meta = dict(meta, id=item_id)
+            self._grow(item_id + 1)
+            self._vectors[item_id] = vector
+            # Vector first: a crash between the writes leaves an orphan vector, which _load drops
+            with open(self._path(VECTORS_FILE), 'ab') as f:
+                f.write(vector.astype(np.float32).tobytes())
+            with open(self._path(META_FILE), 'a', encoding='utf-8') as f:
+                f.write(json.dumps(meta) + '\n')
+            if self._graph is not None:
+                self._graph.add_items(vector[None, :], [item_id])
+            self.meta.append(meta)
+            self.keys[meta["image_hash"]] = item_id
+            self._since_save += 1
+            return item_id
+
+    def search(self, vector, k=10, exclude=None):
+        """
+        Find the most similar stored embeddings
+        Args:
+            vector: L2-normalized query vector
+            k: Number of neighbours
+            exclude: Optional image_hash left out of the results (the query itself)
+        Returns:
+            list of (item id, cosine similarity), most similar first
+        """
+        with self._lock:
+            count = len(self.meta)
+            skip = self.keys.get(exclude) if exclude else None
+            wanted = min(k + (skip is not None), count)
+            if wanted == 0:
+                return []
+            if self._graph is not None:
+                self._graph.set_ef(max(wanted * 2, 64))
+                labels, distances = self._graph.knn_query(vector[None, :], k=wanted)
+                found = [(int(i), 1.0 - float(d)) for i, d in zip(labels[0], distances[0])]
+            else:
+                scores = self._vectors[:count] @ vector
+                top = np.argpartition(-scores, wanted - 1)[:wanted]
+                top = top[np.argsort(-scores[top])]
+                found = [(int(i), float(scores[i])) for i in top]
+        return [(i, score) for i, score in found if i != skip][:k]
+
+    def save(self):
+        """Write the hnswlib graph (vectors and metadata are already on disk)"""
+        with self._save_lock:
+            with self._lock:
+                if self._graph is None or not self._since_save:
+                    return
+                # In-memory copy; the slow write below runs without blocking add/search
+                graph = pickle.loads(pickle.dumps(self._graph))
+                indexed, pending = len(self.meta), self._since_save
+            graph_path = self._path(GRAPH_FILE)
+            graph.save_index(graph_path + '.tmp')
+            os.replace(graph_path + '.tmp', graph_path)
+            with open(self._path(GRAPH_INFO_FILE), 'w', encoding='utf-8') as f:
+                json.dump({"indexed": indexed, "dim": self.dim}, f)
+            with self._lock:
+                self._since_save -= pending
+
+
+class SimilarityIndex:
+    """One EmbeddingIndex per classification model, plus cell thumbnails"""
+
+    def __init__(self, directory="embeddings", backend="auto", save_every=10000, thumbnail_size=96,
+                 index_predictions=True):
+        """
+        Args:
+            directory: Root directory for the indexes and thumbnails
+            backend: 'auto' (hnswlib if installed), 'hnswlib' or 'numpy' (exact search)
+            save_every: Write an index's graph after this many additions, on a background
+                thread (and on shutdown)
+            thumbnail_size: Longest side of stored thumbnails (0 disables them)
+            index_predictions: Add every classification prediction to the index
+        """
+        if backend not in ('auto', 'hnswlib', 'numpy'):
+            raise ValueError(f"Unknown index backend: {backend}. Available: ['auto', 'hnswlib', 'numpy']")
+        has_hnsw = importlib.util.find_spec('hnswlib') is not None
+        if backend == 'hnswlib' and not has_hnsw:
+            print("⚠ hnswlib is not installed, using exact numpy search")
+        self.directory = directory
+        self.use_hnsw = has_hnsw and backend != 'numpy'
+        self.save_every = save_every
+        self.thumbnail_size = thumbnail_size
+        self.index_predictions = index_predictions
+        self.indexes = {}
+        self._lock = threading.Lock()
+        self._searches = 0
+        self._added = 0
+        # Periodic graph saves run off the request path
+        self._save_queue = queue.Queue()
+        self._saving = set()
+        threading.Thread(target=self._save_loop, name="similarity-save", daemon=True).start()
+
+    def index_for(self, model_id, dim, version=None):
+        name = index_name(model_id, version)
+        with self._lock:
+            index = self.indexes.get(name)
+            if index is None:
+                index = EmbeddingIndex(os.path.join(self.directory, name), dim, use_hnsw=self.use_hnsw)
+                self.indexes[name] = index
+            elif index.dim != dim:
+                raise ValueError(f"Embedding size for {name} changed from {index.dim} to {dim}")
+            return index
+
+    def open_version(self, model_id, version, dim):
+        """
+        Start the index of a newly served model version (called when a classifier is swapped)
+        The other versions' indexes are saved; they stay open for requests still draining on them.
+        Args:
+            model_id: Classification model id
+            version: Version now served
+            dim: Embedding size of the new version
+        """
+        name = index_name(model_id, version)
+        with self._lock:
+            previous = [index for key, index in self.indexes.items()
+                        if key != name and (key == model_id or key.startswith(model_id + '@'))]
+        for index in previous:
+            index.save()
+        index = self.index_for(model_id, dim, version)
+        print(f"✓ Similarity index for {model_id} version {version}: {len(index)} item(s) in {index.directory}")
+
+    @staticmethod
+    def image_key(array):
+        return image_hash(array)
+
+    @staticmethod
+    def normalize(embedding):
+        vector = np.asarray(embedding, dtype=np.float32).reshape(-1)
+        return vector / (np.linalg.norm(vector) + 1e-12)
+
+    def _thumbnail_path(self, key):
+        return os.path.join(self.directory, "thumbnails", key[:2], f"{key}.jpg")
+
+    def _save_thumbnail(self, key, image):
+        path = self._thumbnail_path(key)
+        if not self.thumbnail_size or image is None or os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        thumbnail = image.copy()
+        thumbnail.thumbnail((self.thumbnail_size, self.thumbnail_size))
+        thumbnail.save(path + '.tmp', format='JPEG', quality=85)
+        os.replace(path + '.tmp', path)
+
+    def _thumbnail(self, key):
+        path = self._thumbnail_path(key)
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            return base64.b64encode(f.read()).decode()
+
+    def add(self, model_id, embedding, key, image=None, version=None, **meta):
+        """
+        Add an embedding to the model version's index
+        Args:
+            model_id: Classification model that produced the embedding
+            embedding: Penultimate-layer output
+            key: image_hash of the source image
+            image: Optional PIL Image for the thumbnail
+            version: Model version that produced the embedding (see ModelLoader.version_of)
+            meta: Extra fields stored with the item (predicted_class, confidence, source)
+        Returns:
+            Item id
+        """
+        vector = self.normalize(embedding)
+        index = self.index_for(model_id, len(vector), version)
+        self._save_thumbnail(key, image)
+        item_id = index.add(vector, dict(meta, image_hash=key, model_version=version or BUILTIN_VERSION,
+                                         created_at=datetime.now().isoformat(timespec='seconds')))
+        with self._lock:
+            self._added += 1
+            due = index._since_save >= self.save_every and index.directory not in self._saving
+            if due:
+                self._saving.add(index.directory)
+        if due:
+            self._save_queue.put(index)
+        return item_id
+
+    def _save_loop(self):
+        while True:
+            index = self._save_queue.get()
+            try:
+                index.save()
+            except Exception as e:
+                print(f"⚠ Could not save the similarity index in {index.directory}: {str(e)}")
+            finally:
+                with self._lock:
+                    self._saving.discard(index.directory)
+
+    def search(self, model_id, embedding, k=10, exclude=None, version=None):
+        """
+        Find the k most similar previously indexed cells of the same model version
+        Returns:
+            list of dicts with id, similarity, stored metadata and thumbnail
+        """
+        vector = self.normalize(embedding)
+        index = self.index_for(model_id, len(vector), version)
+        with self._lock:
+            self._searches += 1
+        neighbours = []
+        for item_id, score in index.search(vector, k=k, exclude=exclude):
+            meta = index.meta[item_id]
+            neighbours.append(dict(meta, similarity=round(score, 6), thumbnail=self._thumbnail(meta["image_hash"])))
+        return neighbours
+
+    def save_all(self):
+        for index in list(self.indexes.values()):
+            index.save()
+
+    def stats(self):
+        """
+        Index sizes and counters
+        Returns:
+            dict with the backend and items per model version index
+        """
+        with self._lock:
+            return {
+                "backend": "hnswlib" if self.use_hnsw else "numpy",
+                "index_predictions": self.index_predictions,
+                "items": {name: len(index) for name, index in self.indexes.items()},
+                "added": self._added,
+                "searches": self._searches
+            }
+
+
+def build_similarity_index():
+    """
+    Create the similarity index from environment variables
+    DL_EMBEDDING_INDEX: 0 disables the index and the /embeddings endpoint (default 1)
+    DL_EMBEDDING_INDEX_PREDICTIONS: 0 only indexes images sent to /embeddings (default 1)
+    DL_EMBEDDING_DIR: where indexes and thumbnails are stored (default 'embeddings')
+    DL_EMBEDDING_BACKEND: 'auto' (default), 'hnswlib' or 'numpy'
+    DL_EMBEDDING_SAVE_EVERY: additions between graph saves (default 10000)
+    DL_EMBEDDING_THUMBNAIL: thumbnail size in pixels, 0 disables (default 96)
+    Returns:
+        SimilarityIndex, or None when disabled
+    """
+    if os.environ.get('DL_EMBEDDING_INDEX', '1') == '0':
+        return None
+    index = SimilarityIndex(
+        directory=os.environ.get('DL_EMBEDDING_DIR', 'embeddings'),
+        backend=os.environ.get('DL_EMBEDDING_BACKEND', 'auto').lower(),
+        save_every=int(os.environ.get('DL_EMBEDDING_SAVE_EVERY', '10000')),
+        thumbnail_size=int(os.environ.get('DL_EMBEDDING_THUMBNAIL', '96')),
+        index_predictions=os.environ.get('DL_EMBEDDING_INDEX_PREDICTIONS', '1') != '0'
+    )
+    print(f"✓ Similarity index ({index.stats()['backend']}) in {index.directory}/")
+    return index
@@ -0,0 +1,249 @@
+"""
+Stand-in Models - Lightweight substitutes for the Keras and YOLO models
+Used by the benchmark/load-testing tools on machines without the real weights
+"""
+import time
+import numpy as np
+import cv2
+from contextlib import contextmanager
+
+
+# Same identifiers as ModelLoader.model_files
+CLASSIFIER_IDS = ['resnet-50', 'densenet-121', 'mobilenet-v2', 'efficientnet-b0', 'cnn', 'vit-base']
+
+
+class HostArray(np.ndarray):
+    """numpy array exposing the .cpu().numpy() calls used on torch tensors"""
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return np.asarray(self)
+
+
+def _host(array):
+    return np.asarray(array).view(HostArray)
+
+
+class StandInClassifier:
+    """Keras-like classifier returning deterministic softmax outputs"""
+
+    def __init__(self, num_classes=5, base_ms=2.0, per_image_ms=1.0, seed=0):
+        """
+        Args:
+            num_classes: Number of output classes
+            base_ms: Fixed cost per predict() call
+            per_image_ms: Additional cost per image in the batch
+            seed: Seed for the projection weights
+        """
+        self.num_classes = num_classes
+        self.base_ms = base_ms
+        self.per_image_ms = per_image_ms
+        rng = np.random.default_rng(seed)
+        # Project a 28x28x3 thumbnail so outputs depend on the input
+        self.weights = rng.standard_normal((28 * 28 * 3, num_classes)).astype(np.float32)
+
+    def features(self, batch):
+        """28x28x3 thumbnails, the stand-in for penultimate-layer features"""
+        batch = np.asarray(batch, dtype=np.float32)
+        # Frameworks release the GIL during compute, sleep does the same
+        time.sleep((self.base_ms + self.per_image_ms * len(batch)) / 1000.0)
+        step = max(batch.shape[1] // 28, 1)
+        return batch[:, ::step, ::step, :][:, :28, :28, :].reshape(len(batch), -1)
+
+    def softmax(self, features):
+        logits = features @ self.weights[:features.shape[1]]
+        logits -= logits.max(axis=1, keepdims=True)
+        exp = np.exp(logits)
+        return exp / exp.sum(axis=1, keepdims=True)
+
+    def predict(self, batch, verbose=0):
+        return self.softmax(self.features(batch))
+
+
+class StandInEmbeddingModel:
+    """Two-output view of a StandInClassifier: (features, softmax)"""
+
+    def __init__(self, classifier):
+        self.classifier = classifier
+
+    def predict(self, batch, verbose=0):
+        features = self.classifier.features(batch)
+        return [features, self.classifier.softmax(features)]
+
+
+class StandInBoxes:
+    """Ultralytics-like Boxes container"""
+
+    def __init__(self, cls, conf, xyxy):
+        self.cls = _host(cls)
+        self.conf = _host(conf)
+        self.xyxy = _host(xyxy)
+
+    def __len__(self):
+        return len(self.cls)
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield StandInBoxes(self.cls[i:i + 1], self.conf[i:i + 1], self.xyxy[i:i + 1])
+
+
+class StandInResults:
+    """Ultralytics-like Results for a single image"""
+
+    def __init__(self, orig_img, boxes, names):
+        self.orig_img = orig_img
+        self.boxes = boxes
+        self.names = names
+
+    def __getitem__(self, index):
+        boxes = StandInBoxes(self.boxes.cls[index], self.boxes.conf[index], self.boxes.xyxy[index])
+        return StandInResults(self.orig_img, boxes, self.names)
+
+    def plot(self, labels=True, conf=True):
+        img = self.orig_img.copy()
+        for i in range(len(self.boxes)):
+            x1, y1, x2, y2 = (int(v) for v in self.boxes.xyxy[i])
+            color = (56, 56, 255) if int(self.boxes.cls[i]) == 0 else (151, 157, 255)
+            cv2.rectangle(img, (x1, y1), (x2, y2), color, 2)
+            if labels:
+                text = self.names[int(self.boxes.cls[i])]
+                if conf:
+                    text += f" {float(self.boxes.conf[i]):.2f}"
+                cv2.putText(img, text, (x1, max(y1 - 4, 0)), cv2.FONT_HERSHEY_SIMPLEX, 0.5, color, 1)
+        return img
+
+
+class StandInDetector:
+    """YOLO-like detector producing deterministic boxes scaled to image area"""
+
+    def __init__(self, names=None, base_ms=15.0, per_image_ms=10.0, cells_per_mpx=120):
+        """
+        Args:
+            names: Class index to name mapping
+            base_ms: Fixed cost per predict() call
+            per_image_ms: Additional cost per image in the batch
+            cells_per_mpx: Number of candidate boxes per megapixel
+        """
+        self.names = names or {0: 'RBC', 1: 'WBC'}
+        self.base_ms = base_ms
+        self.per_image_ms = per_image_ms
+        self.cells_per_mpx = cells_per_mpx
+
+    def _boxes_for(self, image, conf):
+        h, w = image.shape[:2]
+        rng = np.random.default_rng(h * 100003 + w)
+        n = max(int(self.cells_per_mpx * h * w / 1e6), 1)
+        size = max(min(h, w) // 12, 4)
+        x1 = rng.uniform(0, max(w - size, 1), n)
+        y1 = rng.uniform(0, max(h - size, 1), n)
+        xyxy = np.stack([x1, y1, x1 + size, y1 + size], axis=1).astype(np.float32)
+        scores = rng.uniform(0.05, 0.99, n).astype(np.float32)
+        classes = (rng.uniform(0, 1, n) < 0.1).astype(np.float32)  # ~10% WBC
+        keep = scores >= conf
+        return StandInBoxes(classes[keep], scores[keep], xyxy[keep])
+
+    def predict(self, source, conf=0.25, verbose=False, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        images = [np.asarray(img) for img in images]
+        time.sleep((self.base_ms + self.per_image_ms * len(images)) / 1000.0)
+        return [StandInResults(img, self._boxes_for(img, conf), self.names) for img in images]
+
+
+class StandInModelLoader:
+    """Drop-in replacement for ModelLoader backed by stand-in models"""
+
+    def __init__(self, models_dir="models", load_ms=50.0):
+        """
+        Args:
+            models_dir: Unused, kept for signature compatibility
+            load_ms: Simulated load time per model
+        """
+        self.models_dir = models_dir
+        self.load_ms = load_ms
+        self.classification_models = {model_id: None for model_id in CLASSIFIER_IDS}
+        self.detection_model = None
+        self.detection_count_model = None
+        self.classification_classes = ['basophil', 'eosinophil', 'lymphocyte', 'monocyte', 'neutrophil']
+        self.detection_count_classes = ["RBC", "WBC"]
+        self.model_files = {model_id: f"standin-{model_id}" for model_id in CLASSIFIER_IDS}
+
+    def load_classification_model(self, model_id='mobilenet-v2'):
+        time.sleep(self.load_ms / 1000.0)
+        self.classification_models[model_id] = StandInClassifier(
+            num_classes=len(self.classification_classes), seed=CLASSIFIER_IDS.index(model_id)
+        )
+        return self.classification_models[model_id]
+
+    def load_all_models(self):
+        for model_id in CLASSIFIER_IDS:
+            self.load_classification_model(model_id)
+        time.sleep(self.load_ms / 1000.0)
+        self.detection_model = StandInDetector(names={0: 'cell', 1: 'platelet'})
+        time.sleep(self.load_ms / 1000.0)
+        self.detection_count_model = StandInDetector()
+        print("✓ Stand-in models loaded")
+        return True
+
+    def detection_batch_limit(self, task, filename=None, fmt=None):
+        return None
+
+    def get_classification_model(self, model_id='mobilenet-v2'):
+        if model_id not in self.classification_models:
+            raise ValueError(f"Unknown model ID: {model_id}. Available: {list(self.classification_models.keys())}")
+        return self.classification_models[model_id]
+
+    def get_embedding_model(self, model_id='mobilenet-v2', model=None):
+        return StandInEmbeddingModel(model or self.get_classification_model(model_id))
+
+    def version_of(self, model):
+        return "builtin"
+
+    @contextmanager
+    def lease(self, key):
+        if key == 'detection':
+            yield self.get_detection_model()
+        elif key == 'count':
+            yield self.get_detection_count_model()
+        else:
+            yield self.get_classification_model(key)
+
+    def get_available_classification_models(self):
+        return [model_id for model_id, model in self.classification_models.items() if model is not None]
+
+    def get_detection_model(self):
+        if self.detection_model is None:
+            raise ValueError("Detection model not loaded.")
+        return self.detection_model
+
+    def get_detection_count_model(self):
+        if self.detection_count_model is None:
+            raise ValueError("Detection count model not loaded.")
+        return self.detection_count_model
+
+
+def synthetic_smear(width, height, seed=0):
+    """
+    Generate a synthetic blood smear image
+    Args:
+        width: Image width
+        height: Image height
+        seed: Random seed
+    Returns:
+        RGB numpy array (uint8)
+    """
+    rng = np.random.default_rng(seed)
+    image = np.empty((height, width, 3), dtype=np.uint8)
+    image[:] = (238, 214, 220)  # pale pink background
+    radius = max(min(width, height) // 30, 3)
+    num_cells = max(int(width * height / (radius * radius * 12)), 1)
+    for _ in range(num_cells):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(image, center, radius, (205, 110, 120), -1)
+    # A few larger, darker nucleated cells
+    for _ in range(max(num_cells // 40, 1)):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        cv2.circle(image, center, radius * 2, (110, 70, 160), -1)
+    noise = rng.integers(0, 12, image.shape, dtype=np.uint8)
+    return cv2.add(image, noise)
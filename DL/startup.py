@@ -0,0 +1,83 @@
+"""
+Startup - Startup state and timing breakdown reported by the health endpoints
+"""
+import time
+import threading
+from contextlib import contextmanager
+
+from profiler import StageTimer
+
+
+class StartupTracker(StageTimer):
+    """Track startup phases so health checks can report progress and timings"""
+
+    def __init__(self, mode="eager", started=None):
+        """
+        Args:
+            mode: 'eager' (load before listening) or 'lazy' (load in the background)
+            started: perf_counter() value startup is measured from
+        """
+        super().__init__()
+        if started is not None:
+            self.started = started
+        self.mode = mode
+        self.state = "starting"  # starting -> loading -> ready | failed
+        self.current_phase = None
+        self.error = None
+        self.listening_ms = None
+        self.ready_ms = None
+        self._lock = threading.Lock()
+
+    def elapsed_ms(self):
+        return (time.perf_counter() - self.started) * 1000
+
+    @contextmanager
+    def stage(self, name):
+        with self._lock:
+            self.current_phase = name
+        try:
+            with super().stage(name):
+                yield
+        finally:
+            with self._lock:
+                self.current_phase = None
+
+    def mark_loading(self):
+        with self._lock:
+            self.state = "loading"
+
+    def mark_listening(self):
+        with self._lock:
+            self.listening_ms = self.elapsed_ms()
+
+    def mark_ready(self):
+        with self._lock:
+            self.state = "ready"
+            self.ready_ms = self.elapsed_ms()
+
+    def mark_failed(self, error):
+        with self._lock:
+            self.state = "failed"
+            self.error = f"{type(error).__name__}: {str(error)}"
+
+    @property
+    def ready(self):
+        return self.state == "ready"
+
+    def summary(self):
+        """
+        Get the startup breakdown
+        Returns:
+            dict with state, per-phase milliseconds and milestones
+        """
+        with self._lock:
+            return {
+                "mode": self.mode,
+                "state": self.state,
+                "current_phase": self.current_phase,
+                "phases_ms": {name: round(ms, 3) for name, ms in self.stages.items()},
+                "listening_ms": round(self.listening_ms, 3) if self.listening_ms is not None else None,
+                "ready_ms": round(self.ready_ms, 3) if self.ready_ms is not None else None,
+                "elapsed_ms": round(self.elapsed_ms(), 3),
+                "error": self.error
+            }
@@ -0,0 +1,355 @@
+"""
+Streaming - Live cell counting over a WebSocket
+A microscope client sends a stream of encoded frames; only the newest
+frame waiting is processed, so when inference is slower than the camera
+older frames are skipped instead of queueing up. Each processed frame
+gets a small JSON message with its counts and, with tracking enabled,
+the number of distinct cells seen so far.
+"""
+import json
+import time
+import asyncio
+import logging
+import threading
+
+import numpy as np
+
+from deadlines import RequestContext, RequestAborted
+
+
+# Per-frame predictor logging is discarded; a session logs its summary only
+FRAME_LOGGER = logging.getLogger('stream.frames')
+FRAME_LOGGER.addHandler(logging.NullHandler())
+FRAME_LOGGER.propagate = False
+FRAME_LOGGER.setLevel(logging.WARNING)
+
+
+def box_iou(boxes_a, boxes_b):
+    """
+    Pairwise IoU between two sets of [x1, y1, x2, y2] boxes
+    Returns:
+        numpy array of shape (len(boxes_a), len(boxes_b))
+    """
+    a = np.asarray(boxes_a, dtype=np.float32).reshape(-1, 4)
+    b = np.asarray(boxes_b, dtype=np.float32).reshape(-1, 4)
+    x1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    y1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    x2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    y2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.clip(x2 - x1, 0, None) * np.clip(y2 - y1, 0, None)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    union = area_a[:, None] + area_b[None, :] - inter
+    return np.where(union > 0, inter / np.maximum(union, 1e-9), 0.0)
+
+
+# ==================== TRACKING ====================
+
+class CellTracker:
+    """Greedy IoU tracker so a cell visible in consecutive frames is counted once"""
+
+    def __init__(self, iou_threshold=0.3, max_missed=5, min_hits=2):
+        """
+        Args:
+            iou_threshold: Minimum IoU for a detection to continue a track
+            max_missed: Processed frames a track survives without a match
+            min_hits: Frames a track needs before it counts as a cell
+                (filters one-frame false positives)
+        """
+        self.iou_threshold = iou_threshold
+        self.max_missed = max(int(max_missed), 0)
+        self.min_hits = max(int(min_hits), 1)
+        self.reset()
+
+    def reset(self):
+        self._tracks = {}  # class -> list of [track_id, bbox, hits, missed]
+        self._next_id = 1
+        self.totals = {}
+
+    def update(self, detections):
+        """
+        Match one frame's detections to the current tracks
+        Args:
+            detections: List of dicts with 'class' and 'bbox'
+        Returns:
+            tuple: (track id per detection, None while a track is unconfirmed;
+                    dict of cells first counted in this frame per class)
+        """
+        track_ids = [None] * len(detections)
+        new = {}
+        by_class = {}
+        for i, detection in enumerate(detections):
+            by_class.setdefault(detection["class"], []).append(i)
+
+        for label in set(by_class) | set(self._tracks):
+            tracks = self._tracks.get(label, [])
+            indices = by_class.get(label, [])
+            matched_tracks = set()
+            matched = set()
+
+            if tracks and indices:
+                iou = box_iou([track[1] for track in tracks], [detections[i]["bbox"] for i in indices])
+                # Highest-IoU pairs first
+                for flat in np.argsort(-iou, axis=None):
+                    t, d = divmod(int(flat), len(indices))
+                    if iou[t, d] < self.iou_threshold:
+                        break
+                    if t in matched_tracks or d in matched:
+                        continue
+                    matched_tracks.add(t)
+                    matched.add(d)
+                    track = tracks[t]
+                    track[1] = detections[indices[d]]["bbox"]
+                    track[2] += 1
+                    track[3] = 0
+                    if track[2] == self.min_hits:
+                        new[label] = new.get(label, 0) + 1
+                    if track[2] >= self.min_hits:
+                        track_ids[indices[d]] = track[0]
+
+            survivors = []
+            for t, track in enumerate(tracks):
+                if t not in matched_tracks:
+                    track[3] += 1
+                    if track[3] > self.max_missed:
+                        continue
+                survivors.append(track)
+
+            for d, i in enumerate(indices):
+                if d in matched:
+                    continue
+                track = [self._next_id, detections[i]["bbox"], 1, 0]
+                self._next_id += 1
+                survivors.append(track)
+                if self.min_hits == 1:
+                    new[label] = new.get(label, 0) + 1
+                    track_ids[i] = track[0]
+
+            if survivors:
+                self._tracks[label] = survivors
+            else:
+                self._tracks.pop(label, None)
+
+        for label, count in new.items():
+            self.totals[label] = self.totals.get(label, 0) + count
+        return track_ids, new
+
+    @property
+    def active(self):
+        return sum(len(tracks) for tracks in self._tracks.values())
+
+
+# ==================== FRAME SLOT ====================
+
+class LatestFrame:
+    """Single-slot mailbox: a new frame replaces one that was not picked up yet"""
+
+    def __init__(self):
+        self._frame = None
+        self._event = asyncio.Event()
+        self.closed = False
+        self.received = 0
+        self.skipped = 0
+
+    def put(self, data, max_latency_ms=None):
+        if self._frame is not None:
+            self.skipped += 1
+        self.received += 1
+        # The context starts the frame's latency budget on arrival
+        self._frame = (self.received, data, RequestContext(max_latency_ms))
+        self._event.set()
+
+    async def get(self):
+        """
+        Wait for the newest frame
+        Returns:
+            tuple (sequence number, bytes, RequestContext), or None once closed
+        """
+        while self._frame is None:
+            if self.closed:
+                return None
+            self._event.clear()
+            await self._event.wait()
+        frame, self._frame = self._frame, None
+        return frame
+
+    def close(self):
+        self.closed = True
+        self._event.set()
+
+
+# ==================== SESSION ====================
+
+class StreamStats:
+    """Counters across all streaming sessions (reported by /metrics)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.active = 0
+        self.sessions = 0
+        self.frames = {"received": 0, "processed": 0, "skipped": 0, "expired": 0, "failed": 0}
+        self._latency_seconds = 0.0
+        self._max_latency_seconds = 0.0
+
+    def opened(self):
+        with self._lock:
+            self.active += 1
+            self.sessions += 1
+
+    def closed(self, session):
+        with self._lock:
+            self.active -= 1
+            self.frames["received"] += session.frames.received
+            self.frames["skipped"] += session.frames.skipped
+            for key in ("processed", "expired", "failed"):
+                self.frames[key] += session.counters[key]
+            self._latency_seconds += session.latency_seconds
+            self._max_latency_seconds = max(self._max_latency_seconds, session.max_latency_seconds)
+
+    def stats(self):
+        with self._lock:
+            processed = self.frames["processed"]
+            return {
+                "active": self.active,
+                "sessions": self.sessions,
+                "frames": dict(self.frames),
+                "mean_latency_ms": round(self._latency_seconds / processed * 1000, 3) if processed else 0.0,
+                "max_latency_ms": round(self._max_latency_seconds * 1000, 3)
+            }
+
+
+class CountStream:
+    """One WebSocket counting session"""
+
+    def __init__(self, websocket, decode, detect, conf=0.25, max_latency_ms=1000, tracker=None,
+                 boxes=False, logger=None):
+        """
+        Args:
+            websocket: Accepted starlette/FastAPI WebSocket
+            decode: async (bytes, timer) -> PIL Image
+            detect: async (image, conf, timer) -> predict_detection_count result
+            conf: Confidence threshold
+            max_latency_ms: Frames older than this when their turn comes are dropped
+            tracker: Optional CellTracker for distinct-cell totals
+            boxes: Include the boxes (and track ids) in every message
+            logger: Session logger (None = print)
+        """
+        self.websocket = websocket
+        self.decode = decode
+        self.detect = detect
+        self.conf = conf
+        self.max_latency_ms = max_latency_ms
+        self.tracker = tracker
+        self.boxes = boxes
+        self.log = logger.info if logger else print
+
+        self.frames = LatestFrame()
+        self.counters = {"processed": 0, "expired": 0, "failed": 0}
+        self.latency_seconds = 0.0
+        self.max_latency_seconds = 0.0
+        self._reported_skips = 0
+        self._current = None
+        self._reset = False
+
+    async def run(self):
+        """Process frames until the client disconnects"""
+        receiver = asyncio.ensure_future(self._receive())
+        try:
+            while True:
+                frame = await self.frames.get()
+                if frame is None:
+                    break
+                await self._process(*frame)
+        finally:
+            receiver.cancel()
+            self.frames.close()
+            self.log(
+                f"Stream closed: {self.frames.received} frames received, {self.counters['processed']} processed, "
+                f"{self.frames.skipped} skipped, {self.counters['expired']} expired, "
+                f"{self.counters['failed']} failed"
+                + (f", distinct cells {self.tracker.totals}" if self.tracker else "")
+            )
+
+    async def _receive(self):
+        # Keep reading so the slot always holds the newest frame
+        try:
+            while True:
+                message = await self.websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                if message.get("bytes"):
+                    self.frames.put(message["bytes"], self.max_latency_ms)
+                elif message.get("text"):
+                    self._control(message["text"])
+        except Exception as e:
+            self.log(f"Stream receive error: {str(e)}")
+        finally:
+            if self._current is not None:
+                self._current.cancel()
+            self.frames.close()
+
+    def _control(self, text):
+        # {"type": "reset"} starts a new distinct-cell count (e.g. a new slide)
+        try:
+            command = json.loads(text)
+        except ValueError:
+            return
+        if isinstance(command, dict) and command.get("type") == "reset":
+            self._reset = True
+
+    async def _process(self, sequence, data, context):
+        self._current = context
+        try:
+            image = await self.decode(data, context)
+            result = await self.detect(image, self.conf, context)
+        except RequestAborted:
+            if self.frames.closed:
+                return
+            self.counters["expired"] += 1
+            return
+        except Exception as e:
+            self.counters["failed"] += 1
+            await self._send({"type": "error", "frame": sequence, "detail": str(e)})
+            return
+        finally:
+            self._current = None
+
+        latency = time.perf_counter() - context.started
+        self.counters["processed"] += 1
+        self.latency_seconds += latency
+        self.max_latency_seconds = max(self.max_latency_seconds, latency)
+
+        message = {
+            "type": "counts",
+            "frame": sequence,
+            "counts": result["counts"],
+            "total_cells": result["total_cells"],
+            "skipped": self.frames.skipped - self._reported_skips,
+            "latency_ms": round(latency * 1000, 1)
+        }
+        self._reported_skips = self.frames.skipped
+
+        track_ids = None
+        if self.tracker is not None:
+            if self._reset:
+                self.tracker.reset()
+                self._reset = False
+            track_ids, new = self.tracker.update(result["detections"])
+            message["new"] = new
+            message["distinct"] = dict(self.tracker.totals)
+        if self.boxes:
+            message["detections"] = [
+                [d["class"], round(d["confidence"], 3)] + [round(v, 1) for v in d["bbox"]]
+                + ([track_ids[i]] if track_ids is not None else [])
+                for i, d in enumerate(result["detections"])
+            ]
+        await self._send(message)
+
+    async def _send(self, message):
+        if self.frames.closed:
+            return
+        try:
+            await self.websocket.send_text(json.dumps(message, separators=(',', ':')))
+        except Exception:
+            # Client went away mid-send; the receiver sees the disconnect
+            self.frames.close()
@@ -24,7 +24,9 @@ const getAllModels = async (req, res) => {
         return res.status(200).json({
             success: true,
             message: 'Models retrieved successfully',
-            data: modelsData.models
+            data: modelsData.models,
+            defaultModel: modelsData.defaultModel || null,
+            profile: modelsData.profile || null
         });
     } catch (error) {
         console.error('Get all models error:', error);
@@ -69,7 +71,19 @@ const getModelById = async (req, res) => {
     }
 };
 
+/**
+ * Default classification model id (measured by DL/profile_models.py)
+ */
+const getDefaultModelId = () => {
+    try {
+        return loadModelsData().defaultModel || 'mobilenet-v2';
+    } catch (error) {
+        return 'mobilenet-v2';
+    }
+};
+
 module.exports = {
     getAllModels,
+    getDefaultModelId,
     getModelById
 };
@@ -7,9 +7,21 @@
 const Upload = require('../models/upload.model');
 const axios = require('axios');
 const FormData = require('form-data');
+const { getDefaultModelId } = require('./modelsController');
 
 // DL API configuration
 const DL_API_URL = process.env.DL_API_URL || 'http://localhost:8000';
+// Per-call timeout (0 = none); forwarded so the DL server abandons work we stopped waiting for
+const DL_TIMEOUT_MS = parseInt(process.env.DL_TIMEOUT_MS || '0', 10);
+
+// Axios config for a multipart call to the DL API
+const dlRequestConfig = (formData) => ({
+    headers: {
+        ...formData.getHeaders(),
+        ...(DL_TIMEOUT_MS > 0 ? { 'X-Request-Deadline-Ms': String(DL_TIMEOUT_MS) } : {})
+    },
+    timeout: DL_TIMEOUT_MS
+});
 
 // Model name mapping: Frontend -> DL API
 const MODEL_MAPPING = {
@@ -36,7 +48,7 @@ function base64ToBuffer(base64String) {
  */
 const predictImage = async (req, res) => {
     try {
-        const { image, options, classificationModel, fileName, fileSize, mimeType, showLabels = true } = req.body;
+        const { image, options, classificationModel, fileName, fileSize, mimeType, showLabels = true, tta = 0 } = req.body;
         const userId = req.userId; // From auth middleware
         const startTime = Date.now();
 
@@ -60,16 +72,19 @@ const predictImage = async (req, res) => {
         try {
             // Classification
             if (options.classification) {
-                const modelId = MODEL_MAPPING[classificationModel] || 'mobilenet-v2';
+                const modelId = MODEL_MAPPING[classificationModel] || getDefaultModelId();
                 
                 const formData = new FormData();
                 formData.append('image', imageBuffer, { filename: 'image.jpg' });
                 formData.append('model_id', modelId);
+                if (tta > 1) {
+                    formData.append('tta', String(tta));
+                }
 
                 const classificationResponse = await axios.post(
                     `${DL_API_URL}/predict/classification`,
                     formData,
-                    { headers: formData.getHeaders() }
+                    dlRequestConfig(formData)
                 );
 
                 if (classificationResponse.data.success) {
@@ -77,8 +92,9 @@ const predictImage = async (req, res) => {
                     response.classification = {
                         cellType: result.predicted_class,
                         confidence: (result.confidence * 100).toFixed(1),
-                        model: classificationModel || 'MobileNet',
-                        probabilities: result.probabilities
+                        model: classificationModel || Object.keys(MODEL_MAPPING).find(name => MODEL_MAPPING[name] === modelId) || modelId,
+                        probabilities: result.probabilities,
+                        ...(result.tta ? { tta: result.tta } : {})
                     };
                 } else {
                     throw new Error('Classification failed');
@@ -95,7 +111,7 @@ const predictImage = async (req, res) => {
                 const detectionResponse = await axios.post(
                     `${DL_API_URL}/predict/detection`,
                     formData,
-                    { headers: formData.getHeaders() }
+                    dlRequestConfig(formData)
                 );
 
                 if (detectionResponse.data.success) {
@@ -121,7 +137,7 @@ const predictImage = async (req, res) => {
                 const countResponse = await axios.post(
                     `${DL_API_URL}/predict/count`,
                     formData,
-                    { headers: formData.getHeaders() }
+                    dlRequestConfig(formData)
                 );
 
                 if (countResponse.data.success) {
@@ -206,6 +222,7 @@ const getAvailableModels = async (req, res) => {
             
             if (dlModelsResponse.data.success) {
                 const dlModels = dlModelsResponse.data.models;
+                const defaultModelId = getDefaultModelId();
                 
                 // Map DL model IDs back to frontend names
                 const reverseMapping = {
@@ -220,7 +237,7 @@ const getAvailableModels = async (req, res) => {
                     return {
                         name,
                         status: 'active',
-                        recommended: modelId === 'mobilenet-v2'
+                        recommended: modelId === defaultModelId
                     };
                 });
                 
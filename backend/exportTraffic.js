@@ -0,0 +1,110 @@
+const fs = require('fs');
+const path = require('path');
+const mongoose = require('mongoose');
+const Upload = require('./models/upload.model');
+require('dotenv').config({ quiet: true });
+
+/**
+ * Export recorded predictions as a JSONL traffic trace for DL/loadtest.py
+ *
+ * Usage:
+ *   node exportTraffic.js [output.jsonl] [--limit N] [--with-images DIR]
+ */
+
+// Model name mapping: Frontend -> DL API (same as predictionController)
+const MODEL_MAPPING = {
+    'ResNet': 'resnet-50',
+    'DenseNet': 'densenet-121',
+    'MobileNet': 'mobilenet-v2',
+    'EfficientNet': 'efficientnet-b0',
+    'CNN': 'cnn',
+    'ViT': 'vit-base'
+};
+
+const parseArgs = () => {
+    const args = process.argv.slice(2);
+    const options = { output: 'traffic_trace.jsonl', limit: 0, imagesDir: null };
+
+    for (let i = 0; i < args.length; i++) {
+        if (args[i] === '--limit') {
+            options.limit = parseInt(args[++i], 10) || 0;
+        } else if (args[i] === '--with-images') {
+            options.imagesDir = args[++i];
+        } else {
+            options.output = args[i];
+        }
+    }
+    return options;
+};
+
+const extensionFor = (mimeType) => {
+    if (mimeType === 'image/png') return 'png';
+    return 'jpg';
+};
+
+const exportTraffic = async () => {
+    const options = parseArgs();
+
+    try {
+        await mongoose.connect(process.env.MONGO_URI);
+        console.log('Connected to MongoDB');
+
+        if (options.imagesDir) {
+            fs.mkdirSync(options.imagesDir, { recursive: true });
+        }
+
+        let query = Upload.find({ status: 'completed' }).sort({ createdAt: 1 });
+        if (options.limit > 0) {
+            query = query.limit(options.limit);
+        }
+        // Image payloads are only needed when writing them out
+        if (!options.imagesDir) {
+            query = query.select('-imageData');
+        }
+
+        const out = fs.createWriteStream(options.output);
+        let firstTimestamp = null;
+        let exported = 0;
+
+        for await (const upload of query.cursor()) {
+            const createdAt = upload.createdAt.getTime();
+            if (firstTimestamp === null) {
+                firstTimestamp = createdAt;
+            }
+
+            const record = {
+                offset_s: (createdAt - firstTimestamp) / 1000,
+                task: 'classification',
+                model_id: MODEL_MAPPING[upload.prediction.modelUsed] || 'mobilenet-v2',
+                image_bytes: upload.imageSize || null,
+                width: upload.metadata?.imageWidth || null,
+                height: upload.metadata?.imageHeight || null,
+                mime_type: upload.imageMimeType || null,
+                processing_ms: upload.processingTime || null
+            };
+
+            if (options.imagesDir && upload.imageData) {
+                const base64Data = upload.imageData.replace(/^data:image\/\w+;base64,/, '');
+                const fileName = `${upload._id}.${extensionFor(upload.imageMimeType)}`;
+                fs.writeFileSync(path.join(options.imagesDir, fileName), Buffer.from(base64Data, 'base64'));
+                record.image = path.resolve(options.imagesDir, fileName);
+            }
+
+            out.write(JSON.stringify(record) + '\n');
+            exported++;
+        }
+
+        await new Promise(resolve => out.end(resolve));
+        console.log(`✅ Exported ${exported} requests to ${options.output}`);
+
+    } catch (error) {
+        console.error('Error exporting traffic:', error);
+    } finally {
+        await mongoose.connection.close();
+        console.log('Database connection closed');
+        process.exit(0);
+    }
+};
+
+// Run the export function
+exportTraffic();
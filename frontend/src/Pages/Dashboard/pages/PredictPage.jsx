@@ -1,8 +1,17 @@
 import React, { useState, useEffect } from "react";
 import { predictImage } from "../../../helpers/uploadApi";
+import { getAllModels } from "../../../helpers/modelsApi";
 import { saveToCache, getFromCache, clearCache, CACHE_KEYS } from "../../../helpers/cache";
 import { errorToast, successToast } from "../../../helpers/toast";
 
+// Model picker names for the backend's model ids
+const MODEL_NAMES = {
+    'resnet-50': 'ResNet',
+    'densenet-121': 'DenseNet',
+    'mobilenet-v2': 'MobileNet',
+    'vit-base': 'ViT'
+};
+
 const PredictPage = ({ onUploadSuccess }) => {
     const [selectedFile, setSelectedFile] = useState(null);
     const [preview, setPreview] = useState(null);
@@ -16,7 +25,8 @@ const PredictPage = ({ onUploadSuccess }) => {
         count: false
     });
     
-    // Classification model selection
+    // Classification model selection (default comes from the measured model profile)
+    const [defaultModel, setDefaultModel] = useState("MobileNet");
     const [classificationModel, setClassificationModel] = useState("MobileNet");
     
     // Show labels option for detection/count
@@ -30,6 +40,19 @@ const PredictPage = ({ onUploadSuccess }) => {
         }
     }, []);
 
+    // Pick the recommended model from the model metadata
+    useEffect(() => {
+        getAllModels()
+            .then((response) => {
+                const name = MODEL_NAMES[response.defaultModel];
+                if (name) {
+                    setDefaultModel(name);
+                    setClassificationModel(name);
+                }
+            })
+            .catch(() => {});
+    }, []);
+
     const handleFileChange = (e) => {
         const file = e.target.files[0];
         if (file) {
@@ -127,7 +150,7 @@ const PredictPage = ({ onUploadSuccess }) => {
             detection: false,
             count: false
         });
-        setClassificationModel("MobileNet");
+        setClassificationModel(defaultModel);
         setShowLabels(true);
         clearCache(CACHE_KEYS.PREDICTION_RESULTS);
     };
@@ -188,7 +211,7 @@ const PredictPage = ({ onUploadSuccess }) => {
                                                     checked={classificationModel === model}
                                                     onChange={(e) => setClassificationModel(e.target.value)}
                                                 />
-                                                <span>{model} {model === 'MobileNet' && <span className="recommended-badge">Recommended</span>}</span>
+                                                <span>{model} {model === defaultModel && <span className="recommended-badge">Recommended</span>}</span>
                                             </label>
                                         ))}
                                     </div>